@@ -0,0 +1,85 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+"""Compare the former from_pydata + bmesh mesh construction with the bulk
+foreach_set one used by google_maps.addMesh, on large synthetic grids.
+Run from a Blender installation:
+    blender --background --factory-startup --python benchmark/addmesh.py -- 10000 100000 1000000
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+import bpy
+import bmesh
+from bpy_extras import object_utils
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "blender"))
+from MapsModelsImporter.google_maps import addMesh
+
+def makeGrid(vertex_count):
+    """Return verts, tris and uvs of a regular grid with about vertex_count vertices"""
+    side = max(2, int(vertex_count ** 0.5))
+    u, v = np.meshgrid(np.linspace(0, 1, side), np.linspace(0, 1, side))
+    uvs = np.stack([u.ravel(), v.ravel()], axis=1)
+    verts = np.concatenate([uvs, np.zeros((len(uvs), 1))], axis=1)
+    i = np.arange(side * (side - 1)).reshape(side - 1, side)[:, :-1].ravel()
+    tris = np.concatenate([
+        np.stack([i, i + 1, i + side], axis=1),
+        np.stack([i + 1, i + side + 1, i + side], axis=1),
+    ])
+    return verts, tris, uvs
+
+def addMeshLegacy(context, name, verts, tris, uvs):
+    """Mesh construction as it was done before switching to foreach_set"""
+    mesh = bpy.data.meshes.new(name)
+    mesh.from_pydata(verts.tolist(), [], tris.tolist())
+    mesh.update()
+    bm = bmesh.new()
+    bm.from_mesh(mesh)
+    uv_layer = bm.loops.layers.uv.verify()
+    for f in bm.faces:
+        for l in f.loops:
+            l[uv_layer].uv = tuple(uvs[l.vert.index])
+    bm.to_mesh(mesh)
+    return object_utils.object_data_add(context, mesh, operator=None)
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def main(vertex_counts):
+    context = bpy.context
+    for vertex_count in vertex_counts:
+        verts, tris, uvs = makeGrid(vertex_count)
+        legacy = timeit(addMeshLegacy, context, "Legacy", verts, tris, uvs)
+        bulk = timeit(addMesh, context.scene.collection, "Bulk", verts, tris, uvs)
+        print(f"{len(verts):>9} verts, {len(tris):>9} tris: "
+            f"legacy {legacy*1000.:.1f}ms, bulk {bulk*1000.:.1f}ms (x{legacy/bulk:.1f})")
+
+if __name__ == "__main__":
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    main([int(arg) for arg in argv] or [10000, 100000, 1000000])
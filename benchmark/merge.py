@@ -0,0 +1,106 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+"""Measure how import and scene evaluation times scale with the number of
+objects, by importing the same synthetic draw calls either as one object per
+draw call or merged into fewer objects with google_maps.MeshChunk.
+Run from a Blender installation:
+    blender --background --factory-startup --python benchmark/merge.py -- [draw calls] [vertices per draw call]
+Viewport drawing is only timed when Blender is not run in background.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+import bpy
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "blender"))
+sys.path.insert(0, BENCHMARK_DIR)
+from MapsModelsImporter.google_maps import addMesh, MeshChunk
+from addmesh import makeGrid
+
+def clearScene():
+    for obj in list(bpy.data.objects):
+        bpy.data.objects.remove(obj)
+    for mesh in list(bpy.data.meshes):
+        bpy.data.meshes.remove(mesh)
+
+def makeDrawcalls(drawcall_count, vertex_count):
+    """Return one (verts, tris, uvs) per draw call, spread on a square area"""
+    verts, tris, uvs = makeGrid(vertex_count)
+    side = int(np.ceil(drawcall_count ** 0.5))
+    return [
+        (verts + [i % side, i // side, 0], tris, uvs)
+        for i in range(drawcall_count)
+    ]
+
+def importDrawcalls(context, drawcalls, object_count, materials):
+    """Import draw calls as object_count objects"""
+    if object_count == len(drawcalls):
+        for i, (verts, tris, uvs) in enumerate(drawcalls):
+            obj = addMesh(context.scene.collection, "BuildingMesh-{:05d}".format(i), verts, tris, uvs)
+            obj.data.materials.append(materials[i % len(materials)])
+        return
+    chunks = [MeshChunk() for _ in range(object_count)]
+    for i, (verts, tris, uvs) in enumerate(drawcalls):
+        chunks[i * object_count // len(drawcalls)].add(verts, tris, uvs, materials[i % len(materials)])
+    for i, chunk in enumerate(chunks):
+        chunk.toBlender(context.scene.collection, "BuildingChunk-{:05d}".format(i))
+
+def evaluateScene(context):
+    context.view_layer.update()
+    depsgraph = context.evaluated_depsgraph_get()
+    for obj in context.scene.objects:
+        obj.evaluated_get(depsgraph)
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def main(drawcall_count, vertex_count):
+    context = bpy.context
+    drawcalls = makeDrawcalls(drawcall_count, vertex_count)
+    materials = [bpy.data.materials.new("BuildingMat-{:05d}".format(i)) for i in range(16)]
+    object_counts = sorted({
+        count for count in (drawcall_count, drawcall_count // 10, drawcall_count // 100, 16, 1)
+        if 0 < count <= drawcall_count
+    }, reverse=True)
+    print(f"{drawcall_count} draw calls of {len(drawcalls[0][0])} vertices:")
+    for object_count in object_counts:
+        clearScene()
+        import_time = timeit(importDrawcalls, context, drawcalls, object_count, materials)
+        evaluation_time = timeit(evaluateScene, context)
+        line = f" - {object_count:>6} objects: import {import_time*1000.:9.1f}ms, evaluation {evaluation_time*1000.:9.1f}ms"
+        if not bpy.app.background:
+            draw_time = timeit(lambda: bpy.ops.wm.redraw_timer(type='DRAW_WIN_SWAP', iterations=10)) / 10
+            line += f", viewport draw {draw_time*1000.:9.1f}ms"
+        print(line)
+
+if __name__ == "__main__":
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    args = [int(arg) for arg in argv]
+    main(*(args + [5000, 500][len(args):]))
@@ -0,0 +1,259 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+"""Benchmarks of the extraction and of the import that run on plain Linux,
+without RenderDoc, a GPU nor Blender: synthetic captures of Google Maps,
+Google Earth and Mapy CZ are served by the stand-in renderdoc module of
+benchmark/stubs, and imported with its stand-in bpy module.
+    python benchmark/offline.py [--scales small,medium] [--kinds maps,earth,mapy] [--output results.json] [--baseline previous.json]
+Scales give a number of draw calls and an average number of vertices per
+draw call, see SCALES, or use --draws and --vertices.
+
+Each benchmark is timed, then run again while tracing Python and NumPy
+allocations to measure its peak memory (unless --no-memory). Results can
+be saved as JSON and compared to a previous run of this script. Stubs neither
+encode images nor fill GPU buffers, so only compare runs with each other,
+not with imports of real captures.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+ADDON_DIR = os.path.join(BENCHMARK_DIR, "..", "blender", "MapsModelsImporter")
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "..", "blender"))
+sys.path.insert(0, ADDON_DIR)
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, "stubs"))
+import renderdoc as rd
+import bpy
+from meshdata import unpackDataNumpy, makeMeshData, DrawBuffers
+from google_maps_rd import CaptureScraper, parseArgs, TEXTURE_FORMATS
+from rdutils import CaptureWrapper
+import MapsModelsImporter
+from MapsModelsImporter.google_maps import filesToBlender
+
+# name -> (draw calls, average vertices per draw call)
+SCALES = {
+    "small": (1000, 10),
+    "medium": (10000, 100),
+    "large": (100000, 100),
+}
+DEFAULT_SCALES = ("small", "medium")
+
+# -----------------------------------------------------------------------------
+# Benchmarks, each one returns the number of units it processed
+
+def drawActions(controller):
+    return [action for action in controller.GetRootActions() if action.flags & rd.ActionFlags.Drawcall]
+
+def benchUnpack(capture_file, prefix, options):
+    """Decode all vertex attributes of the capture with unpackDataNumpy,
+    from a single buffer
+    @return vertex count"""
+    with CaptureWrapper(capture_file) as controller:
+        vertex_count = sum(action.numIndices for action in drawActions(controller)) // 3
+        controller.SetFrameEvent(drawActions(controller)[0].eventId, True)
+        state = controller.GetPipelineState()
+        attributes = state.GetVertexInputs()
+        stride = state.GetVBuffers()[0].byteStride
+    data = np.random.default_rng(0).integers(0, 256, vertex_count * stride, dtype=np.uint8).tobytes()
+    def run():
+        for attr in attributes:
+            unpackDataNumpy(attr.format, data, stride=stride, count=vertex_count, offset=attr.byteOffset)
+        return vertex_count
+    return run
+
+def benchMeshData(capture_file, prefix, options):
+    """Fetch the indices and all vertex attributes of each draw call, like
+    CaptureScraper does
+    @return draw call count"""
+    def run():
+        with CaptureWrapper(capture_file) as controller:
+            draws = drawActions(controller)
+            for draw in draws:
+                controller.SetFrameEvent(draw.eventId, True)
+                state = controller.GetPipelineState()
+                ib = state.GetIBuffer()
+                vbs = state.GetVBuffers()
+                meshes = [makeMeshData(attr, ib, vbs, draw) for attr in state.GetVertexInputs()]
+                buffers = DrawBuffers(controller, meshes[0])
+                for mesh in meshes:
+                    buffers.fetchData(mesh)
+            return len(draws)
+    return run
+
+def benchScraper(capture_file, prefix, options):
+    """Extract the capture to files with CaptureScraper.run, in this process
+    @return draw call count"""
+    argv = [capture_file, prefix, "-1", "--texture-format", options.texture_format]
+    def run():
+        with CaptureWrapper(capture_file) as controller:
+            scraper = CaptureScraper(controller, parseArgs(argv))
+            scraper.run()
+            return len(scraper.drawcall_entries)
+    return run
+
+def benchImport(capture_file, prefix, options):
+    """Import the files extracted by CaptureScraper in the stand-in bpy
+    @return draw call count"""
+    benchScraper(capture_file, prefix, options)()
+    def run():
+        bpy.data.clear()
+        bpy.context.scene.collection.children.clear()
+        filesToBlender(bpy.context, prefix, max_blocks=-1, merge_mode=options.merge_mode)
+        return len(bpy.data.objects) if options.merge_mode == 'NONE' else len(bpy.data.meshes)
+    return run
+
+BENCHMARKS = {
+    "unpack": (benchUnpack, "vertices"),
+    "meshdata": (benchMeshData, "draws"),
+    "scraper": (benchScraper, "draws"),
+    "import": (benchImport, "draws"),
+}
+
+# -----------------------------------------------------------------------------
+
+def measure(run, trace_memory):
+    """@return units processed, time in seconds and peak memory in bytes (None if not traced)"""
+    start = time.perf_counter()
+    units = run()
+    seconds = time.perf_counter() - start
+    peak_memory = None
+    if trace_memory:
+        tracemalloc.start()
+        run()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return units, seconds, peak_memory
+
+def runBenchmarks(options, workdir):
+    scales = [(name, *SCALES[name]) for name in options.scales]
+    if options.draws is not None:
+        scales = [("custom", options.draws, options.vertices)]
+    results = []
+    for kind in options.kinds:
+        for scale, draws, vertices in scales:
+            capture_file = os.path.join(workdir, f"{kind}-{scale}.rdc")
+            rd.writeCapture(capture_file, kind, draws, vertices)
+            prefix = os.path.join(workdir, f"{kind}-{scale}-")
+            for name in options.benchmarks:
+                make_run, unit = BENCHMARKS[name]
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                    units, seconds, peak_memory = measure(make_run(capture_file, prefix, options), options.memory)
+                result = {
+                    "benchmark": name,
+                    "kind": kind,
+                    "scale": scale,
+                    "draws": draws,
+                    "vertices": vertices,
+                    "seconds": seconds,
+                    "units": units,
+                    "unit": unit,
+                    "throughput": units / seconds if seconds > 0 else None,
+                    "peak_memory": peak_memory,
+                }
+                results.append(result)
+                printResult(result)
+    return results
+
+def printResult(result):
+    line = " - {benchmark:>8} {kind:>5} {scale:>6}: {seconds:8.3f}s, {throughput:12,.0f} {unit}/s".format(**result)
+    if result["peak_memory"] is not None:
+        line += ", peak {:8.1f}MB".format(result["peak_memory"] / 1e6)
+    print(line)
+
+def resultKey(result):
+    return (result["benchmark"], result["kind"], result["draws"], result["vertices"])
+
+def compareResults(results, baseline):
+    """Print the ratio of the throughput and peak memory of each result to
+    the matching one of the baseline"""
+    previous = { resultKey(result): result for result in baseline["results"] }
+    print("Compared to the baseline:")
+    for result in results:
+        reference = previous.get(resultKey(result))
+        if reference is None:
+            continue
+        line = " - {benchmark:>8} {kind:>5} {scale:>6}: throughput x{:.2f}".format(result["throughput"] / reference["throughput"], **result)
+        if result["peak_memory"] is not None and reference["peak_memory"]:
+            line += ", peak memory x{:.2f}".format(result["peak_memory"] / reference["peak_memory"])
+        print(line)
+
+def parseOptions(argv):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the extraction and import, on synthetic captures")
+    parser.add_argument("--kinds", default=",".join(rd.CAPTURE_KINDS), help="Kinds of capture, among " + ", ".join(rd.CAPTURE_KINDS))
+    parser.add_argument("--scales", default=",".join(DEFAULT_SCALES), help="Scales to run, among " + ", ".join(SCALES))
+    parser.add_argument("--draws", type=int, default=None, help="Number of draw calls, instead of the predefined scales")
+    parser.add_argument("--vertices", type=int, default=100, help="Average number of vertices per draw call, with --draws")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help="Benchmarks to run, among " + ", ".join(BENCHMARKS))
+    parser.add_argument("--texture-format", choices=TEXTURE_FORMATS, default='png')
+    parser.add_argument("--merge-mode", choices=('NONE', 'TEXTURE', 'GRID'), default='NONE')
+    parser.add_argument("--no-memory", dest="memory", action='store_false', help="Do not measure peak memory, which runs each benchmark a second time")
+    parser.add_argument("--output", default=None, help="Save results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Compare results to those of a previous run, saved with --output")
+    options = parser.parse_args(argv)
+    options.kinds = options.kinds.split(",")
+    options.scales = options.scales.split(",")
+    options.benchmarks = options.benchmarks.split(",")
+    for value, choices in ((options.kinds, rd.CAPTURE_KINDS), (options.scales, SCALES), (options.benchmarks, BENCHMARKS)):
+        unknown = set(value) - set(choices)
+        if unknown:
+            parser.error("unknown value(s): " + ", ".join(sorted(unknown)))
+    return options
+
+def main(argv):
+    options = parseOptions(argv)
+    MapsModelsImporter.register()
+    bpy.context.setAddonPreferences(MapsModelsImporter.__name__, debug_info=False, trace_file="", report_file="", memory_profiling=False)
+
+    workdir = tempfile.mkdtemp(prefix="mmi-benchmark-")
+    try:
+        results = runBenchmarks(options, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(baseline, f, indent=2)
+    if options.baseline is not None:
+        with open(options.baseline) as f:
+            compareResults(results, json.load(f))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
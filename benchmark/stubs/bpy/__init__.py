@@ -0,0 +1,100 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+"""Stand-in for Blender's bpy module, for benchmarks to run in a plain Python
+interpreter (see benchmark/offline.py). Data blocks only keep the arrays they
+are given, so that the memory they use compares to Blender's, and nothing is
+drawn nor evaluated. It only implements what the add-on uses.
+"""
+
+import os
+
+from . import app, path, props, types, utils
+
+# -----------------------------------------------------------------------------
+
+class _DataBlocks(list):
+    """bpy.data collection of data blocks of a given type"""
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def new(self, name, *args, **kwargs):
+        block = self.factory(name, *args, **kwargs)
+        self.append(block)
+        return block
+
+    def load(self, filepath, check_existing=False):
+        block = self.new(os.path.basename(filepath))
+        block.filepath = filepath
+        return block
+
+    def remove(self, block, **kwargs):
+        list.remove(self, block)
+
+    def get(self, name, default=None):
+        return next((block for block in self if block.name == name), default)
+
+class _BlendData():
+    def __init__(self):
+        self.meshes = _DataBlocks(types.Mesh)
+        self.images = _DataBlocks(types.Image)
+        self.materials = _DataBlocks(types.Material)
+        self.objects = _DataBlocks(types.Object)
+        self.collections = _DataBlocks(types.Collection)
+
+    def clear(self):
+        """Remove all data blocks, not available in Blender"""
+        self.__init__()
+
+data = _BlendData()
+
+# -----------------------------------------------------------------------------
+
+class _Addon():
+    def __init__(self, preferences):
+        self.preferences = preferences
+
+class _Preferences():
+    def __init__(self):
+        self.addons = {}
+
+class _ViewLayer():
+    def update(self):
+        pass
+
+class _Context():
+    def __init__(self):
+        self.scene = types.Scene()
+        self.collection = self.scene.collection
+        self.view_layer = _ViewLayer()
+        self.preferences = _Preferences()
+
+    def setAddonPreferences(self, addon_idname, **values):
+        """Set preferences of an add-on, not available in Blender"""
+        preferences = types.AddonPreferences()
+        preferences.__dict__.update(values)
+        self.preferences.addons[addon_idname] = _Addon(preferences)
+        return preferences
+
+context = _Context()
@@ -0,0 +1,191 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+import numpy as np
+
+# -----------------------------------------------------------------------------
+# Classes the add-on derives from
+
+class Operator():
+    pass
+
+class Panel():
+    pass
+
+class AddonPreferences():
+    pass
+
+class _Menu():
+    def __init__(self):
+        self.functions = []
+
+    def append(self, function):
+        self.functions.append(function)
+
+    def remove(self, function):
+        self.functions.remove(function)
+
+TOPBAR_MT_file_import = _Menu()
+
+# -----------------------------------------------------------------------------
+# Data blocks
+
+class _ArrayCollection():
+    """Collection property of a data block, only storing what foreach_set
+    gives it, as arrays of item_size values per item"""
+    def __init__(self, item_sizes={}):
+        self.item_sizes = item_sizes
+        self.arrays = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, count):
+        self.count += count
+
+    def foreach_set(self, attr, seq):
+        array = np.array(seq, copy=True)
+        if array.size != self.count * self.item_sizes.get(attr, 1):
+            raise RuntimeError(f"foreach_set(\"{attr}\"): {array.size} values for {self.count} items")
+        self.arrays[attr] = array
+
+    def foreach_get(self, attr, seq):
+        seq[:] = self.arrays[attr]
+
+class MeshUVLoopLayer():
+    def __init__(self, mesh, name):
+        self.name = name
+        self.data = _ArrayCollection({ "uv": 2 })
+        self.data.add(len(mesh.loops))
+
+class _UVLayers(list):
+    def __init__(self, mesh):
+        super().__init__()
+        self.mesh = mesh
+
+    def new(self, name="UVMap"):
+        layer = MeshUVLoopLayer(self.mesh, name)
+        self.append(layer)
+        return layer
+
+class Mesh():
+    def __init__(self, name):
+        self.name = name
+        self.vertices = _ArrayCollection({ "co": 3 })
+        self.loops = _ArrayCollection()
+        self.polygons = _ArrayCollection()
+        self.uv_layers = _UVLayers(self)
+        self.materials = []
+
+    def update(self, calc_edges=False):
+        pass
+
+class _Pixels():
+    def __init__(self, size):
+        self.size = size
+        self.array = None
+
+    def __len__(self):
+        return self.size
+
+    def foreach_set(self, seq):
+        if len(seq) != self.size:
+            raise RuntimeError(f"foreach_set: {len(seq)} values for {self.size} pixel components")
+        self.array = np.array(seq, dtype=np.float32)
+
+class Image():
+    def __init__(self, name, width=0, height=0, alpha=False, float_buffer=False):
+        self.name = name
+        self.filepath = ""
+        self.size = (width, height)
+        self.pixels = _Pixels(width * height * 4)
+
+    def update(self):
+        pass
+
+    def pack(self):
+        pass
+
+class NodeSocket():
+    def __init__(self):
+        self.default_value = None
+
+class _Sockets(dict):
+    def __missing__(self, key):
+        socket = self[key] = NodeSocket()
+        return socket
+
+class Node():
+    def __init__(self, type):
+        self.type = type
+        self.inputs = _Sockets()
+        self.outputs = _Sockets()
+        self.image = None
+
+class _Nodes(dict):
+    def new(self, type):
+        node = self[f"{type}.{len(self):03d}"] = Node(type)
+        return node
+
+class _Links(list):
+    def new(self, output, input):
+        self.append((output, input))
+        return self[-1]
+
+class NodeTree():
+    def __init__(self):
+        self.nodes = _Nodes({ "Principled BSDF": Node("ShaderNodeBsdfPrincipled") })
+        self.links = _Links()
+
+class Material():
+    def __init__(self, name):
+        self.name = name
+        self.use_nodes = False
+        self.node_tree = NodeTree()
+
+class Object():
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.matrix_world = None
+
+    def select_set(self, state):
+        pass
+
+class _CollectionMembers(list):
+    def link(self, item):
+        self.append(item)
+
+    def unlink(self, item):
+        self.remove(item)
+
+class Collection():
+    def __init__(self, name):
+        self.name = name
+        self.objects = _CollectionMembers()
+        self.children = _CollectionMembers()
+
+class Scene():
+    def __init__(self):
+        self.collection = Collection("Scene Collection")
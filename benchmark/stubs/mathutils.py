@@ -0,0 +1,75 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+"""Stand-in for Blender's mathutils module, see bpy/__init__.py.
+Only 4x4 matrices are supported."""
+
+from math import cos, sin
+import numpy as np
+
+class Matrix():
+    def __init__(self, rows=None):
+        self.array = np.identity(4) if rows is None else np.array([list(row) for row in rows], dtype=np.float64)
+
+    @staticmethod
+    def Identity(size):
+        return Matrix()
+
+    @staticmethod
+    def Scale(factor, size):
+        return Matrix(np.diag([factor, factor, factor, 1.0]))
+
+    @staticmethod
+    def Rotation(angle, size, axis):
+        c, s = cos(angle), sin(angle)
+        i, j = { 'X': (1, 2), 'Y': (2, 0), 'Z': (0, 1) }[axis]
+        array = np.identity(4)
+        array[i, i], array[i, j], array[j, i], array[j, j] = c, -s, s, c
+        return Matrix(array)
+
+    def transposed(self):
+        return Matrix(self.array.T)
+
+    def inverted(self):
+        return Matrix(np.linalg.inv(self.array))
+
+    def __matmul__(self, other):
+        return Matrix(self.array @ other.array)
+
+    def __mul__(self, factor):
+        return Matrix(self.array * factor)
+
+    def __getitem__(self, row):
+        return self.array[row]
+
+    def __setitem__(self, row, values):
+        self.array[row] = values
+
+    def __iter__(self):
+        return iter(self.array)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array if dtype is None else self.array.astype(dtype)
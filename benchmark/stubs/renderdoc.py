@@ -0,0 +1,396 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+"""Stand-in for the renderdoc module, for benchmarks to run without RenderDoc
+nor a GPU (see benchmark/offline.py). It only implements what the extraction
+scripts use.
+
+Capture files are JSON descriptions of a synthetic capture, written by
+writeCapture(). Replaying one serves the actions, pipeline state, vertex and
+index buffers, constant buffers and textures of draw calls laid out like in
+real captures of Google Maps, Google Earth or Mapy CZ, so that the scraping
+strategies of google_maps_rd.py recognize them.
+"""
+
+import json
+import numpy as np
+
+CAPTURE_KINDS = ('maps', 'earth', 'mapy')
+TEXTURE_SIZE = 256
+
+# -----------------------------------------------------------------------------
+# Enums and simple structures
+
+class _Enum():
+    def __init__(self, *names):
+        for value, name in enumerate(names):
+            setattr(self, name, value)
+
+ShaderStage = _Enum("Vertex", "Hull", "Domain", "Geometry", "Pixel", "Compute")
+ShaderStage.Fragment = ShaderStage.Pixel
+VarType = _Enum("Float", "Double", "Half", "SInt", "UInt")
+Topology = _Enum("Unknown", "PointList", "LineList", "LineStrip", "TriangleList", "TriangleStrip")
+CompType = _Enum("Typeless", "Float", "UNorm", "SNorm", "UInt", "SInt", "UScaled", "SScaled", "Depth", "UNormSRGB")
+AlphaMapping = _Enum("Discard", "BlendToColor", "BlendToCheckerboard", "Preserve")
+FileType = _Enum("DDS", "PNG", "JPG", "BMP", "TGA", "HDR", "EXR", "Raw")
+
+class ActionFlags():
+    Drawcall = 0x1
+    Clear = 0x2
+    Indexed = 0x10000
+
+class ResourceId():
+    def __init__(self, value=0):
+        self.value = value
+
+    @staticmethod
+    def Null():
+        return ResourceId(0)
+
+    def __eq__(self, other):
+        return isinstance(other, ResourceId) and other.value == self.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __int__(self):
+        return self.value
+
+    def __repr__(self):
+        return "ResourceId::{}".format(self.value)
+
+class ResourceFormat():
+    def __init__(self, compType=CompType.Typeless, compCount=0, compByteWidth=0, bgra=False):
+        self.compType = compType
+        self.compCount = compCount
+        self.compByteWidth = compByteWidth
+        self.bgra = bgra
+
+    def Special(self):
+        return False
+
+    def BGRAOrder(self):
+        return self.bgra
+
+class MeshFormat():
+    pass
+
+class Subresource():
+    def __init__(self, mip=0, slice=0, sample=0):
+        self.mip = mip
+        self.slice = slice
+        self.sample = sample
+
+class TextureSave():
+    def __init__(self):
+        self.resourceId = ResourceId.Null()
+        self.mip = 0
+        self.slice = Subresource()
+        self.slice.sliceIndex = 0
+        self.alpha = AlphaMapping.Discard
+        self.destType = FileType.DDS
+
+class ReplayOptions():
+    pass
+
+class _Struct():
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+class _Status():
+    def __init__(self, message=None, code=0):
+        self.message = message
+        self.code = code
+
+    def OK(self):
+        return self.message is None
+
+    def Message(self):
+        return self.message or ""
+
+class ShaderValue():
+    def __init__(self, values):
+        self.f32v = list(values) + [0.0] * (16 - len(values))
+        self.s32v = [int(v) for v in self.f32v]
+
+class ShaderVariable():
+    def __init__(self, name, values, rows=1, columns=4):
+        self.name = name
+        self.type = VarType.Float
+        self.rows = rows
+        self.columns = columns
+        self.members = []
+        self.value = ShaderValue(values)
+
+# -----------------------------------------------------------------------------
+# Synthetic captures
+
+# Vertex attributes of each kind of capture, as (name, format, byte offset),
+# with the size of a vertex, like in the captures measured by benchmark/unpack.py
+VERTEX_LAYOUTS = {
+    'maps': ([
+        ("POSITION", ResourceFormat(CompType.UInt, 4, 1), 0),
+        ("TEXCOORD", ResourceFormat(CompType.UNorm, 2, 2), 4),
+    ], 8),
+    'earth': ([
+        ("POSITION", ResourceFormat(CompType.Float, 3, 4), 0),
+        ("NORMAL", ResourceFormat(CompType.SNorm, 4, 1), 12),
+        ("TEXCOORD", ResourceFormat(CompType.UNorm, 2, 2), 16),
+    ], 20),
+    'mapy': ([
+        ("POSITION", ResourceFormat(CompType.UInt, 4, 2), 0),
+        ("TEXCOORD", ResourceFormat(CompType.UNorm, 2, 2), 8),
+    ], 12),
+}
+
+def _matrix(rows):
+    """Flatten a matrix given by rows into the column major order of constant buffers"""
+    return np.array(rows, dtype=np.float64).T.ravel().tolist()
+
+def _translation(x, y, z=0.0):
+    return _matrix([[1, 0, 0, x], [0, 1, 0, y], [0, 0, 1, z], [0, 0, 0, 1]])
+
+def _uniforms(kind, position):
+    """Vertex shader uniforms of a draw call placed at the given position"""
+    x, y = position
+    if kind == 'maps':
+        return {
+            "_w": [0.0, 0.0, 1.0 / 65536.0, 1.0 / 65536.0],
+            "_s": _translation(x * 256.0, y * 256.0),
+        }
+    if kind == 'earth':
+        return {
+            "_uMeshToWorldMatrix": _translation(x, y),
+            "_uModelviewMatrix": _translation(0.0, 0.0, -10.0),
+        }
+    return {
+        "_uMV": _translation(x, y),
+        "_uParams": _matrix([[1, 0, 1.0 / 256.0, 0], [0, 1, 1.0 / 256.0, 0], [0, 0, 0, 0], [0, 0, 1, 1]]),
+        "_uParamsSE": _matrix([[0, 1, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [1, 0, 1, 1]]),
+    }
+
+def writeCapture(filename, kind='maps', draws=1000, vertices=100, textures=16):
+    """Write a synthetic capture file
+    @param vertices: average number of vertices per draw call"""
+    if kind not in CAPTURE_KINDS:
+        raise ValueError(f"Unknown capture kind: {kind}")
+    with open(filename, 'w') as f:
+        json.dump({ "kind": kind, "draws": draws, "vertices": vertices, "textures": textures }, f)
+
+class _Action():
+    def __init__(self, eventId, name, flags=0, numIndices=0, indexOffset=0, baseVertex=0):
+        self.eventId = eventId
+        self.actionId = eventId
+        self._name = name
+        self.flags = flags
+        self.numIndices = numIndices
+        self.indexOffset = indexOffset
+        self.baseVertex = baseVertex
+        self.children = []
+
+    def GetName(self, structured_file):
+        return "ID3D11DeviceContext::" + self._name
+
+class _Draw():
+    """Geometry of a draw call, in vertex and index buffers of its own"""
+    def __init__(self, capture, index):
+        self.index = index
+        # Sizes vary between half and one and a half the average
+        self.vertex_count = max(3, int(capture.vertices * (0.5 + (index * 7919 % 1000) / 1000)))
+        self.index_count = 3 * self.vertex_count
+        side = int(np.ceil(np.sqrt(capture.draws)))
+        self.uniforms = _uniforms(capture.kind, (index % side, index // side))
+        self.vertex_buffer = ResourceId(100000 + 2 * index)
+        self.index_buffer = ResourceId(100001 + 2 * index)
+        self.texture = ResourceId(5000 + index % capture.textures)
+
+class _Capture():
+    def __init__(self, spec):
+        self.kind = spec["kind"]
+        self.draws = spec["draws"]
+        self.vertices = spec["vertices"]
+        self.textures = spec["textures"]
+        self.attributes, self.stride = VERTEX_LAYOUTS[self.kind]
+        self.index_stride = 2 if self.vertices * 3 // 2 < 65536 else 4
+
+        # All draw calls share the same vertex and index data, that is
+        # generated once, only their size and uniforms differ.
+        max_vertices = max(3, int(self.vertices * 1.5))
+        rng = np.random.default_rng(0)
+        self.vertex_data = rng.integers(0, 256, max_vertices * self.stride, dtype=np.uint8)
+        self.index_pattern = rng.integers(0, np.iinfo(np.int64).max, 3 * max_vertices)
+
+        event_id = 1
+        first, last = {
+            'maps': ("ClearRenderTargetView(0.000000, 0.000000, 0.000000, 1.000000)", "Draw()"),
+            'earth': ("ClearRenderTargetView(0.000000, 0.000000, 0.000000, 1.000000)", "Present()"),
+            'mapy': ("ClearRenderTargetView(0.000000, 0.000000, 0.000000, 1.000000)", "ClearDepthStencilView()"),
+        }[self.kind]
+        self.actions = [_Action(event_id, first, flags=ActionFlags.Clear)]
+        self.draw_events = {}
+        for index in range(self.draws):
+            event_id += 1
+            draw = _Draw(self, index)
+            self.draw_events[event_id] = draw
+            self.actions.append(_Action(
+                event_id,
+                "DrawIndexed({})".format(draw.index_count),
+                flags=ActionFlags.Drawcall | ActionFlags.Indexed,
+                numIndices=draw.index_count
+            ))
+        self.actions.append(_Action(event_id + 1, last))
+
+    def bufferData(self, rid):
+        draw = self.draw_events[2 + (rid.value - 100000) // 2]
+        if rid == draw.vertex_buffer:
+            return self.vertex_data[:draw.vertex_count * self.stride]
+        indices = self.index_pattern[:draw.index_count] % draw.vertex_count
+        return indices.astype(f"<u{self.index_stride}")
+
+class _PipelineState():
+    def __init__(self, capture, event_id):
+        self.capture = capture
+        self.draw = capture.draw_events.get(event_id)
+
+    def GetShader(self, stage):
+        return ResourceId(1000 if self.draw is not None else 1001)
+
+    def GetShaderEntryPoint(self, stage):
+        return "main"
+
+    def GetShaderReflection(self, stage):
+        names = self.draw.uniforms.keys() if self.draw is not None else ["_uViewport"]
+        globals_block = _Struct(name="$Globals", bindPoint=0, variables=[_Struct(name=name) for name in names])
+        return _Struct(resourceId=self.GetShader(stage), constantBlocks=[globals_block])
+
+    def GetConstantBuffer(self, stage, block, index):
+        return _Struct(resourceId=ResourceId(3000), byteOffset=0, byteSize=256)
+
+    def GetGraphicsPipelineObject(self):
+        return ResourceId(4000)
+
+    def GetPrimitiveTopology(self):
+        return Topology.TriangleStrip if self.capture.kind == 'maps' else Topology.TriangleList
+
+    def GetIBuffer(self):
+        rid = self.draw.index_buffer if self.draw is not None else ResourceId.Null()
+        return _Struct(resourceId=rid, byteOffset=0, byteStride=self.capture.index_stride)
+
+    def GetVBuffers(self):
+        rid = self.draw.vertex_buffer if self.draw is not None else ResourceId.Null()
+        return [_Struct(resourceId=rid, byteOffset=0, byteStride=self.capture.stride)]
+
+    def GetVertexInputs(self):
+        return [
+            _Struct(name=name, format=fmt, byteOffset=offset, vertexBuffer=0, perInstance=False)
+            for name, fmt, offset in self.capture.attributes
+        ]
+
+    def GetBindpointMapping(self, stage):
+        return _Struct(samplers=[_Struct(bind=0)])
+
+    def GetReadOnlyResources(self, stage):
+        return [_Struct(resources=[_Struct(resourceId=self.draw.texture)])]
+
+class ReplayController():
+    def __init__(self, capture):
+        self.capture = capture
+        self.state = _PipelineState(capture, 0)
+
+    def GetRootActions(self):
+        return self.capture.actions
+
+    def GetStructuredFile(self):
+        return None
+
+    def SetFrameEvent(self, eventId, force):
+        self.state = _PipelineState(self.capture, eventId)
+
+    def GetPipelineState(self):
+        return self.state
+
+    def GetBufferData(self, rid, offset, length):
+        data = self.capture.bufferData(rid).view(np.uint8)
+        end = len(data) if length == 0 else offset + length
+        return data[offset:end].tobytes()
+
+    def GetCBufferVariableContents(self, pipeline, shader, stage, entry, bind, buffer, offset, size):
+        draw = self.state.draw
+        if draw is None:
+            return [ShaderVariable("_uViewport", [0.0, 0.0, 1920.0, 1080.0])]
+        return [
+            ShaderVariable(name, values, 4 if len(values) == 16 else 1, 4)
+            for name, values in draw.uniforms.items()
+        ]
+
+    def GetTextures(self):
+        mips = TEXTURE_SIZE.bit_length()
+        return [
+            _Struct(
+                resourceId=ResourceId(5000 + i),
+                width=TEXTURE_SIZE,
+                height=TEXTURE_SIZE,
+                mips=mips,
+                arraysize=1,
+                format=ResourceFormat(CompType.UNorm, 4, 1),
+            )
+            for i in range(self.capture.textures)
+        ]
+
+    def GetTextureData(self, rid, subresource):
+        size = max(1, TEXTURE_SIZE >> subresource.mip)
+        return bytes(size * size * 4)
+
+    def SaveTexture(self, texsave, filename):
+        """Not an actual PNG file, images are not decoded by the bpy stand-in"""
+        size = max(1, TEXTURE_SIZE >> texsave.mip)
+        with open(filename, 'wb') as f:
+            f.write(b"\x89PNG\r\n\x1a\n" + bytes(size * size // 4))
+        return True
+
+    def Shutdown(self):
+        pass
+
+class CaptureFile():
+    def __init__(self):
+        self.spec = None
+
+    def OpenFile(self, filename, filetype, progress):
+        try:
+            with open(filename) as f:
+                self.spec = json.load(f)
+        except (OSError, ValueError) as err:
+            return _Status(f"Not a synthetic capture: {err}", code=1)
+        return _Status()
+
+    def LocalReplaySupport(self):
+        return True
+
+    def OpenCapture(self, options, progress):
+        return _Status(), ReplayController(_Capture(self.spec))
+
+    def Shutdown(self):
+        pass
+
+def OpenCaptureFile():
+    return CaptureFile()
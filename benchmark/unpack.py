@@ -0,0 +1,106 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+"""Microbenchmark of meshdata.unpackDataNumpy on vertex formats found in
+Google Maps and Google Earth captures, compared to the former implementation
+that padded and copied the buffer. The renderdoc module must be importable,
+like for google_maps_rd.py:
+    python benchmark/unpack.py [vertex count]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "blender", "MapsModelsImporter"))
+import renderdoc as rd
+from meshdata import unpackDataNumpy
+
+class Format():
+    """Stand-in for rd.ResourceFormat, with only what unpackDataNumpy reads"""
+    def __init__(self, compType, compCount, compByteWidth, bgra=False):
+        self.compType = compType
+        self.compCount = compCount
+        self.compByteWidth = compByteWidth
+        self.bgra = bgra
+
+    def BGRAOrder(self):
+        return self.bgra
+
+# name, format, stride, attribute offset in the vertex
+VERTEX_FORMATS = [
+    ("Maps position (4 x u8, stride 8)", Format(rd.CompType.UInt, 4, 1), 8, 0),
+    ("Maps uv (2 x unorm16, stride 8)", Format(rd.CompType.UNorm, 2, 2), 8, 4),
+    ("Earth position (3 x f32, stride 12)", Format(rd.CompType.Float, 3, 4), 12, 0),
+    ("Earth uv (2 x unorm16, stride 16)", Format(rd.CompType.UNorm, 2, 2), 16, 12),
+    ("Earth normal (4 x snorm8, stride 20)", Format(rd.CompType.SNorm, 4, 1), 20, 16),
+    ("Color (4 x unorm8 BGRA, stride 16)", Format(rd.CompType.UNorm, 4, 1, bgra=True), 16, 12),
+]
+
+def unpackDataNumpyLegacy(fmt, data, stride=None, count=-1, offset=0):
+    """unpackDataNumpy as it was before decoding through strided views"""
+    compType = {
+        rd.CompType.UInt: 'u', rd.CompType.SInt: 'i', rd.CompType.Float: 'f',
+        rd.CompType.UNorm: 'u', rd.CompType.UScaled: 'u', rd.CompType.SNorm: 'i', rd.CompType.SScaled: 'i',
+    }[fmt.compType]
+    data_field = ('data', f"{fmt.compCount}{compType}{fmt.compByteWidth}")
+    dtype = np.dtype([data_field])
+    missing = stride - dtype.itemsize
+    if missing > 0:
+        dtype = np.dtype([data_field, ('align', f"{missing}u1")])
+        missing = offset + count * dtype.itemsize - len(data)
+        if missing > 0:
+            data = data + b'\x00' * missing
+    decoded = np.frombuffer(data, dtype, count=count, offset=offset)['data']
+    if fmt.compType == rd.CompType.UNorm:
+        decoded = decoded.astype('f') / float((1 << (fmt.compByteWidth * 8)) - 1)
+    elif fmt.compType == rd.CompType.SNorm:
+        maxNeg = -(1 << (fmt.compByteWidth * 8 - 1))
+        mask = decoded != maxNeg
+        decoded = decoded.astype('f')
+        decoded[mask] /= float(-(maxNeg-1))
+    if fmt.BGRAOrder():
+        decoded = decoded[:,[2, 1, 0, 3]]
+    return decoded
+
+def bestOf(func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main(vertex_count):
+    print(f"Decoding {vertex_count} vertices, best of 5:")
+    for name, fmt, stride, offset in VERTEX_FORMATS:
+        data = np.random.default_rng(0).integers(0, 256, vertex_count * stride, dtype=np.uint8).tobytes()
+        if fmt.compType == rd.CompType.Float:
+            data = np.random.default_rng(0).uniform(-1, 1, vertex_count * stride // 4).astype(np.float32).tobytes()
+        legacy = bestOf(lambda: unpackDataNumpyLegacy(fmt, data, stride=stride, count=vertex_count, offset=offset))
+        strided = bestOf(lambda: unpackDataNumpy(fmt, data, stride=stride, count=vertex_count, offset=offset))
+        print(f" - {name:<40} legacy {legacy*1000.:8.3f}ms, strided {strided*1000.:8.3f}ms (x{legacy/strided:.1f})")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
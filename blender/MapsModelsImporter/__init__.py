@@ -37,6 +37,7 @@ from . import preferences
 from . import properties
 from . import operators
 from . import panels
+from . import daemon
 
 def register():
     preferences.register()
@@ -49,6 +50,7 @@ def unregister():
     operators.unregister()
     properties.unregister()
     preferences.unregister()
+    daemon.shutdown()
 
 if __name__ == "__main__":
     register()
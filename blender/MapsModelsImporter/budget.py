@@ -0,0 +1,182 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+# no bpy nor renderdoc here, this is used on both sides of the extraction
+
+"""Budgets limit an import by its total number of triangles, of vertices and
+of texture bytes, rather than by its number of draw calls, whose size varies
+by orders of magnitude. Draw calls are prioritized by decreasing index count,
+which is known without replaying them, so that the most detailed geometry is
+kept, and those that would exceed a budget are left out. A texture shared by
+several draw calls counts once, for the size of its texels once decoded.
+
+Draw calls are tried in this order until the budget is exhausted, i.e. until
+even the smallest remaining one cannot fit. The size of a triangle strip is
+then estimated as if it had no degenerate triangle, so a strip that only fits
+thanks to its degenerate triangles may be left out. The extraction process
+stops replaying the capture once the budget is exhausted. With several
+workers, it first reads the indices and texture of the draw calls in this
+order to keep the ones that fit, then workers extract their shard of the kept
+draw calls without a budget of their own. The importer selects among the
+extracted draw calls the same way, from their sizes listed in the manifest.
+"""
+
+import numpy as np
+
+BUDGET_LIMITS = ("max_triangles", "max_vertices", "max_texture_bytes")
+
+# -----------------------------------------------------------------------------
+
+def triangleCount(topology, indices):
+    """Number of triangles the importer makes of an index buffer, i.e. the
+    length of what decodeTriangles returns
+    @param topology: 'TRIANGLES' or 'TRIANGLE_STRIP', see makeDrawcallEntry"""
+    if topology == 'TRIANGLE_STRIP':
+        # The last triangle of the strip is left out, and degenerate ones too
+        count = len(indices) - 3
+        if count <= 0:
+            return 0
+        indices = np.asarray(indices)
+        a, b, c = indices[:count], indices[1:count + 1], indices[2:count + 2]
+        return int(np.count_nonzero((a != b) & (a != c) & (b != c)))
+    return len(indices) // 3
+
+def estimatedTriangleCount(topology, index_count):
+    """Number of triangles of a draw call known from its number of indices
+    only, exact for triangle lists, assuming no degenerate triangle for strips"""
+    if topology == 'TRIANGLE_STRIP':
+        return max(0, index_count - 3)
+    return index_count // 3
+
+def rankDrawcalls(drawcalls, index_count):
+    """@param index_count: function giving the number of indices of an item of drawcalls
+    @return the draw calls by decreasing index count, in their original order
+    when they have the same one"""
+    return sorted(drawcalls, key=index_count, reverse=True)
+
+# -----------------------------------------------------------------------------
+
+class ImportBudget():
+    def __init__(self, max_triangles=0, max_vertices=0, max_texture_bytes=0):
+        """Limits are disabled when 0"""
+        self.max_triangles = max_triangles
+        self.max_vertices = max_vertices
+        self.max_texture_bytes = max_texture_bytes
+        self.triangles = 0
+        self.vertices = 0
+        self.texture_bytes = 0
+        self.textures = set() # textures counted so far
+
+    @staticmethod
+    def fromDict(limits):
+        """@param limits: dict of limits, as returned by limits(), or None for no limit"""
+        return ImportBudget(**(limits or {}))
+
+    def limits(self):
+        return { name: getattr(self, name) for name in BUDGET_LIMITS }
+
+    def isLimited(self):
+        return any(limit > 0 for limit in self.limits().values())
+
+    def copy(self):
+        """@return an unused budget with the same limits"""
+        return ImportBudget.fromDict(self.limits())
+
+    def fits(self, triangles, vertices, texture=None, texture_bytes=0):
+        """@param texture: identifies the texture of the draw call, None if it has none
+        @return whether a draw call can be counted without exceeding a budget"""
+        if texture is None or texture in self.textures:
+            texture_bytes = 0
+        return not (
+            (self.max_triangles > 0 and self.triangles + triangles > self.max_triangles) or
+            (self.max_vertices > 0 and self.vertices + vertices > self.max_vertices) or
+            (self.max_texture_bytes > 0 and self.texture_bytes + texture_bytes > self.max_texture_bytes)
+        )
+
+    def add(self, triangles, vertices, texture=None, texture_bytes=0):
+        """Count a draw call, see fits()"""
+        if texture is None or texture in self.textures:
+            texture_bytes = 0
+        self.triangles += triangles
+        self.vertices += vertices
+        self.texture_bytes += texture_bytes
+        if texture is not None:
+            self.textures.add(texture)
+
+    def tryAdd(self, triangles, vertices, texture=None, texture_bytes=0):
+        """Count a draw call, unless it would exceed a budget
+        @return whether the draw call fits"""
+        if not self.fits(triangles, vertices, texture, texture_bytes):
+            return False
+        self.add(triangles, vertices, texture, texture_bytes)
+        return True
+
+    def isExhausted(self, topology, index_count):
+        """@param index_count: number of indices of the smallest remaining draw call
+        @return whether no remaining draw call can fit anymore, see estimatedTriangleCount"""
+        return (
+            (self.max_triangles > 0 and self.triangles + estimatedTriangleCount(topology, index_count) > self.max_triangles) or
+            (self.max_vertices > 0 and index_count > 0 and self.vertices >= self.max_vertices)
+        )
+
+    def args(self):
+        """@return the command line options of the extraction script setting this budget"""
+        args = []
+        for name, limit in self.limits().items():
+            if limit > 0:
+                args += ["--" + name.replace('_', '-'), str(limit)]
+        return args
+
+    def summary(self):
+        """returns something like X triangles (max X), X vertices, X texture bytes"""
+        return ", ".join(
+            f"{used} {name}" + (f" (max {limit})" if limit > 0 else "")
+            for name, used, limit in (
+                ("triangles", self.triangles, self.max_triangles),
+                ("vertices", self.vertices, self.max_vertices),
+                ("texture bytes", self.texture_bytes, self.max_texture_bytes),
+            )
+        )
+
+# -----------------------------------------------------------------------------
+
+def selectEntries(entries, budget):
+    """Select the largest draw calls of a manifest that fit in the budget, the
+    same way as the extraction process does
+    @return the selected entries, in their original order"""
+    if budget is None or not budget.isLimited():
+        return list(entries)
+    budget = budget.copy()
+    ranked = rankDrawcalls(entries, lambda entry: entry["index_count"])
+    selected = set()
+    for entry in ranked:
+        if budget.isExhausted(ranked[-1]["topology"], ranked[-1]["index_count"]):
+            break
+        if budget.tryAdd(
+            entry["triangle_count"],
+            entry["vertex_count"],
+            entry["texture"],
+            entry.get("texture_bytes", 0)
+        ):
+            selected.add(id(entry))
+    return [entry for entry in entries if id(entry) in selected]
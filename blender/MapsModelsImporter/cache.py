@@ -0,0 +1,199 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+# no bpy here
+
+"""Persistent cache of extracted captures. Each entry is a directory named
+after a hash of the capture file content, of the extractor source code and of
+the extraction settings, so that re-importing the same capture skips the
+RenderDoc replay. Entries are evicted in least recently used order once the
+cache grows beyond its maximum size."""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+from .manifest import manifestFilename, readManifest
+from .budget import ImportBudget
+
+CACHE_DIRNAME = "MapsModelsImporter-cache"
+ENTRY_FILENAME = "cache-entry.json"
+ADDON_DIR = os.path.dirname(os.path.realpath(__file__))
+# Any change to these files may change the extraction output
+EXTRACTOR_SOURCES = (
+    "google_maps_rd.py",
+    "google_maps_rd_experimental.py",
+    "meshdata.py",
+    "rdutils.py",
+    "packfile.py",
+    "manifest.py",
+    "protocol.py",
+    "sharedmem.py",
+    "budget.py",
+)
+
+_capture_hashes = {} # (path, size, mtime) -> hash, not to hash twice the same file in a session
+_extractor_version = None
+
+# -----------------------------------------------------------------------------
+
+def hashFile(filepath, chunk_size=1 << 20):
+    stat = os.stat(filepath)
+    memo_key = (os.path.realpath(filepath), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _capture_hashes:
+        h = hashlib.sha256()
+        with open(filepath, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                h.update(chunk)
+        _capture_hashes[memo_key] = h.hexdigest()
+    return _capture_hashes[memo_key]
+
+def extractorVersion():
+    """Hash of the source code of the extraction script"""
+    global _extractor_version
+    if _extractor_version is None:
+        h = hashlib.sha256()
+        for filename in EXTRACTOR_SOURCES:
+            with open(os.path.join(ADDON_DIR, filename), 'rb') as file:
+                h.update(file.read())
+        _extractor_version = h.hexdigest()
+    return _extractor_version
+
+def directorySize(path):
+    return sum(
+        os.path.getsize(os.path.join(root, filename))
+        for root, _, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+# -----------------------------------------------------------------------------
+
+class ExtractionCache():
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+
+    def makeKey(self, filepath, use_experimental, settings=None):
+        """@param settings: dict of any extra option that changes the extraction output"""
+        h = hashlib.sha256()
+        h.update(hashFile(filepath).encode('ascii'))
+        h.update(extractorVersion().encode('ascii'))
+        h.update(b"experimental" if use_experimental else b"standard")
+        h.update(json.dumps(settings or {}, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()[:32]
+
+    def entryDir(self, key):
+        return os.path.join(self.root, key)
+
+    def lookup(self, key, max_blocks, budget=None):
+        """@return the extraction prefix if the entry exists and covers max_blocks
+        and the budget (an ImportBudget, see budget.py), None otherwise. An
+        entry extracted with a budget only covers the exact same limits."""
+        entry_filename = os.path.join(self.entryDir(key), ENTRY_FILENAME)
+        if not os.path.isfile(entry_filename):
+            return None
+        with open(entry_filename, 'r') as file:
+            entry = json.load(file)
+        prefix = os.path.join(self.entryDir(key), entry["prefix"])
+        manifest_filename = manifestFilename(prefix)
+        if not os.path.isfile(manifest_filename):
+            return None
+        manifest = readManifest(manifest_filename)
+        cached_max_blocks = manifest["max_blocks"]
+        cached_budget = ImportBudget.fromDict(manifest.get("budget"))
+        if cached_budget.isLimited():
+            # Draw calls are selected greedily, so a smaller budget or
+            # max_blocks does not select a subset of what was extracted
+            requested_budget = budget if budget is not None else ImportBudget()
+            if cached_budget.limits() != requested_budget.limits() or max(cached_max_blocks, 0) != max(max_blocks, 0):
+                return None
+        elif cached_max_blocks > 0 and (max_blocks <= 0 or max_blocks > cached_max_blocks):
+            return None # the cached extraction was truncated more than requested
+        os.utime(entry_filename) # mark as recently used
+        return prefix
+
+    def prepare(self, key, filepath):
+        """Create an empty entry for a new extraction
+        @return the extraction prefix"""
+        self.discard(key)
+        os.makedirs(self.entryDir(key))
+        return os.path.join(self.entryDir(key), os.path.splitext(os.path.basename(filepath))[0] + "-")
+
+    def commit(self, key, prefix):
+        """Mark the entry as complete once the extraction succeeded, and make
+        room for it by evicting older entries"""
+        entry = {
+            "prefix": os.path.basename(prefix),
+            "size": directorySize(self.entryDir(key)),
+        }
+        with open(os.path.join(self.entryDir(key), ENTRY_FILENAME), 'w') as file:
+            json.dump(entry, file)
+        self.evict(keep=key)
+
+    def discard(self, key):
+        shutil.rmtree(self.entryDir(key), ignore_errors=True)
+
+    def entries(self):
+        """@return (last use time, size, key) of complete entries, and keys of incomplete ones"""
+        complete, incomplete = [], []
+        if not os.path.isdir(self.root):
+            return complete, incomplete
+        for key in os.listdir(self.root):
+            entry_filename = os.path.join(self.entryDir(key), ENTRY_FILENAME)
+            if os.path.isfile(entry_filename):
+                with open(entry_filename, 'r') as file:
+                    size = json.load(file)["size"]
+                complete.append((os.path.getmtime(entry_filename), size, key))
+            else:
+                incomplete.append(key)
+        return complete, incomplete
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in max_size"""
+        complete, incomplete = self.entries()
+        for key in incomplete:
+            if key != keep:
+                self.discard(key) # left over by an interrupted extraction
+        total_size = sum(size for _, size, _ in complete)
+        for _, size, key in sorted(complete):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            self.discard(key)
+            total_size -= size
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def size(self):
+        complete, _ = self.entries()
+        return sum(size for _, size, _ in complete)
+
+# -----------------------------------------------------------------------------
+
+def getCache(pref):
+    parent = pref.tmp_dir if pref.tmp_dir else tempfile.gettempdir()
+    return ExtractionCache(os.path.join(parent, CACHE_DIRNAME), pref.cache_size * 1024 * 1024)
@@ -0,0 +1,227 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+# no bpy here
+
+"""Blender side of the extraction daemon (see google_maps_rd_daemon.py), a
+long lived extraction process started once per session and reused across
+imports. Jobs run one at a time, DaemonJob gives them the interface of the
+Popen object of a dedicated extraction process."""
+
+import json
+import queue
+import threading
+import subprocess
+from collections import deque
+
+from .profiling import Timer, profiling_counters
+from .protocol import parseEvent
+
+SHUTDOWN_TIMEOUT = 5.0
+
+# -----------------------------------------------------------------------------
+
+class ExtractionDaemon():
+    def __init__(self, args):
+        """@param args: command line of the daemon script"""
+        self.args = args
+        self.lock = threading.Lock() # held while a job runs
+        self.closed = False
+        self.start_count = 0
+        self.job_count = 0
+        self.startup_time = None # of the last start, once ready
+        self.saved_time = 0.0
+        self.log = deque(maxlen=100) # of the daemon itself, out of jobs
+        self.start()
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        self.start_count += 1
+        self.ready = False
+        self.timer = Timer()
+        threading.Thread(target=self.readLog, args=(self.process,), daemon=True).start()
+
+    def readLog(self, process):
+        for line in process.stderr:
+            self.log.append(line)
+
+    def setReady(self):
+        self.ready = True
+        self.startup_time = self.timer.ellapsed()
+        profiling_counters["daemonStartup"].add_sample(self.startup_time)
+
+    def submit(self, args, use_stdin=False):
+        """Start a job, running the extraction script with the given arguments
+        @param use_stdin: give the job a standard input, see DaemonJob
+        @return the DaemonJob, or None if the daemon is busy with another job"""
+        if self.closed or not self.lock.acquire(blocking=False):
+            return None
+        try:
+            if self.process.poll() is not None:
+                self.start()
+            if self.ready:
+                # A new extraction process would have had to load renderdoc
+                self.saved_time += self.startup_time
+            job = DaemonJob(self, use_stdin)
+            self.process.stdin.write(json.dumps({ "args": args }) + "\n")
+            self.process.stdin.flush()
+        except OSError:
+            self.lock.release()
+            return None
+        self.job_count += 1
+        job.start()
+        return job
+
+    def jobEnded(self, job):
+        """Called by the job once the daemon is done with it, or died"""
+        if job.died and self.ready and not job.killed and not self.closed:
+            # Crashed while running the job, keep a warm daemon for the next one
+            self.start()
+        self.lock.release()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=SHUTDOWN_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+    def summary(self):
+        startup = f"{self.startup_time:.03f}s" if self.startup_time is not None else "not ready yet"
+        return (
+            f"{self.job_count} jobs, started {self.start_count} times (start up {startup}), " +
+            f"saved {self.saved_time:.03f}s of start up"
+        )
+
+# -----------------------------------------------------------------------------
+
+class DaemonJobInput():
+    """Standard input of a job, that is the one of the daemon, which is not
+    closed with the job (see sharedmem.RELEASE_LINE)"""
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        self.file.write(data)
+        self.file.flush()
+
+    def close(self):
+        pass
+
+class DaemonJob():
+    """Popen-like handle of a job: stdout yields what the job prints on the
+    standard output of the daemon, e.g. events in streaming mode, and stderr
+    yields its log once it is done. Killing a job kills the daemon, which is
+    started again for the next job."""
+    def __init__(self, daemon, use_stdin):
+        self.daemon = daemon
+        self.process = daemon.process
+        self.stdin = DaemonJobInput(self.process.stdin) if use_stdin else None
+        self.lines = queue.Queue() # None marks the end of the job
+        self.stdout = self.iterLines()
+        self.stderr = self.iterLog()
+        self.output = ""
+        self.returncode = None
+        self.died = False
+        self.killed = False
+        self.ended = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.readOutput, daemon=True).start()
+
+    def iterLines(self):
+        while True:
+            line = self.lines.get()
+            if line is None:
+                return
+            yield line
+
+    def iterLog(self):
+        self.ended.wait()
+        yield from self.output.splitlines(keepends=True)
+
+    def readOutput(self):
+        try:
+            for line in self.process.stdout:
+                event = parseEvent(line)
+                if event is None:
+                    self.lines.put(line)
+                elif event["type"] == "ready":
+                    self.daemon.setReady()
+                elif event["type"] == "job_done":
+                    self.returncode = event["returncode"]
+                    self.output = event["output"]
+                    return
+                else:
+                    self.lines.put(line)
+            # The daemon died, with the return code of its script if it did
+            # not even get to run the job
+            self.died = True
+            self.returncode = self.process.wait()
+            self.output = "".join(self.daemon.log)
+        finally:
+            self.lines.put(None)
+            self.ended.set()
+            self.daemon.jobEnded(self)
+
+    def poll(self):
+        return self.returncode if self.ended.is_set() else None
+
+    def wait(self):
+        self.ended.wait()
+        return self.returncode
+
+    def kill(self):
+        self.killed = True
+        self.process.kill()
+
+# -----------------------------------------------------------------------------
+
+_daemon = None
+
+def getDaemon(args):
+    """@return the extraction daemon running the given command line, started
+    the first time it is needed in the session"""
+    global _daemon
+    if _daemon is not None and _daemon.args != args:
+        shutdown()
+    if _daemon is None:
+        _daemon = ExtractionDaemon(args)
+    return _daemon
+
+def getDaemonSummary():
+    return _daemon.summary() if _daemon is not None else None
+
+def shutdown():
+    global _daemon
+    if _daemon is not None:
+        _daemon.close()
+        _daemon = None
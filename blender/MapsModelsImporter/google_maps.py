@@ -23,15 +23,28 @@
 
 import sys
 import os
+import json
+import queue
+import threading
 import subprocess
+from abc import ABC, abstractmethod
+from collections import deque, defaultdict
 import numpy as np
 
-from .profiling import Timer, profiling_counters
+from .profiling import Timer, ProfilingCounterProperty, MemoryCounterProperty, profiling_counters, memory_counters, formatBytes, profiler, span, profile, writeTrace, readTrace, profileFilename, readCounters
 from .utils import getBinaryDir, makeTmpDir
+from .cache import getCache
 from .preferences import getPreferences
+from .packfile import PackReader, PackStreamReader, readRawTexture, RAW_TEXTURE_EXTENSION
+from .manifest import manifestFilename, readManifest
+from .protocol import parseEvent
+from .sharedmem import SharedPackReader, RELEASE_LINE
+from .daemon import getDaemon, getDaemonSummary
+from .budget import selectEntries
 
 SCRIPT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "google_maps_rd.py")
 SCRIPT_PATH_EXP = os.path.join(os.path.dirname(os.path.realpath(__file__)), "google_maps_rd_experimental.py")
+SCRIPT_PATH_DAEMON = os.path.join(os.path.dirname(os.path.realpath(__file__)), "google_maps_rd_daemon.py")
 
 MSG_CONSOLE_DEBUG_OUTPUT = """\nPlease report to MapsModelsImporter developers providing the full console log with debug information.
 First turn on debug output by activating the "Debug Info"-checkbox under Edit > Preferences > Add-ons > MapsModelsImporter
@@ -62,9 +75,12 @@ MSG_UNKNOWN_ERROR = "Error: An unknown Error occurred!" + MSG_CONSOLE_DEBUG_OUTP
 class MapsModelsImportError(Exception):
     pass
 
-def captureToFiles(context, filepath, prefix, max_blocks, use_experimental):
-    """Extract binary files and textures from a RenderDoc capture file.
-    This spawns a standalone Python interpreter because renderdoc module cannot be loaded in embedded Python"""
+def extractorCommand(context, filepath, prefix, max_blocks, use_experimental, texture_format='PNG', texture_mip=0, texture_max_size=0, budget=None):
+    """Command line of the extraction script, run by a standalone Python interpreter because renderdoc module cannot be loaded in embedded Python
+    @param texture_format: 'PNG', 'RAW' or 'RAW_ZLIB', see IMP_OP_GoogleMapsCapture
+    @param texture_mip, texture_max_size: mip level to extract, or maximum edge size of the extracted mip (0 for no limit)
+    @param budget: ImportBudget limiting the extraction, see budget.py
+    @return the arguments of the command and the Python home directory"""
     pref = getPreferences(context)
     if bpy.app.version < (2,91,0):
         blender_dir = os.path.dirname(sys.executable)
@@ -80,35 +96,75 @@ def captureToFiles(context, filepath, prefix, max_blocks, use_experimental):
     os.environ["PYTHONIOENCODING"] = "utf-8"
     os.environ["PATH"] += os.pathsep + os.path.join(python_home, "bin")
     script_path = SCRIPT_PATH_EXP if use_experimental else SCRIPT_PATH
-    try:
-        out = subprocess.check_output([python, script_path, filepath, prefix, str(max_blocks)], stderr=subprocess.STDOUT, text=True)
-        if pref.debug_info:
-            print("google_maps_rd returned:")
-            print(out)
-    except subprocess.CalledProcessError as err:
+    args = [
+        python, script_path, filepath, prefix, str(max_blocks),
+        "--workers", str(pref.extraction_workers),
+        "--texture-format", texture_format.lower().replace('_', '-'),
+        "--texture-mip", str(texture_mip),
+        "--texture-max-size", str(texture_max_size),
+    ]
+    if pref.trace_file:
+        args += ["--trace", traceFilename(prefix)]
+    if pref.memory_profiling:
+        args += ["--memory-profile"]
+    if budget is not None:
+        args += budget.args()
+    return args, python_home
+
+def extractionError(context, returncode, output, args, python_home):
+    """@return the error to raise when the extraction script failed"""
+    pref = getPreferences(context)
+    if pref.debug_info:
+        print("\n==========================================================================================")
+        print("google_maps_rd failed and returned:")
+        print(output)
+        print(f"\nExtra info:\n - python = {args[0]}\n - python_home = {python_home}")
+    if returncode == 20: #error codes 20 and 21 are defined in google_maps_rd.py
+        ERROR_MESSAGE = MSG_RDMODULE_NOT_FOUND
+    elif returncode == 21:
+        ERROR_MESSAGE = MSG_RDMODULE_IMPORT_ERROR
+    elif returncode == 1:
+        ERROR_MESSAGE = MSG_INCORRECT_RDC
         if pref.debug_info:
-            print("\n==========================================================================================")
-            print("google_maps_rd failed and returned:")
-            print(err.output)
-            print(f"\nExtra info:\n - python = {python}\n - python_home = {python_home}")
-        if err.returncode == 20: #error codes 20 and 21 are defined in google_maps_rd.py
-            ERROR_MESSAGE = MSG_RDMODULE_NOT_FOUND
-        elif err.returncode == 21:
-            ERROR_MESSAGE = MSG_RDMODULE_IMPORT_ERROR
-        elif err.returncode == 1:
-            ERROR_MESSAGE = MSG_INCORRECT_RDC
-            if pref.debug_info:
-                print(MSG_INCORRECT_RDC)
-        else:
-            ERROR_MESSAGE = MSG_UNKNOWN_ERROR + "\nReturncode: " + err.returncode
-        raise MapsModelsImportError(ERROR_MESSAGE)
+            print(MSG_INCORRECT_RDC)
+    else:
+        ERROR_MESSAGE = MSG_UNKNOWN_ERROR + "\nReturncode: " + str(returncode)
+    return MapsModelsImportError(ERROR_MESSAGE)
+
+def submitToDaemon(context, args, use_experimental, use_stdin=False):
+    """Run the command returned by extractorCommand as a job of the extraction
+    daemon, if enabled (the experimental script does not run in the daemon)
+    @return the DaemonJob, or None if the command must run in a new process"""
+    pref = getPreferences(context)
+    if not pref.use_daemon or use_experimental:
+        return None
+    job = getDaemon([args[0], SCRIPT_PATH_DAEMON]).submit(args[2:], use_stdin)
+    if job is None and pref.debug_info:
+        print("The extraction daemon is busy, starting a new extraction process")
+    return job
+
+@profile()
+def captureToFiles(context, filepath, prefix, max_blocks, use_experimental, texture_format='PNG', texture_mip=0, texture_max_size=0, budget=None):
+    """Extract binary files and textures from a RenderDoc capture file.
+    See extractorCommand for the texture options and the budget."""
+    pref = getPreferences(context)
+    args, python_home = extractorCommand(context, filepath, prefix, max_blocks, use_experimental, texture_format, texture_mip, texture_max_size, budget)
+    job = submitToDaemon(context, args, use_experimental)
+    if job is not None:
+        out = "".join(job.stdout) + "".join(job.stderr)
+        returncode = job.wait()
+    else:
+        process = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        out, returncode = process.stdout, process.returncode
+    if returncode != 0:
+        raise extractionError(context, returncode, out, args, python_home)
+    if pref.debug_info:
+        print("google_maps_rd returned:")
+        print(out)
 
 # -----------------------------------------------------------------------------
 
 import bpy
-import bmesh
-import pickle
-from bpy_extras import object_utils
 from math import floor, pi
 from mathutils import Matrix
 import os
@@ -189,29 +245,89 @@ def extractUniforms(constants, refMatrix):
 
     return uvOffsetScale, matrix, refMatrix
 
-def addMesh(context, name, verts, tris, uvs):
+def addMesh(collection, name, verts, tris, uvs, material_indices=None):
+    """Build a triangle mesh in bulk from NumPy arrays, without any per loop
+    Python work. verts is (N,3), tris is (M,3) and uvs is (N,2), indexed per vertex.
+    material_indices is an optional (M,) array giving the material slot of each triangle.
+    The object is only linked to the given collection, without any operator
+    call nor selection change, so that many objects can be created quickly."""
+    verts = np.ascontiguousarray(verts, dtype=np.float32).reshape(-1, 3)
+    tris = np.ascontiguousarray(tris, dtype=np.int32).reshape(-1, 3)
+    loops = tris.reshape(-1)
+
     mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(verts))
+    mesh.vertices.foreach_set("co", verts.reshape(-1))
+    mesh.loops.add(len(loops))
+    mesh.loops.foreach_set("vertex_index", loops)
+    mesh.polygons.add(len(tris))
+    mesh.polygons.foreach_set("loop_start", np.arange(0, len(loops), 3, dtype=np.int32))
 
-    mesh.from_pydata(verts, [], tris)
-    mesh.update()
+    uv_layer = mesh.uv_layers.new()
+    if uvs is not None and len(loops) > 0:
+        loop_uvs = np.ascontiguousarray(uvs, dtype=np.float32)[loops]
+        uv_layer.data.foreach_set("uv", loop_uvs.reshape(-1))
 
-    bm = bmesh.new()
-    bm.from_mesh(mesh)
-    uv_layer = bm.loops.layers.uv.verify()
-    for f in bm.faces:
-        for l in f.loops:
-            luv = l[uv_layer]
-            luv.uv = tuple(uvs[l.vert.index])
-    bm.to_mesh(mesh)
+    if material_indices is not None:
+        mesh.polygons.foreach_set("material_index", np.ascontiguousarray(material_indices, dtype=np.int32))
 
-    obj = object_utils.object_data_add(context, mesh, operator=None)
+    mesh.update(calc_edges=True)
+
+    obj = bpy.data.objects.new(name, mesh)
+    collection.objects.link(obj)
     return obj
 
-def addImageMaterial(name, obj, img):
-    bpy.ops.material.new()
+class MeshChunk():
+    """Geometry of several draw calls merged into a single object, in world
+    space, keeping the material of each draw call in its own slot"""
+    def __init__(self):
+        self.verts = []
+        self.tris = []
+        self.uvs = []
+        self.material_indices = []
+        self.materials = []
+        self.vertex_count = 0
+
+    def add(self, verts, tris, uvs, mat):
+        if mat not in self.materials:
+            self.materials.append(mat)
+        self.verts.append(verts)
+        self.tris.append(tris + self.vertex_count)
+        self.uvs.append(uvs)
+        self.material_indices.append(np.full(len(tris), self.materials.index(mat), dtype=np.int32))
+        self.vertex_count += len(verts)
+
+    def toBlender(self, collection, name):
+        obj = addMesh(
+            collection,
+            name,
+            np.concatenate(self.verts),
+            np.concatenate(self.tris),
+            np.concatenate(self.uvs),
+            np.concatenate(self.material_indices)
+        )
+        for mat in self.materials:
+            obj.data.materials.append(mat)
+        return obj
+
+def transformPoints(matrix, verts):
+    """Apply a 4x4 object matrix to an (N,3) array of points"""
+    m = np.array(matrix, dtype=np.float64)
+    return (verts @ m[:3,:3].T + m[:3,3]).astype(np.float32)
+
+def chunkKey(merge_mode, texture, world_verts, grid_size):
+    """Chunk in which a draw call is merged, either the one of its texture or
+    the grid cell containing the center of its vertices"""
+    if merge_mode == 'TEXTURE':
+        return texture
+    if len(world_verts) == 0:
+        return (0, 0)
+    center = world_verts.mean(axis=0)
+    return tuple(int(c) for c in np.floor(center[:2] / grid_size))
+
+def makeImageMaterial(name, img):
     mat = bpy.data.materials.new(name=name)
     mat.use_nodes = True
-    obj.data.materials.append(mat)
     nodes = mat.node_tree.nodes
     principled = nodes["Principled BSDF"]
     principled.inputs["Roughness"].default_value = 1.0
@@ -220,154 +336,708 @@ def addImageMaterial(name, obj, img):
         texture_node.image = img
         links = mat.node_tree.links
         link = links.new(texture_node.outputs[0], principled.inputs[0])
+    return mat
 
-def numpyLoad(file):
-    (dim,) = np.fromfile(file, dtype=np.int32, count=1)
-    shape = np.fromfile(file, dtype=np.int32, count=dim)
-    dt = np.dtype(file.read(2).decode('ascii'))
-    array = np.fromfile(file, dtype=dt)
-    array = array.reshape(shape)
-    return array
-
-def loadData(prefix, drawcall_id):
-    with open("{}{:05d}-indices.bin".format(prefix, drawcall_id), 'rb') as file:
-        #indices = pickle.load(file)
-        indices = numpyLoad(file)
-
-    with open("{}{:05d}-positions.bin".format(prefix, drawcall_id), 'rb') as file:
-        #positions = pickle.load(file)
-        positions = numpyLoad(file)
-
-    with open("{}{:05d}-uv.bin".format(prefix, drawcall_id), 'rb') as file:
-        #uvs = pickle.load(file)
-        uvs = numpyLoad(file)
-
-    texture_filename = "{}{:05d}-texture.png".format(prefix, drawcall_id)
-    if os.path.isfile(texture_filename):
-        img = bpy.data.images.load(texture_filename)
-    else:
-        img = None
+def loadData(pack, entry):
+    """Load a draw call listed in the extraction manifest"""
+    drawcall_id = entry["id"]
+    indices = pack.getArray(drawcall_id, "indices")
+    positions = pack.getArray(drawcall_id, "positions")
+    uvs = pack.getArray(drawcall_id, "uv")
+    constants = pack.getConstants(drawcall_id)
+    return indices, positions, uvs, constants
 
-    with open("{}{:05d}-constants.bin".format(prefix, drawcall_id), 'rb') as file:
-        constants = pickle.load(file)
+def loadRawImage(filepath):
+    """Create an image from the texels of a raw texture file, without any decoding.
+    The image is packed, which encodes it as PNG, so that it is kept in the blend file."""
+    texels = readRawTexture(filepath)
+    height, width, _ = texels.shape
+    img = bpy.data.images.new(os.path.basename(filepath), width, height, alpha=True)
+    # Blender images start with the bottom row
+    pixels = np.empty((height, width, 4), dtype=np.float32)
+    np.multiply(texels[::-1], 1.0 / 255.0, out=pixels, casting='unsafe')
+    img.pixels.foreach_set(pixels.ravel())
+    img.update()
+    img.pack()
+    return img
 
-    return indices, positions, uvs, img, constants
+def loadImageMaterial(directory, texture, materials, pack=False):
+    """Get the material of a texture of the manifest, shared by all draw calls
+    that use it. Textures are only loaded once.
+    @param materials: dict of the materials already created, by texture file name
+    @param pack: pack the image in the blend file rather than pointing to the
+    texture file, which may be removed (e.g. when evicted from the cache)"""
+    if texture not in materials:
+        with span("loadImage"):
+            if texture is None:
+                img = None
+            elif texture.endswith(RAW_TEXTURE_EXTENSION):
+                img = loadRawImage(os.path.join(directory, texture))
+            else:
+                img = bpy.data.images.load(os.path.join(directory, texture))
+                if pack:
+                    img.pack()
+        mat_name = "BuildingMat-{:05d}".format(len(materials))
+        materials[texture] = makeImageMaterial(mat_name, img)
+    return materials[texture]
 
 # -----------------------------------------------------------------------------
 
-def filesToBlender(context, prefix, max_blocks=200, use_experimental=False, globalScale=1.0/256.0):
-    """Import data from the files extracted by captureToFiles"""
-    # Get reference matrix
-    refMatrix = None
-    
-    if max_blocks <= 0:
-        # If no specific bound, max block is the number of .bin files in the directory
-        max_blocks = len([file for file in os.listdir(os.path.dirname(prefix)) if file.endswith(".bin")])
+def decodeTriangles(indices, topology):
+    """Make triangles from a triangle strip or triangle list index buffer
+    @return an (N,3) int32 array of vertex indices"""
+    indices = np.asarray(indices)
+    if topology == 'TRIANGLE_STRIP':
+        # NB: The last triangle of the strip has always been left out
+        count = len(indices) - 3
+        if count <= 0:
+            return np.zeros((0, 3), dtype=np.int32)
+        tris = np.lib.stride_tricks.sliding_window_view(indices, 3)[:count].astype(np.int32)
+        # Every other triangle of the strip has a flipped winding
+        tris[1::2, 1:] = tris[1::2, :0:-1].copy()
+        degenerate = (tris[:,0] == tris[:,1]) | (tris[:,0] == tris[:,2]) | (tris[:,1] == tris[:,2])
+        return tris[~degenerate]
+    else:
+        count = len(indices) // 3
+        return indices[:3 * count].astype(np.int32).reshape(count, 3)
 
-    drawcall_id = 0
-    while drawcall_id < max_blocks:
-        if not os.path.isfile("{}{:05d}-indices.bin".format(prefix, drawcall_id)):
-            drawcall_id += 1
-            continue
+def decompressMapyCZ(positions, _uParamsSE):
+    """Reproduce the position decompression done by Mapy CZ's vertex shader
+    from its _uParamsSE uniform, for all vertices at once
+    @return an (N,3) float32 array of vertex positions"""
+    p = np.array(_uParamsSE, dtype=np.float64)
+    v = np.asarray(positions, dtype=np.float64)[:,:3]
 
-        timer = Timer()
-        try:
-            indices, positions, uvs, img, constants = loadData(prefix, drawcall_id)
-        except FileNotFoundError as err:
-            print("Skipping ({})".format(err))
-            drawcall_id += 1
-            continue
-        profiling_counters["loadData"].add_sample(timer)
-
-        uvOffsetScale, matrix, refMatrix = extractUniforms(constants, refMatrix)
+    scaled = v * [p[3][0], p[0][1], p[1][1]]
+    direction = scaled + [p[0][0], p[1][0], p[2][0]]
+    direction[:,2] *= p[3][3]
+    norm = np.linalg.norm(direction, axis=1)
+    direction /= (norm + 0.0001)[:,np.newaxis]
+
+    height = norm - p[2][3]
+    factor = (np.clip(height, p[1][2], p[3][2]) - p[1][2]) * p[0][3] * p[1][3] + p[2][2]
+    scaled += direction * (height * factor - height)[:,np.newaxis]
+    return scaled.astype(np.float32)
+
+class DrawcallImporter():
+    """Turn extracted draw calls into Blender objects one at a time, so that
+    they can be imported while the extraction is still running"""
+    def __init__(self, context, prefix, globalScale=1.0/256.0, merge_mode='NONE', grid_size=100.0, link_early=False, pack_images=False):
+        """@param merge_mode: 'NONE' for one object per draw call, 'TEXTURE' to merge
+        draw calls that share the same texture, 'GRID' to merge draw calls by
+        cells of grid_size x grid_size world units
+        @param link_early: link the collection to the scene right away, so that
+        objects show up as they are imported
+        @param pack_images: pack images in the blend file, for extractions in
+        the cache whose files may be evicted"""
+        self.context = context
+        self.directory = os.path.dirname(prefix)
+        self.globalScale = globalScale
+        self.merge_mode = merge_mode
+        self.grid_size = grid_size
+        self.pack_images = pack_images
+        self.refMatrix = None
+        self.materials = {} # one material per texture
+        self.chunks = {} # merged draw calls, by chunk key
+        # New objects go to a dedicated collection, linked to the scene only once
+        # all of them are created so that the view layer is updated only once.
+        self.collection = bpy.data.collections.new(os.path.basename(prefix).rstrip("-") or "MapsModels")
+        self.linked = False
+        if link_early:
+            self.linkCollection()
+
+    def linkCollection(self):
+        with span("linkCollection"):
+            (self.context.collection or self.context.scene.collection).children.link(self.collection)
+        self.linked = True
+
+    def importDrawcall(self, entry, indices, positions, uvs, constants):
+        """Import a draw call of the manifest, given its arrays and constants"""
+        with span("importDrawcall", drawcall=entry["id"]):
+            self.importDrawcallData(entry, indices, positions, uvs, constants)
+
+    def importDrawcallData(self, entry, indices, positions, uvs, constants):
+        drawcall_id = entry["id"]
+        globalScale = self.globalScale
+
+        uvOffsetScale, matrix, self.refMatrix = extractUniforms(constants, self.refMatrix)
         if uvOffsetScale is None:
-            drawcall_id += 1
-            continue
+            return
         
-        timer = Timer()
-        # Make triangles from triangle strip index buffer
-        n = len(indices)
-        if constants["DrawCall"]["topology"] == 'TRIANGLE_STRIP':
-            tris = [ [ indices[i+j] for j in [[0,1,2],[0,2,1]][i%2] ] for i in range(n - 3)]
-            tris = [ t for t in tris if t[0] != t[1] and t[0] != t[2] and t[1] != t[2] ]
-        else:
-            tris = [ [ indices[3*i+j] for j in range(3) ] for i in range(n//3) ]
-
-        if len(indices) == 0:
-            continue
-
-        if constants["DrawCall"]["type"] == 'Google Maps':
-            verts = positions[:,:3] * 256.0 # [ [ p[0] * 256.0, p[1] * 256.0, p[2] * 256.0 ] for p in positions ]
-        elif constants["DrawCall"]["type"] == 'Mapy CZ':
-            raw_verts = positions[:,:3]
-            verts = []
-            globUniforms = constants['$Globals']
-            _uParamsSE = makeMatrix(globUniforms['_uParamsSE'])
-            for v0 in raw_verts:
-                r0 = [0.0, 0.0, 0.0, 0.0]
-                r1 = np.zeros((3,), dtype=np.float32)
-                r2 = np.zeros((3,), dtype=np.float32)
-                r1[0] = v0[0] * _uParamsSE[3][0] + _uParamsSE[0][0]
-                r1[1] = v0[1] * _uParamsSE[0][1] + _uParamsSE[1][0]
-                r1[2] = (v0[2] * _uParamsSE[1][1] + _uParamsSE[2][0]) * _uParamsSE[3][3]
-                r0[1] = np.linalg.norm(r1)
-                r0[2] = r0[1] + 0.0001
-                r0[1] = r0[1] - _uParamsSE[2][3]
-                r0[2] = 1.0 / r0[2]
-                r1 *= r0[2]
-                r0[2] = min(max(r0[1], _uParamsSE[1][2]), _uParamsSE[3][2]) # clamp
-                r0[2] = (r0[2] - _uParamsSE[1][2]) * _uParamsSE[0][3] * _uParamsSE[1][3] + _uParamsSE[2][2]
-                r0[1] = r0[1] * r0[2] - r0[1]
-                r2[0] = v0[0] * _uParamsSE[3][0]
-                r2[1] = v0[1] * _uParamsSE[0][1]
-                r2[2] = v0[2] * _uParamsSE[1][1]
-                r2 += r1 * r0[1]
-                verts.append(r2.tolist())
-        else:
-            verts = positions[:,:3] # [ [ p[0], p[1], p[2] ] for p in positions ]
+        if entry["index_count"] == 0:
+            return
 
-        [ou, ov, su, sv] = uvOffsetScale
-        if uvs is not None and uvs.shape[1] > 2: # len(uvs[0]) > 2:
-            uvs = uvs[:,:2] # [u[:2] for u in uvs]
+        with span("processData"):
+            tris = decodeTriangles(indices, entry["topology"])
 
-        if constants["DrawCall"]["type"] == 'Google Maps':
-            #uvs = [ [ (floor(u * 65535.0 + 0.5) + ou) * su, (floor(v * 65535.0 + 0.5) + ov) * sv ] for u, v in uvs ]
-            uvs = (uvs * 65535.0 + 0.5 + np.array([ou, ov])) * np.array([su, sv])
-        else:
-            #uvs = [ [ (u + ou) * su, (v + ov) * sv ] for u, v in uvs ]
-            uvs = (uvs + np.array([ou, ov])) * np.array([su, sv])
+            if constants["DrawCall"]["type"] == 'Google Maps':
+                verts = positions[:,:3] * 256.0 # [ [ p[0] * 256.0, p[1] * 256.0, p[2] * 256.0 ] for p in positions ]
+            elif constants["DrawCall"]["type"] == 'Mapy CZ':
+                globUniforms = constants['$Globals']
+                verts = decompressMapyCZ(positions, makeMatrix(globUniforms['_uParamsSE']))
+            else:
+                verts = positions[:,:3] # [ [ p[0], p[1], p[2] ] for p in positions ]
+
+            [ou, ov, su, sv] = uvOffsetScale
+            if uvs is not None and uvs.shape[1] > 2: # len(uvs[0]) > 2:
+                uvs = uvs[:,:2] # [u[:2] for u in uvs]
 
-        profiling_counters["processData"].add_sample(timer)
+            if constants["DrawCall"]["type"] == 'Google Maps':
+                #uvs = [ [ (floor(u * 65535.0 + 0.5) + ou) * su, (floor(v * 65535.0 + 0.5) + ov) * sv ] for u, v in uvs ]
+                uvs = (uvs * 65535.0 + 0.5 + np.array([ou, ov])) * np.array([su, sv])
+            else:
+                #uvs = [ [ (u + ou) * su, (v + ov) * sv ] for u, v in uvs ]
+                uvs = (uvs + np.array([ou, ov])) * np.array([su, sv])
 
 
+        mat = loadImageMaterial(self.directory, entry["texture"], self.materials, self.pack_images)
+
+        if self.merge_mode != 'NONE':
+            with span("mergeData"):
+                world_verts = transformPoints(matrix * globalScale, verts)
+                key = chunkKey(self.merge_mode, entry["texture"], world_verts, self.grid_size)
+                self.chunks.setdefault(key, MeshChunk()).add(world_verts, tris, uvs, mat)
+            return
+
         mesh_name = "BuildingMesh-{:05d}".format(drawcall_id)
-        timer = Timer()
-        obj = addMesh(context, mesh_name, verts, tris, uvs)
-        profiling_counters["addMesh"].add_sample(timer)
+        with span("addMesh"):
+            obj = addMesh(self.collection, mesh_name, verts, tris, uvs)
         obj.matrix_world = matrix * globalScale
+        obj.data.materials.append(mat)
+
+    @profile()
+    def finish(self):
+        """Create the merged objects, link the collection to the scene and
+        save the reference matrix"""
+        context = self.context
+        try:
+            for i, chunk in enumerate(self.chunks.values()):
+                with span("addMesh"):
+                    chunk.toBlender(self.collection, "BuildingChunk-{:05d}".format(i))
+        finally:
+            if not self.linked:
+                self.linkCollection()
+
+        # Save reference matrix
+        if self.refMatrix:
+            values = sum([list(v) for v in self.refMatrix], [])
+            context.scene.maps_models_importer_ref_matrix = values
+            context.scene.maps_models_importer_is_ref_matrix_valid = True
+
+class DrawcallStream():
+    """Draw calls announced by the extraction process in streaming mode, read
+    from pack files that are still being written. Draw calls may be announced
+    out of order by the extraction workers, those received before the first
+    one are held back so that the reference matrix is the same as when
+    importing from files. The first one is the first draw call listed that
+    has not been skipped by the extraction process."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.packs = {} # pack files, opened on demand
+        self.shared_pack = SharedPackReader() # arrays in shared memory, for draw calls without pack file
+        self.candidates = None # ids of the draw calls that may be the first one, in order
+        self.received = set()
+        self.skipped = set()
+        self.started = False
+        self.pending = []
 
-        mat_name = "BuildingMat-{:05d}".format(drawcall_id)
-        addImageMaterial(mat_name, obj, img)
+    def start(self, drawcalls):
+        """@return an iterable of the draw calls that can be imported, see receive()"""
+        self.candidates = deque(sorted(drawcalls))
+        return self.advance()
 
-        drawcall_id += 1
+    def receive(self, event):
+        """@return an iterable of the draw calls that can be imported, as
+        arguments of DrawcallImporter.importDrawcall"""
+        self.pending.append(event)
+        self.received.add(event["entry"]["id"])
+        return self.advance()
+
+    def skip(self, drawcall_id):
+        """The draw call will never be received
+        @return an iterable of the draw calls that can be imported, see receive()"""
+        self.skipped.add(drawcall_id)
+        return self.advance()
+
+    def advance(self):
+        if not self.started:
+            if self.candidates is None:
+                return []
+            while self.candidates and self.candidates[0] in self.skipped:
+                self.candidates.popleft()
+            if self.candidates and self.candidates[0] not in self.received:
+                return []
+            self.started = True
+        return self.flush()
+
+    def flush(self):
+        """Get all the draw calls held back, in order"""
+        events = sorted(self.pending, key=lambda event: event["entry"]["id"])
+        self.pending = []
+        for event in events:
+            yield self.load(event)
+
+    def attach(self, event):
+        """Open the shared memory segments of a draw call as soon as it is
+        announced, see sharedmem.py. Called from the thread reading events."""
+        if event["entry"]["pack"] is None:
+            self.shared_pack.attach(event["draw"])
+
+    def load(self, event):
+        entry, draw = event["entry"], event["draw"]
+        if entry["pack"] is None:
+            pack = self.shared_pack
+        else:
+            if entry["pack"] not in self.packs:
+                self.packs[entry["pack"]] = PackStreamReader(os.path.join(self.directory, entry["pack"]))
+            pack = self.packs[entry["pack"]]
+        with span("loadData", drawcall=entry["id"]):
+            indices = pack.getArray(draw, "indices")
+            positions = pack.getArray(draw, "positions")
+            uvs = pack.getArray(draw, "uv")
+        return entry, indices, positions, uvs, draw["constants"]
 
-    # Save reference matrix
-    if refMatrix:
-        values = sum([list(v) for v in refMatrix], [])
-        context.scene.maps_models_importer_ref_matrix = values
-        context.scene.maps_models_importer_is_ref_matrix_valid = True
+    def close(self):
+        for pack in self.packs.values():
+            pack.close()
+        self.shared_pack.close()
 
+class ImportTask(ABC):
+    """Import that can be run step by step from Blender's event loop, see
+    IMP_OP_GoogleMapsCapture.modal(), or all at once by calling step()"""
+    def __init__(self):
+        self.drawcall_count = None # unknown until the draw calls are listed
+        self.imported_count = 0
+        self.done = False
+        self.report = None # see makeReport, once done
+
+    @abstractmethod
+    def step(self, time_budget=None):
+        """Import draw calls for about time_budget seconds, or until the end if None
+        @return True once the import is complete"""
+
+    @abstractmethod
+    def cancel(self):
+        """Stop the import, keeping the draw calls imported so far"""
+
+    def progress(self):
+        """@return the fraction of draw calls imported so far"""
+        if not self.drawcall_count:
+            return 1.0 if self.done else 0.0
+        return self.imported_count / self.drawcall_count
+
+class ManifestImport(ImportTask):
+    """Import the draw calls listed in the manifest of a complete extraction"""
+    def __init__(self, context, prefix, max_blocks=200, globalScale=1.0/256.0, merge_mode='NONE', grid_size=100.0, link_early=False, budget=None, pack_images=False):
+        """@param budget: ImportBudget selecting the draw calls to import, see budget.py"""
+        super().__init__()
+        # The manifest lists exactly the draw calls that were extracted
+        self.directory = os.path.dirname(prefix)
+        manifest_filename = manifestFilename(prefix)
+        if not os.path.isfile(manifest_filename):
+            raise MapsModelsImportError(MSG_INCORRECT_RDC)
+        manifest = readManifest(manifest_filename)
+        self.drawcalls = deque(selectEntries([
+            entry for entry in manifest["drawcalls"]
+            if max_blocks <= 0 or entry["id"] < max_blocks
+        ], budget))
+        self.drawcall_count = len(self.drawcalls)
+        self.packs = {} # pack files, opened on demand
+        self.context = context
+        self.prefix = prefix
+        self.importer = DrawcallImporter(context, prefix, globalScale, merge_mode, grid_size, link_early, pack_images)
+
+    def step(self, time_budget=None):
+        timer = Timer()
+        try:
+            while self.drawcalls:
+                if time_budget is not None and timer.ellapsed() >= time_budget:
+                    return False
+                self.importEntry(self.drawcalls.popleft())
+                self.imported_count += 1
+        except Exception:
+            self.cancel()
+            raise
+        self.cancel()
+        return True
+
+    def importEntry(self, entry):
+        """Arrays are views of the pack file, released when this returns"""
+        if entry["pack"] not in self.packs:
+            self.packs[entry["pack"]] = PackReader(os.path.join(self.directory, entry["pack"]))
+
+        with span("loadData", drawcall=entry["id"]):
+            indices, positions, uvs, constants = loadData(self.packs[entry["pack"]], entry)
+
+        self.importer.importDrawcall(entry, indices, positions, uvs, constants)
+
+    def cancel(self):
+        """Also called once all draw calls are imported"""
+        if not self.done:
+            self.done = True
+            try:
+                self.importer.finish()
+            finally:
+                for pack in self.packs.values():
+                    pack.close()
+                self.packs = {}
+            self.report = finishProfiling(self.context, self.prefix, self)
+
+class StreamingImport(ImportTask):
+    """Run the extraction process in streaming mode and import the draw calls
+    it announces (see protocol.py), so that the import overlaps with the
+    extraction. Events are read by a thread so that steps never wait for the
+    extraction process unless they are asked to run until the end."""
+    def __init__(self, context, filepath, prefix, max_blocks, use_experimental, texture_options=(), merge_mode='NONE', grid_size=100.0, link_early=False, cache_entry=None, transport='FILE', budget=None, pack_images=False):
+        """@param cache_entry: (cache, key) of the extraction cache entry in
+        which the capture is extracted, committed once the extraction succeeded
+        @param transport: 'FILE' to transfer arrays through pack files, or
+        'SHARED_MEMORY' (which leaves nothing to cache)
+        @param budget: ImportBudget, enforced by the extraction process"""
+        super().__init__()
+        self.context = context
+        self.prefix = prefix
+        self.cache_entry = cache_entry
+        self.args, self.python_home = extractorCommand(context, filepath, prefix, max_blocks, use_experimental, *texture_options, budget=budget)
+        self.args.append("--stream")
+        if transport == 'SHARED_MEMORY':
+            self.args += ["--transport", "shm"]
+        self.process = submitToDaemon(context, self.args, use_experimental, use_stdin=transport == 'SHARED_MEMORY')
+        if self.process is None:
+            self.process = subprocess.Popen(
+                self.args,
+                stdin=subprocess.PIPE if transport == 'SHARED_MEMORY' else None,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+
+        self.importer = DrawcallImporter(context, prefix, merge_mode=merge_mode, grid_size=grid_size, link_early=link_early, pack_images=pack_images)
+        self.stream = DrawcallStream(os.path.dirname(prefix))
+        self.ready = deque() # draw calls that can be imported
+
+        self.log = []
+        self.events = queue.Queue() # None marks the end of the extraction
+        self.threads = [
+            threading.Thread(target=self.readEvents, daemon=True),
+            threading.Thread(target=self.readLog, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def readEvents(self):
+        for line in self.process.stdout:
+            event = parseEvent(line)
+            if event is None:
+                self.log.append(line)
+            elif event["type"] == "end":
+                self.release()
+            else:
+                if event["type"] == "drawcall":
+                    self.stream.attach(event)
+                self.events.put(event)
+        self.events.put(None)
+
+    def release(self):
+        """All shared memory segments are attached, the extraction process can unlink them"""
+        if self.process.stdin is not None:
+            try:
+                self.process.stdin.write(RELEASE_LINE)
+                self.process.stdin.close()
+            except OSError:
+                pass # the extraction process is already gone
+
+    def readLog(self):
+        for line in self.process.stderr:
+            self.log.append(line)
+
+    def step(self, time_budget=None):
+        timer = Timer()
+        try:
+            while True:
+                if self.ready:
+                    self.importer.importDrawcall(*self.ready.popleft())
+                    self.imported_count += 1
+                else:
+                    try:
+                        event = self.events.get(block=time_budget is None)
+                    except queue.Empty:
+                        return False
+                    if event is None:
+                        self.complete()
+                        return True
+                    elif event["type"] == "start":
+                        self.drawcall_count = event["drawcall_count"]
+                        self.ready.extend(self.stream.start(event["drawcalls"]))
+                    elif event["type"] == "drawcall":
+                        self.ready.extend(self.stream.receive(event))
+                    elif event["type"] == "skipped":
+                        self.ready.extend(self.stream.skip(event["drawcall"]))
+                if time_budget is not None and timer.ellapsed() >= time_budget:
+                    return False
+        except Exception:
+            if not self.done:
+                self.cancel()
+                self.discardCacheEntry()
+            raise
+
+    def complete(self):
+        returncode = self.process.wait()
+        for thread in self.threads:
+            thread.join()
+        try:
+            if returncode == 0:
+                # Draw calls held back because the first one was neither
+                # announced nor skipped, when an extraction worker failed
+                self.ready.extend(self.stream.flush())
+                while self.ready:
+                    self.importer.importDrawcall(*self.ready.popleft())
+                    self.imported_count += 1
+        finally:
+            self.close()
+
+        output = "".join(self.log)
+        if returncode != 0:
+            self.discardCacheEntry()
+            raise extractionError(self.context, returncode, output, self.args, self.python_home)
+        if self.cache_entry is not None:
+            cache, key = self.cache_entry
+            cache.commit(key, self.prefix)
+        if getPreferences(self.context).debug_info:
+            print("google_maps_rd returned:")
+            print(output)
+
+    def cancel(self):
+        """The extraction cache entry, if any, is left incomplete rather than
+        discarded for the textures of imported draw calls to remain available
+        during the session, it will be evicted later on."""
+        if not self.done:
+            self.process.kill()
+            self.process.wait()
+            self.close()
+
+    def close(self):
+        self.done = True
+        self.stream.close()
+        self.importer.finish()
+        self.report = finishProfiling(self.context, self.prefix, self)
+
+    def discardCacheEntry(self):
+        if self.cache_entry is not None:
+            cache, key = self.cache_entry
+            cache.discard(key)
+
+def printProfilingCounters(context):
     pref = getPreferences(context)
     if pref.debug_info:
+        report = getLastReport()
+        if report is not None:
+            print("Import stages:")
+            for name, stats in report["stages"].items():
+                print(f" - {name} ({stats['process']}): {stats['total']*1000.:.03f}ms in {stats['count']} samples, p95 {stats['p95']*1000.:.03f}ms")
         print("Profiling counters:")
-        for key, counter in profiling_counters.items():
-            print(f" - {key}: {counter.summary()}")
+        for line in profiler.summaryLines():
+            print(line)
+        print("Slowest draw calls:")
+        for drawcall, times in profiler.slowestDrawcalls():
+            print(f" - {drawcall}: " + ", ".join(f"{name} {t*1000.:.03f}ms" for name, t in times.items()))
+        if pref.memory_profiling:
+            print("Largest draw calls:")
+            for drawcall, traced in profiler.largestDrawcalls():
+                print(f" - {drawcall}: {formatBytes(traced)}")
+            print("Top allocation sites:")
+            for line in profiler.memoryLines():
+                print(line)
+        daemon_summary = getDaemonSummary()
+        if daemon_summary is not None:
+            print(f"Extraction daemon: {daemon_summary}")
+
+def traceFilename(prefix):
+    """Trace of the extraction, see google_maps_rd.py --trace"""
+    return "{}trace.json".format(prefix)
+
+def startProfiling(pref):
+    """Reset the counters at the beginning of an import, see finishProfiling"""
+    profiler.reset()
+    if pref.trace_file:
+        profiler.startTrace("Blender")
+    if pref.memory_profiling:
+        profiler.startMemoryProfiling()
+
+def saveTrace(context, prefix):
+    """Write the trace of the import, if recording, merged with the one of the
+    extraction when there was an extraction"""
+    if not profiler.tracing:
+        return
+    events = profiler.stopTrace()
+    filename = traceFilename(prefix)
+    if os.path.isfile(filename):
+        events.extend(readTrace(filename))
+        os.remove(filename)
+    writeTrace(bpy.path.abspath(getPreferences(context).trace_file), events)
+
+# Stages of the import that are reported, the process they run in and the
+# spans they are made of. Textures are either saved as PNG, or read then
+# written in raw texture mode.
+REPORT_STAGES = (
+    ("consolidateEvents", "extraction", ("consolidateEvents",)),
+    ("extractRelevantCalls", "extraction", ("extractRelevantCalls",)),
+    ("fetchBuffers", "extraction", ("fetchBuffers",)),
+    ("saveTextures", "extraction", ("SaveTexture", "GetTextureData", "writeRawTexture")),
+    ("loadData", "import", ("loadData",)),
+    ("processData", "import", ("processData",)),
+    ("addMesh", "import", ("addMesh",)),
+)
+
+_last_report = None
+
+def stageCounter(counters, spans):
+    """@return a counter with the samples of all the spans of a stage"""
+    stage = ProfilingCounterProperty()
+    for name in spans:
+        if name in counters:
+            for sample in counters[name].samples:
+                stage.add_sample(sample)
+    return stage
+
+def makeReport(prefix, task, extraction_counters, import_counters, extraction_memory=None, import_memory=None):
+    """Gather the profiling counters of the extraction processes, if the
+    capture was extracted for this import, and the ones of Blender
+    @return a dict that can be saved as JSON, times are in seconds and memory in bytes"""
+    processes = { "extraction": extraction_counters, "import": import_counters }
+    memory = { "extraction": extraction_memory or {}, "import": import_memory or {} }
+    return {
+        "prefix": prefix,
+        "drawcall_count": task.drawcall_count,
+        "imported_count": task.imported_count,
+        "stages": {
+            name: { "process": process, **stageCounter(processes[process], spans).stats() }
+            for name, process, spans in REPORT_STAGES
+        },
+        "counters": {
+            process: { name: counter.stats() for name, counter in counters.items() }
+            for process, counters in processes.items()
+        },
+        "memory": {
+            process: { name: counter.stats() for name, counter in counters.items() }
+            for process, counters in memory.items()
+        },
+    }
+
+def finishProfiling(context, prefix, task):
+    """Called by import tasks once done, write the trace and the report of
+    the import if requested in the preferences
+    @return the report, see makeReport"""
+    global _last_report
+    saveTrace(context, prefix)
+    extraction_counters = {}
+    extraction_memory = defaultdict(MemoryCounterProperty)
+    filename = profileFilename(prefix)
+    if os.path.isfile(filename):
+        extraction_counters = readCounters(filename, memory=extraction_memory)
+        os.remove(filename)
+    _last_report = makeReport(prefix, task, extraction_counters, profiling_counters, extraction_memory, memory_counters)
+    report_file = getPreferences(context).report_file
+    if report_file:
+        with open(bpy.path.abspath(report_file), 'w') as f:
+            json.dump(_last_report, f, indent=2)
+    return _last_report
+
+def getLastReport():
+    """@return the report of the last import, see makeReport, or None"""
+    return _last_report
 
+def filesToBlender(context, prefix, max_blocks=200, use_experimental=False, globalScale=1.0/256.0, merge_mode='NONE', grid_size=100.0, budget=None, pack_images=False):
+    """Import data from the files extracted by captureToFiles, see
+    DrawcallImporter for the merge options and budget.py for the budget"""
+    ManifestImport(context, prefix, max_blocks, globalScale, merge_mode, grid_size, budget=budget, pack_images=pack_images).step()
+    printProfilingCounters(context)
     return None # no error
 
+def streamCaptureToBlender(context, filepath, prefix, max_blocks, use_experimental, texture_options=(), merge_mode='NONE', grid_size=100.0, transport='FILE', budget=None, pack_images=False):
+    """Same as captureToFiles followed by filesToBlender, but draw calls are
+    imported as soon as the extraction process announces them"""
+    StreamingImport(context, filepath, prefix, max_blocks, use_experimental, texture_options, merge_mode, grid_size, transport=transport, budget=budget, pack_images=pack_images).step()
+    printProfilingCounters(context)
+
 # -----------------------------------------------------------------------------
 
-def importCapture(context, filepath, max_blocks, use_experimental, pref):
-    prefix = makeTmpDir(pref, filepath)
-    captureToFiles(context, filepath, prefix, max_blocks, use_experimental)
-    filesToBlender(context, prefix, max_blocks, use_experimental)
+def importCapture(context, filepath, max_blocks, use_experimental, pref, texture_format='PNG', texture_mip=0, texture_max_size=0, merge_mode='NONE', grid_size=100.0, budget=None):
+    """@param budget: ImportBudget limiting the import, see budget.py
+    @return the report of the import, see makeReport"""
+    texture_options = (texture_format, texture_mip, texture_max_size)
+    # Files of the cache may be evicted, images must not point to them
+    import_options = { "merge_mode": merge_mode, "grid_size": grid_size, "pack_images": useCache(pref) }
+    startProfiling(pref)
+
+    def extract(prefix):
+        """@return True iff the draw calls have been imported along the extraction"""
+        if pref.use_streaming or pref.transport == 'SHARED_MEMORY':
+            streamCaptureToBlender(context, filepath, prefix, max_blocks, use_experimental, texture_options, transport=pref.transport, budget=budget, **import_options)
+            return True
+        captureToFiles(context, filepath, prefix, max_blocks, use_experimental, *texture_options, budget=budget)
+        return False
+
+    if useCache(pref):
+        prefix, imported = cachedCaptureToFiles(context, filepath, max_blocks, use_experimental, pref, texture_options, extract, budget)
+    else:
+        prefix = makeTmpDir(pref, filepath)
+        imported = extract(prefix)
+    if not imported:
+        filesToBlender(context, prefix, max_blocks, use_experimental, budget=budget, **import_options)
+    return getLastReport()
+
+def startCaptureImport(context, filepath, max_blocks, use_experimental, pref, texture_format='PNG', texture_mip=0, texture_max_size=0, merge_mode='NONE', grid_size=100.0, budget=None):
+    """Same as importCapture, but returns an ImportTask to be run step by step.
+    The extraction always runs in streaming mode, and objects show up as they
+    are imported."""
+    texture_options = (texture_format, texture_mip, texture_max_size)
+    import_options = { "merge_mode": merge_mode, "grid_size": grid_size, "link_early": True, "pack_images": useCache(pref) }
+    cache_entry = None
+    startProfiling(pref)
+    if useCache(pref):
+        cache = getCache(pref)
+        key = cacheKey(cache, filepath, use_experimental, texture_options)
+        prefix = cache.lookup(key, max_blocks, budget)
+        if prefix is not None:
+            return ManifestImport(context, prefix, max_blocks, budget=budget, **import_options)
+        prefix = cache.prepare(key, filepath)
+        cache_entry = (cache, key)
+    else:
+        prefix = makeTmpDir(pref, filepath)
+    return StreamingImport(context, filepath, prefix, max_blocks, use_experimental, texture_options, cache_entry=cache_entry, transport=pref.transport, budget=budget, **import_options)
+
+def useCache(pref):
+    """Arrays transferred through shared memory leave nothing to cache"""
+    return pref.use_cache and pref.transport == 'FILE'
+
+def cacheKey(cache, filepath, use_experimental, texture_options):
+    texture_format, texture_mip, texture_max_size = texture_options
+    return cache.makeKey(filepath, use_experimental, {
+        "texture_format": texture_format,
+        "texture_mip": texture_mip,
+        "texture_max_size": texture_max_size,
+    })
+
+def cachedCaptureToFiles(context, filepath, max_blocks, use_experimental, pref, texture_options, extract, budget=None):
+    """Run extract(prefix) in a new cache entry, unless the capture is already
+    in the extraction cache
+    @return the prefix of the extracted files and the return value of extract,
+    False if the cache was used"""
+    cache = getCache(pref)
+    with span("cacheLookup"):
+        key = cacheKey(cache, filepath, use_experimental, texture_options)
+        prefix = cache.lookup(key, max_blocks, budget)
+    if prefix is not None:
+        if pref.debug_info:
+            print(f"Using cached extraction {prefix}")
+        return prefix, False
+
+    prefix = cache.prepare(key, filepath)
+    try:
+        result = extract(prefix)
+    except:
+        cache.discard(key)
+        raise
+    cache.commit(key, prefix)
+    return prefix, result
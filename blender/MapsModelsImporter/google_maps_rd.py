@@ -30,10 +30,15 @@ This might be due to one of the following reasons:
 Remember, you must use exactly the same version of python to load the RenderDoc Module as was used to build it.
 Find more information about building the RenderDoc Module here: https://github.com/baldurk/renderdoc/blob/v1.x/docs/CONTRIBUTING/Compiling.md\n"""
 
+import os
 import sys
-import pickle
-import struct
-import numpy as np
+import json
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left
+from collections import namedtuple
 
 try:
     import renderdoc as rd
@@ -51,43 +56,258 @@ except ImportError as err:
     print("Error Message: ", err,"\n")
     sys.exit(21)
 
-from meshdata import MeshData, makeMeshData
-from profiling import Timer, profiling_counters
-from rdutils import CaptureWrapper
+from meshdata import DrawBuffers, makeMeshData
+from packfile import PackWriter, packFilename, writeRawTexture, RAW_TEXTURE_EXTENSION
+from manifest import manifestFilename, makeDrawcallEntry, makeManifest, writeManifest, readManifest
+from profiling import Timer, profiler, span, profile, writeTrace, readTrace, profiling_counters, memory_counters, formatBytes, profileFilename, writeCounters, readCounters
+from protocol import EventStream, parseEvent
+from sharedmem import SharedPackWriter, RELEASE_LINE
+from rdutils import CaptureWrapper, resourceKey
+from budget import ImportBudget, triangleCount, rankDrawcalls
+
+SCRIPT_PATH = os.path.realpath(__file__)
+TEXTURE_FORMATS = ('png', 'raw', 'raw-zlib')
+TEXTURE_POOL_SIZE = 2
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description="Extract draw calls of a RenderDoc capture of Google Maps into binary files")
+    parser.add_argument("capture_file")
+    parser.add_argument("prefix", help="Prefix (directory and file name start) of the extracted files")
+    parser.add_argument("max_blocks", type=int, help="Maximum number of draw calls to extract, -1 for no limit")
+    parser.add_argument("--workers", type=int, default=1, help="Number of replay processes sharing the extraction")
+    parser.add_argument("--texture-format", choices=TEXTURE_FORMATS, default='png', help="png is encoded by RenderDoc, raw formats dump texels and compress them (or not) in a thread pool")
+    parser.add_argument("--texture-mip", type=int, default=0, help="Mip level of the textures to extract, 0 for full resolution")
+    parser.add_argument("--texture-max-size", type=int, default=0, help="Extract the largest mip whose edges are at most this size, 0 for no limit")
+    parser.add_argument("--stream", action='store_true', help="Announce each extracted draw call on the standard output, see protocol.py")
+    parser.add_argument("--transport", choices=('file', 'shm'), default='file', help="Write arrays to pack files, or to shared memory segments announced in streaming mode (see sharedmem.py)")
+    parser.add_argument("--trace", default=None, help="Write a trace of the extraction in this JSON file, see profiling.py")
+    parser.add_argument("--max-triangles", type=int, default=0, help="Triangle budget, 0 for no limit, see budget.py")
+    parser.add_argument("--max-vertices", type=int, default=0, help="Vertex budget, 0 for no limit")
+    parser.add_argument("--max-texture-bytes", type=int, default=0, help="Budget of decoded texture bytes, 0 for no limit")
+    parser.add_argument("--memory-profile", action='store_true', help="Also measure the peak memory of each stage and draw call, see profiling.py")
+    parser.add_argument("--shard", type=int, default=None, help="Internal: extract the given shard of draw calls listed by the main process")
+    return parser.parse_args(argv)
+
+def budgetOf(options):
+    return ImportBudget(options.max_triangles, options.max_vertices, options.max_texture_bytes)
+
+def shardsFilename(prefix):
+    return "{}drawcalls.json".format(prefix)
+
+def workerTraceFilename(trace, shard):
+    root, ext = os.path.splitext(trace)
+    return "{}-{:02d}{}".format(root, shard, ext)
+
+# A batch of relevant draw calls starts at the first event whose name starts
+# with first_call, it gathers events starting with drawcall_prefix and ends at
+# the first other event starting with last_call. When skip_until_uniform is
+# set, batches are skipped until the first draw call of one uses this uniform.
+# The first draw call must use required_uniform, if set.
+ScrapingStrategy = namedtuple('ScrapingStrategy', [
+    'first_call', 'last_call', 'drawcall_prefix', 'capture_type', 'skip_until_uniform', 'required_uniform'
+])
+
+SCRAPING_STRATEGIES = [
+    ScrapingStrategy("glClear(Color = <0.000000, 0.000000, 0.000000, 1.000000>, Depth = <1.000000>)", "glDrawArrays(4)", "glDrawElements", "Google Maps", None, None),
+    ScrapingStrategy("glClear(Color = <0.000000, 0.000000, 0.000000, 1.000000>, Depth = <1.000000>, Stencil = <0x00>)", "glDrawArrays(4)", "glDrawElements", "Google Maps", None, None),
+    ScrapingStrategy("glClear(Color = <0.000000, 0.000000, 0.000000, 1.000000>, Depth = <0.000000>)", "glDrawArrays(4)", "glDrawElements", "Google Maps", None, None),
+    ScrapingStrategy("glClear(Color = <0.000000, 0.000000, 0.000000, 1.000000>, Depth = <0.000000>, Stencil = <0x00>)", "glDrawArrays(4)", "glDrawElements", "Google Maps", None, None),
+    ScrapingStrategy("", "ClearDepthStencilView", "DrawIndexed", "Mapy CZ", None, "_uMV"),
+    # With Google Earth there are two batches of DrawIndexed calls, we are interested in the second one
+    ScrapingStrategy("DrawIndexed", "", "DrawIndexed", "Google Earth", "_uMeshToWorldMatrix", None),
+    # Actually sometimes there's only one batch
+    ScrapingStrategy("DrawIndexed", "", "DrawIndexed", "Google Earth", None, "_uMeshToWorldMatrix"),
+    ScrapingStrategy("ClearRenderTargetView(0.000000, 0.000000, 0.000000", "Draw()", "DrawIndexed", "Google Maps", None, None),
+    ScrapingStrategy("", "Draw()", "DrawIndexed", "Google Maps", "_w", None),
+]
+FIRST_STRATEGY = 4 # strategies 0 to 3 are for older OpenGL captures
+
+# Google Maps draw calls come in several batches that all look like this
+GOOGLE_MAPS_BATCH = ScrapingStrategy("", "Draw()", "DrawIndexed", "Google Maps", "_w", None)
+
+class EventIndex():
+    """Positions of the events whose name starts with any of the prefixes used
+    by scraping strategies, built in a single pass over the consolidated events
+    so that looking for a batch does not scan the event list again"""
+    def __init__(self, events, strategies):
+        self.events = events
+        self.positions = {} # prefix -> sorted positions of events starting with it
+        self.stops = {} # (drawcall prefix, last call prefix) -> positions that end a batch
+        for s in strategies:
+            for prefix in (s.first_call, s.drawcall_prefix, s.last_call):
+                self.positions[prefix] = []
+            self.stops[(s.drawcall_prefix, s.last_call)] = []
+
+        for i, event in enumerate(events):
+            name = event.name
+            matches = {}
+            for prefix, positions in self.positions.items():
+                matches[prefix] = name.startswith(prefix)
+                if matches[prefix]:
+                    positions.append(i)
+            for (drawcall_prefix, last_call), positions in self.stops.items():
+                if matches[last_call] and not matches[drawcall_prefix]:
+                    positions.append(i)
+
+    @staticmethod
+    def nextPosition(positions, start):
+        """First position greater or equal to start, or None"""
+        k = bisect_left(positions, start)
+        return positions[k] if k < len(positions) else None
+
+    def findBatch(self, start, strategy):
+        """Find the first batch of draw calls of the strategy that starts at or after start
+        @return the batch and the position of the event that ended it (len(events) if none)"""
+        end_of_events = len(self.events)
+        draw_positions = self.positions[strategy.drawcall_prefix]
+        begin = self.nextPosition(self.positions[strategy.first_call], start)
+        if begin is None:
+            return [], end_of_events
+        first_draw = self.nextPosition(draw_positions, begin)
+        if first_draw is None:
+            return [], end_of_events
+        # The batch ends only once it contains at least one draw call
+        end = self.nextPosition(self.stops[(strategy.drawcall_prefix, strategy.last_call)], first_draw + 1)
+        if end is None:
+            end = end_of_events
+        batch = draw_positions[bisect_left(draw_positions, first_draw):bisect_left(draw_positions, end)]
+        return [self.events[i] for i in batch], end
+
+def primitiveTopology(state):
+    """@return the topology of a draw call, as named in its manifest entry"""
+    return 'TRIANGLE_STRIP' if state.GetPrimitiveTopology() == rd.Topology.TriangleStrip else 'TRIANGLES'
+
+def isRawCompatible(description):
+    """Raw texture dumps are only supported for 8 bit RGBA/BGRA textures,
+    others (e.g. block compressed) are saved as PNG"""
+    if description is None:
+        return False
+    fmt = description.format
+    unorm_types = (rd.CompType.UNorm, getattr(rd.CompType, 'UNormSRGB', rd.CompType.UNorm))
+    return (
+        not fmt.Special()
+        and fmt.compType in unorm_types
+        and fmt.compCount == 4
+        and fmt.compByteWidth == 1
+    )
+
+class WorkerProcess():
+    """Extraction process replaying its own copy of the capture to extract one
+    shard of the relevant draw calls, its output is relayed with a prefix.
+    In streaming mode, its events are relayed as is to the given event stream,
+    but for the "end" event that tells when it is done extracting."""
+    def __init__(self, options, shard, events=None):
+        self.shard = shard
+        self.events = events
+        self.extracted = threading.Event()
+        self.timer = Timer()
+        args = [
+            sys.executable, SCRIPT_PATH, options.capture_file, options.prefix, str(options.max_blocks),
+            "--texture-format", options.texture_format,
+            "--texture-mip", str(options.texture_mip),
+            "--texture-max-size", str(options.texture_max_size),
+            "--shard", str(shard),
+        ]
+        if events is not None:
+            args += ["--stream", "--transport", options.transport]
+        if options.trace is not None:
+            args += ["--trace", workerTraceFilename(options.trace, shard)]
+        if options.memory_profile:
+            args += ["--memory-profile"]
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE if options.transport == 'shm' else None,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if events is None else subprocess.PIPE,
+            text=True
+        )
+        self.threads = [threading.Thread(target=self.relayEvents, daemon=True)]
+        if events is not None:
+            self.threads.append(threading.Thread(target=self.relayOutput, args=(self.process.stderr,), daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def relayEvents(self):
+        try:
+            self.relayOutput(self.process.stdout)
+        finally:
+            self.extracted.set()
+
+    def relayOutput(self, stream):
+        for line in stream:
+            event = parseEvent(line) if self.events is not None else None
+            if event is None:
+                print(f"[worker {self.shard}] {line}", end='', flush=True)
+            elif event["type"] == "end":
+                self.extracted.set()
+            else:
+                self.events.writeLine(line)
 
-_, CAPTURE_FILE, FILEPREFIX, MAX_BLOCKS_STR = sys.argv[:4]
-MAX_BLOCKS = int(MAX_BLOCKS_STR)
+    def waitExtracted(self):
+        """Wait for the worker to be done extracting, it may then wait for
+        release() before exiting"""
+        self.extracted.wait()
 
-def numpySave(array, file):
-    np.array([array.ndim], dtype=np.int32).tofile(file)
-    np.array(array.shape, dtype=np.int32).tofile(file)
-    dt = array.dtype.descr[0][1][1:3].encode('ascii')
-    file.write(dt)
-    array.tofile(file)
+    def release(self):
+        """Let the worker release its shared memory segments and exit"""
+        if self.process.stdin is not None:
+            try:
+                self.process.stdin.write(RELEASE_LINE)
+                self.process.stdin.close()
+            except OSError:
+                pass # the worker is already gone
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        returncode = self.process.wait()
+        if returncode != 0:
+            print(f"Warning: Extraction worker {self.shard} failed with return code {returncode}, its draw calls are missing")
+        return self.timer.ellapsed()
 
 class CaptureScraper():
-    def __init__(self, controller):
+    def __init__(self, controller, options, events=None):
+        """@param events: EventStream on which draw calls are announced in streaming mode"""
         self.controller = controller
+        self.options = options
+        self.events = events
+        self.drawcall_entries = []
+        self.shader_cache = {} # vertex shader ResourceId -> (entry point, reflection, uniform names per block)
+        self.event_shaders = {} # eventId -> vertex shader ResourceId
+        self.strategy = None # scraping strategy that matched
+        self.fetched_bytes = 0
+        self.saved_textures = set()
+        self.texture_descriptions = None # ResourceId -> TextureDescription, loaded on demand
+        self.texture_pool = None
+        self.texture_futures = {} # file name -> future of the pool writing it
+        self.shared_pack = None # SharedPackWriter, when using the shared memory transport
+        self.budget = budgetOf(options)
+        self.texture_bytes = {} # texture file name -> size of its texels
+        self.prefetched_indices = {} # drawcallId -> indices fetched by prioritizeDrawcalls()
+
+    def getVertexShaderReflection(self, draw, state=None):
+        """Reflection of the vertex shader used by a draw call. A capture only
+        uses a handful of different shaders so this is cached per shader, and
+        the shader of each event is remembered so that classification, which
+        tests the same draw calls for several strategies, seeks each event once.
+        @return shader id, entry point, reflection and the set of uniform names of each constant block"""
+        shader = self.event_shaders.get(draw.eventId)
+        if shader is None or shader not in self.shader_cache:
+            if state is None:
+                self.controller.SetFrameEvent(draw.eventId, True)
+                state = self.controller.GetPipelineState()
+            shader = state.GetShader(rd.ShaderStage.Vertex)
+            self.event_shaders[draw.eventId] = shader
 
-    def findDrawcallBatch(self, drawcalls, first_call_prefix, drawcall_prefix, last_call_prefix):
-        batch = []
-        has_batch_started = False
-        for last_call_index, draw in enumerate(drawcalls):
-            if has_batch_started:
-                if not draw.name.startswith(drawcall_prefix):
-                    if draw.name.startswith(last_call_prefix) and batch != []:
-                        break
-                    else:
-                        print("(Skipping drawcall {})".format(draw.name))
-                        continue
-                batch.append(draw)
-            elif draw.name.startswith(first_call_prefix):
-                has_batch_started = True
-                if draw.name.startswith(drawcall_prefix):
-                    batch.append(draw)
-            else:
-                print(f"Not relevant yet: {draw.name}")
-        return batch, last_call_index
+        if shader not in self.shader_cache:
+            ep = state.GetShaderEntryPoint(rd.ShaderStage.Vertex)
+            ref = state.GetShaderReflection(rd.ShaderStage.Vertex)
+            uniform_names = {
+                cb.name: { var.name for var in cb.variables }
+                for cb in ref.constantBlocks
+            }
+            self.shader_cache[shader] = (ep, ref, uniform_names)
+        return (shader, *self.shader_cache[shader])
 
     def getVertexShaderConstants(self, draw, state=None):
         controller = self.controller
@@ -95,9 +315,7 @@ class CaptureScraper():
             controller.SetFrameEvent(draw.eventId, True)
             state = controller.GetPipelineState()
 
-        shader = state.GetShader(rd.ShaderStage.Vertex)
-        ep = state.GetShaderEntryPoint(rd.ShaderStage.Vertex)
-        ref = state.GetShaderReflection(rd.ShaderStage.Vertex)
+        shader, ep, ref, _ = self.getVertexShaderReflection(draw, state)
         constants = {}
         for cbn, cb in enumerate(ref.constantBlocks):
             block = {}
@@ -138,127 +356,78 @@ class CaptureScraper():
             constants[cb.name] = block
         return constants
 
+    def hasUniforms(self, draw, uniforms):
+        """Check from the shader reflection, without fetching constant buffers, that
+        all the uniforms are declared in the $Globals block of the draw's vertex shader"""
+        _, _, _, uniform_names = self.getVertexShaderReflection(draw)
+        globals_names = uniform_names.get('$Globals', set())
+        return all(uniform in globals_names for uniform in uniforms)
+
     def hasUniform(self, draw, uniform):
-        constants = self.getVertexShaderConstants(draw)
-        return '$Globals' in constants and uniform in constants['$Globals']
+        return self.hasUniforms(draw, [uniform])
 
-    def extractRelevantCalls(self, drawcalls, _strategy=4):
+    @profile()
+    def extractRelevantCalls(self, drawcalls):
         """List the drawcalls related to drawing the 3D meshes thank to a ad hoc heuristic
         It may different in RenderDoc UI and in Python module, for some reason
+        Strategies are tried in order, all of them use the same index of events.
         """
-        first_call = ""
-        last_call = "glDrawArrays(4)"
-        drawcall_prefix = "glDrawElements"
-        min_drawcall = 0
-        capture_type = "Google Maps"
-        if _strategy == 0:
-            first_call = "glClear(Color = <0.000000, 0.000000, 0.000000, 1.000000>, Depth = <1.000000>)"
-        elif _strategy == 1:
-            first_call = "glClear(Color = <0.000000, 0.000000, 0.000000, 1.000000>, Depth = <1.000000>, Stencil = <0x00>)"
-        elif _strategy == 2:
-            first_call = "glClear(Color = <0.000000, 0.000000, 0.000000, 1.000000>, Depth = <0.000000>)"
-        elif _strategy == 3:
-            first_call = "glClear(Color = <0.000000, 0.000000, 0.000000, 1.000000>, Depth = <0.000000>, Stencil = <0x00>)"
-        elif _strategy == 4:
-            first_call = ""
-            last_call = "ClearDepthStencilView"
-            drawcall_prefix = "DrawIndexed"
-            capture_type = "Mapy CZ"
-        elif _strategy == 5:
-            # With Google Earth there are two batches of DrawIndexed calls, we are interested in the second one
-            first_call = "DrawIndexed"
-            last_call = ""
-            drawcall_prefix = "DrawIndexed"
-            capture_type = "Google Earth"
-            min_drawcall = 0
-            while True:
-                skipped_drawcalls, new_min_drawcall = self.findDrawcallBatch(drawcalls[min_drawcall:], first_call, drawcall_prefix, last_call)
-                if not skipped_drawcalls or self.hasUniform(skipped_drawcalls[0], "_uMeshToWorldMatrix"):
-                    break # Found a good draw call
-                min_drawcall += new_min_drawcall
-        elif _strategy == 6:
-            # Actually sometimes there's only one batch
-            first_call = "DrawIndexed"
-            last_call = ""
-            drawcall_prefix = "DrawIndexed"
-            capture_type = "Google Earth (single)"
-        elif _strategy == 7:
-            first_call = "ClearRenderTargetView(0.000000, 0.000000, 0.000000"
-            last_call = "Draw()"
-            drawcall_prefix = "DrawIndexed"
-        elif _strategy == 8:
-            first_call = "" # Try from the beginning on
-            last_call = "Draw()"
-            drawcall_prefix = "DrawIndexed"
-            min_drawcall = 0
-            while True:
-                skipped_drawcalls, new_min_drawcall = self.findDrawcallBatch(drawcalls[min_drawcall:], first_call, drawcall_prefix, last_call)
-                if not skipped_drawcalls or self.hasUniform(skipped_drawcalls[0], "_w"):
-                    break # Found a good draw call
-                min_drawcall += new_min_drawcall
+        index = EventIndex(drawcalls, SCRAPING_STRATEGIES + [GOOGLE_MAPS_BATCH])
+        for strategy_id in range(FIRST_STRATEGY, len(SCRAPING_STRATEGIES)):
+            print(f"Trying scraping strategy #{strategy_id}...")
+            relevant_drawcalls = self.applyStrategy(index, SCRAPING_STRATEGIES[strategy_id])
+            if relevant_drawcalls is not None:
+                self.strategy = strategy_id
+                return relevant_drawcalls, SCRAPING_STRATEGIES[strategy_id].capture_type
+
+        print("Error: Could not find the beginning of the relevant 3D draw calls")
+        return [], "none"
+
+    def findBatchWithUniform(self, index, start, strategy, uniform):
+        """Skip batches until the first draw call of one of them uses the uniform
+        @return this batch (or an empty one) and the position where it ends"""
+        while True:
+            batch, end = index.findBatch(start, strategy)
+            if not batch or self.hasUniform(batch[0], uniform):
+                return batch, end
+            start = end
+
+    def applyStrategy(self, index, strategy):
+        """@return the relevant draw calls, or None if the strategy does not apply"""
+        if strategy.skip_until_uniform is not None:
+            relevant_drawcalls, end = self.findBatchWithUniform(index, 0, strategy, strategy.skip_until_uniform)
         else:
-            print("Error: Could not find the beginning of the relevant 3D draw calls")
-            return [], "none"
-
-        print(f"Trying scraping strategy #{_strategy} (from draw call #{min_drawcall})...")
-        relevant_drawcalls, new_min_drawcall = self.findDrawcallBatch(
-            drawcalls[min_drawcall:],
-            first_call,
-            drawcall_prefix,
-            last_call)
-        
+            relevant_drawcalls, end = index.findBatch(0, strategy)
+
         if not relevant_drawcalls:
-            return self.extractRelevantCalls(drawcalls, _strategy=_strategy+1)
+            return None
 
-        if capture_type == "Mapy CZ" and not self.hasUniform(relevant_drawcalls[0], "_uMV"):
-            return self.extractRelevantCalls(drawcalls, _strategy=_strategy+1)
+        if strategy.required_uniform is not None and not self.hasUniform(relevant_drawcalls[0], strategy.required_uniform):
+            return None
 
-        if capture_type == "Google Earth (single)":
-            if not self.hasUniform(relevant_drawcalls[0], "_uMeshToWorldMatrix"):
-                return self.extractRelevantCalls(drawcalls, _strategy=_strategy+1)
-            else:
-                capture_type = "Google Earth"
-
-        if capture_type == "Google Earth":
+        if strategy.capture_type == "Google Earth":
             relevant_drawcalls = [
                 call for call in relevant_drawcalls
                 if self.hasUniform(call, "_uMeshToWorldMatrix")
             ]
 
-        if capture_type == "Google Maps":
+        if strategy.capture_type == "Google Maps":
             # Accumulate multiple batches
             batch_count = 1
             while True:
-                min_drawcall += new_min_drawcall
-                # Find a batch
-                first_call = "" # Try from the beginning on
-                last_call = "Draw()"
-                drawcall_prefix = "DrawIndexed"
-                while True:
-                    skipped_drawcalls, new_min_drawcall = self.findDrawcallBatch(drawcalls[min_drawcall:], first_call, drawcall_prefix, last_call)
-                    if not skipped_drawcalls or self.hasUniform(skipped_drawcalls[0], "_w"):
-                        break # Found a good draw call
-                    min_drawcall += new_min_drawcall
-
-                # Accumulate the batch
-                new_relevant_drawcalls, new_min_drawcall = self.findDrawcallBatch(
-                    drawcalls[min_drawcall:],
-                    first_call,
-                    drawcall_prefix,
-                    last_call)
-
+                new_relevant_drawcalls, end = self.findBatchWithUniform(index, end, GOOGLE_MAPS_BATCH, "_w")
                 if not new_relevant_drawcalls:
                     break
-
                 relevant_drawcalls.extend(new_relevant_drawcalls)
                 batch_count += 1
 
             print(f"Found {batch_count} batches.")
 
-        return relevant_drawcalls, capture_type
-
+        return relevant_drawcalls
 
-    def consolidateEvents(self, rootList, accumulator = []):
+    def consolidateEvents(self, rootList, accumulator=None):
+        if accumulator is None:
+            accumulator = []
         for root in rootList:
             name = root.GetName(self.controller.GetStructuredFile())
             event = root
@@ -269,110 +438,435 @@ class CaptureScraper():
 
     def run(self):
         controller = self.controller
-
-        timer = Timer()
-        drawcalls = self.consolidateEvents(controller.GetRootActions())
-        profiling_counters['consolidateEvents'].add_sample(timer)
-        
-        timer = Timer()
-        relevant_drawcalls, capture_type = self.extractRelevantCalls(drawcalls)
-        profiling_counters['extractRelevantCalls'].add_sample(timer)
+        options = self.options
+        if options.trace is not None:
+            profiler.startTrace("Extraction" if options.shard is None else f"Extraction worker {options.shard}")
+        if options.memory_profile:
+            profiler.startMemoryProfiling()
+
+        with span('consolidateEvents'):
+            drawcalls = self.consolidateEvents(controller.GetRootActions())
+
+        budget = None
+        if options.shard is not None:
+            relevant_drawcalls, capture_type = self.loadShard(drawcalls)
+            workers = []
+        else:
+            timer = Timer()
+            relevant_drawcalls, capture_type = self.extractRelevantCalls(drawcalls)
+            print(f"Found {len(relevant_drawcalls)} draw calls from {capture_type} with strategy #{self.strategy} in {timer.ellapsed()*1000.:.03f}ms")
+
+            if options.max_blocks > 0:
+                relevant_drawcalls = relevant_drawcalls[:options.max_blocks]
+            relevant_drawcalls = list(enumerate(relevant_drawcalls))
+            if self.budget.isLimited():
+                relevant_drawcalls = rankDrawcalls(relevant_drawcalls, lambda pair: pair[1].numIndices)
+                if options.workers > 1:
+                    relevant_drawcalls = self.selectDrawcalls(relevant_drawcalls)
+                else:
+                    budget = self.budget # draw calls are selected while extracted
+            if self.events is not None:
+                drawcall_ids = [drawcallId for drawcallId, _ in relevant_drawcalls]
+                self.events.emit("start", drawcall_count=len(relevant_drawcalls), drawcalls=drawcall_ids)
+            relevant_drawcalls, workers = self.startWorkers(relevant_drawcalls, capture_type)
+            kept_ids = { drawcallId for drawcallId, _ in relevant_drawcalls }
+            self.prefetched_indices = {
+                drawcallId: indices for drawcallId, indices in self.prefetched_indices.items()
+                if drawcallId in kept_ids
+            }
 
         print(f"Scraping capture from {capture_type}...")
+        with span('extractDrawcalls'):
+            self.extractDrawcalls(relevant_drawcalls, capture_type, budget)
+        if budget is not None:
+            print(f"Budget: {budget.summary()}")
+        print(f"Fetched {self.fetched_bytes / (1024 * 1024):.03f} MB of index and vertex buffers")
 
-        if MAX_BLOCKS <= 0:
-            max_drawcall = len(relevant_drawcalls)
-        else:
-            max_drawcall = min(MAX_BLOCKS, len(relevant_drawcalls))
-
-        for drawcallId, draw in enumerate(relevant_drawcalls[:max_drawcall]):
-            timer = Timer()
-            #print("Draw call: " + draw.name)
-            
+        print("Profiling counters:")
+        for line in profiler.summaryLines():
+            print(line)
+        if options.memory_profile:
+            print("Largest draw calls:")
+            for drawcall, traced in profiler.largestDrawcalls():
+                print(f" - {drawcall}: {formatBytes(traced)}")
+            print("Top allocation sites:")
+            for line in profiler.memoryLines():
+                print(line)
+
+        for worker in workers:
+            worker.waitExtracted()
+        if self.events is not None:
+            self.events.emit("end")
+        if self.shared_pack is not None:
+            # Shared memory segments are unlinked when the processes that
+            # created them exit, wait for the importer to have attached them.
+            sys.stdin.readline()
+            for worker in workers:
+                worker.release()
+            self.shared_pack.release()
+
+        for worker in workers:
+            duration = worker.join()
+            print(f"Worker {worker.shard} done in {duration:.03f}s")
+        if workers:
+            os.remove(shardsFilename(options.prefix))
+
+        self.saveManifest(capture_type, workers)
+        self.saveCounters(workers)
+        if options.trace is not None:
+            self.saveTrace(workers)
+
+    @profile()
+    def saveManifest(self, capture_type, workers):
+        """Workers write a partial manifest, that the main process merges into
+        the final one once they are all done"""
+        options = self.options
+        entries = self.drawcall_entries
+        if options.shard is None:
+            for worker in workers:
+                filename = manifestFilename(options.prefix, worker.shard)
+                if not os.path.isfile(filename):
+                    continue # the worker failed, this has been reported already
+                entries.extend(readManifest(filename)["drawcalls"])
+                os.remove(filename)
+        manifest = makeManifest(capture_type, options.max_blocks, entries, strategy=self.strategy, budget=budgetOf(options).limits())
+        writeManifest(manifestFilename(options.prefix, options.shard), manifest)
+
+    def saveCounters(self, workers):
+        """Save profiling counters for the importer to report them (see
+        profiling.py), merging the ones of the workers in the main process"""
+        options = self.options
+        if options.shard is None:
+            for worker in workers:
+                filename = profileFilename(options.prefix, worker.shard)
+                if os.path.isfile(filename):
+                    readCounters(filename, profiling_counters, memory_counters)
+                    os.remove(filename)
+        writeCounters(profileFilename(options.prefix, options.shard))
+
+    def saveTrace(self, workers):
+        """Like manifests, the main process merges the traces of the workers"""
+        events = profiler.stopTrace()
+        for worker in workers:
+            filename = workerTraceFilename(self.options.trace, worker.shard)
+            if os.path.isfile(filename):
+                events.extend(readTrace(filename))
+                os.remove(filename)
+        writeTrace(self.options.trace, events)
+
+    def startWorkers(self, relevant_drawcalls, capture_type):
+        """Split the relevant draw calls into as many contiguous shards as there
+        are workers, start a process for each shard but the first one, which is
+        left to this process.
+        @return the draw calls of the first shard and the started workers"""
+        options = self.options
+        worker_count = max(1, min(options.workers, len(relevant_drawcalls)))
+        if worker_count == 1:
+            return relevant_drawcalls, []
+
+        shard_size = (len(relevant_drawcalls) + worker_count - 1) // worker_count
+        shards = [
+            relevant_drawcalls[i:i + shard_size]
+            for i in range(0, len(relevant_drawcalls), shard_size)
+        ]
+        with open(shardsFilename(options.prefix), 'w') as file:
+            json.dump({
+                "capture_type": capture_type,
+                "shards": [[(drawcallId, draw.eventId) for drawcallId, draw in shard] for shard in shards],
+            }, file)
+
+        print(f"Splitting {len(relevant_drawcalls)} draw calls across {len(shards)} workers...")
+        workers = [WorkerProcess(options, shard, self.events) for shard in range(1, len(shards))]
+        return shards[0], workers
+
+    @profile()
+    def selectDrawcalls(self, ranked_drawcalls):
+        """Keep the largest draw calls that fit in the budget before splitting
+        them across workers, see budget.py. Draw calls are replayed and their
+        indices fetched by decreasing index count, until the budget is
+        exhausted. The indices of the kept draw calls are not fetched again by
+        this process, but workers fetch again those of their shard.
+        @param ranked_drawcalls: (drawcallId, draw) pairs, see rankDrawcalls
+        @return the kept (drawcallId, draw) pairs, in the order of the capture"""
+        controller = self.controller
+        smallest = ranked_drawcalls[-1][1].numIndices if ranked_drawcalls else 0
+        topology = None
+        kept = []
+        for drawcallId, draw in ranked_drawcalls:
+            if topology is not None and self.budget.isExhausted(topology, smallest):
+                break
             controller.SetFrameEvent(draw.eventId, True)
             state = controller.GetPipelineState()
-
-            ib = state.GetIBuffer()
-            vbs = state.GetVBuffers()
-            attrs = state.GetVertexInputs()
-            meshes = [makeMeshData(attr, ib, vbs, draw) for attr in attrs]
-
+            topology = primitiveTopology(state)
             try:
-                # Position
-                m = meshes[0]
-                #m.fetchTriangle(controller)
-                indices = m.fetchIndices(controller)
-                with open("{}{:05d}-indices.bin".format(FILEPREFIX, drawcallId), 'wb') as file:
-                    numpySave(indices, file)
-
-                subtimer = Timer()
-                unpacked = m.fetchData(controller)
-                with open("{}{:05d}-positions.bin".format(FILEPREFIX, drawcallId), 'wb') as file:
-                    numpySave(unpacked, file)
-
-                # UV
-                if len(meshes) < 2:
+                attrs = state.GetVertexInputs()
+                if len(attrs) < 2:
                     raise Exception("No UV data")
-                m = meshes[2 if capture_type == "Google Earth" else 1]
-                #m.fetchTriangle(controller)
-                unpacked = m.fetchData(controller)
-                with open("{}{:05d}-uv.bin".format(FILEPREFIX, drawcallId), 'wb') as file:
-                    numpySave(unpacked, file)
+                mesh = makeMeshData(attrs[0], state.GetIBuffer(), state.GetVBuffers(), draw)
+                indices = mesh.fetchIndices(controller)
             except Exception as err:
-                print("(Skipping because of error: {})".format(err))
+                print("(Leaving out draw call {} because of error: {})".format(drawcallId, err))
                 continue
+            self.fetched_bytes += len(indices) * mesh.indexByteStride
+            if self.budget.tryAdd(*self.drawcallSize(state, indices)):
+                kept.append((drawcallId, draw))
+                self.prefetched_indices[drawcallId] = indices
+
+        print(f"Keeping {len(kept)} of {len(ranked_drawcalls)} draw calls, {self.budget.summary()}")
+        return sorted(kept, key=lambda pair: pair[0])
+
+    def drawcallSize(self, state, indices):
+        """@return the arguments of ImportBudget.fits() for a draw call"""
+        # Only the range of vertices referenced by the indices is extracted, see DrawBuffers
+        vertex_count = int(indices.max()) - int(indices.min()) + 1 if len(indices) > 0 else 0
+        rid, texture_filename = self.findTexture(state)
+        return (
+            triangleCount(primitiveTopology(state), indices),
+            vertex_count,
+            texture_filename,
+            self.textureBytes(rid)
+        )
+
+    def loadShard(self, drawcalls):
+        """Get back the draw calls assigned to this worker by startWorkers()"""
+        with open(shardsFilename(self.options.prefix), 'r') as file:
+            shards = json.load(file)
+        draws_by_event = { draw.eventId: draw for draw in drawcalls }
+        shard = [
+            (drawcallId, draws_by_event[eventId])
+            for drawcallId, eventId in shards["shards"][self.options.shard]
+        ]
+        return shard, shards["capture_type"]
+
+    def extractDrawcalls(self, relevant_drawcalls, capture_type, budget=None):
+        """Extract the data of a list of (drawcallId, draw) pairs into this
+        process' pack file, and textures next to it
+        @param budget: ImportBudget to select draw calls while extracting them,
+        in which case they are ranked by rankDrawcalls and extraction stops
+        once the budget is exhausted, see budget.py"""
+        controller = self.controller
+        smallest = relevant_drawcalls[-1][1].numIndices if relevant_drawcalls else 0
+        topology = None
+        if self.options.transport == 'shm':
+            pack_filename = None
+            pack = self.shared_pack = SharedPackWriter()
+        else:
+            pack_filename = packFilename(self.options.prefix, self.options.shard or 0)
+            pack = PackWriter(pack_filename)
+
+        with pack, ThreadPoolExecutor(TEXTURE_POOL_SIZE) as texture_pool:
+            self.texture_pool = texture_pool
+            for i, (drawcallId, draw) in enumerate(relevant_drawcalls):
+                if budget is not None and topology is not None and budget.isExhausted(topology, smallest):
+                    print(f"Budget exhausted, leaving out {len(relevant_drawcalls) - i} draw calls")
+                    for left_out_id, _ in relevant_drawcalls[i:]:
+                        self.skipDrawcall(left_out_id)
+                    break
 
-            # Vertex Shader Constants
-            shader = state.GetShader(rd.ShaderStage.Vertex)
-            ep = state.GetShaderEntryPoint(rd.ShaderStage.Vertex)
-            ref = state.GetShaderReflection(rd.ShaderStage.Vertex)
-            constants = self.getVertexShaderConstants(draw, state=state)
-            constants["DrawCall"] = {
-                "topology": 'TRIANGLE_STRIP' if state.GetPrimitiveTopology() == rd.Topology.TriangleStrip else 'TRIANGLES',
-                "type": capture_type
-            }
-            with open("{}{:05d}-constants.bin".format(FILEPREFIX, drawcallId), 'wb') as file:
-                pickle.dump(constants, file)
-
-            subtimer = Timer()
-            self.extractTexture(drawcallId, state)
-            profiling_counters['extractTexture'].add_sample(subtimer)
+                with span('processDrawEvent', drawcall=drawcallId):
+                    #print("Draw call: " + draw.name)
+
+                    controller.SetFrameEvent(draw.eventId, True)
+                    state = controller.GetPipelineState()
+                    topology = primitiveTopology(state)
+
+                    ib = state.GetIBuffer()
+                    vbs = state.GetVBuffers()
+                    attrs = state.GetVertexInputs()
+                    meshes = [makeMeshData(attr, ib, vbs, draw) for attr in attrs]
+
+                    try:
+                        with span('fetchBuffers'):
+                            buffers = DrawBuffers(controller, meshes[0], self.prefetched_indices.pop(drawcallId, None))
+                            indices = buffers.indices
+
+                            # Vertex data is not fetched for draw calls left out
+                            size = self.drawcallSize(state, indices) if budget is not None else None
+                            left_out = size is not None and not budget.fits(*size)
+                            if not left_out:
+                                # Position
+                                positions = buffers.fetchData(meshes[0])
+
+                                # UV
+                                if len(meshes) < 2:
+                                    raise Exception("No UV data")
+                                uvs = buffers.fetchData(meshes[2 if capture_type == "Google Earth" else 1])
+                        self.fetched_bytes += buffers.fetched_bytes
+                    except Exception as err:
+                        print("(Skipping because of error: {})".format(err))
+                        self.skipDrawcall(drawcallId)
+                        continue
 
-            profiling_counters['processDrawEvent'].add_sample(timer)
+                    if left_out:
+                        self.skipDrawcall(drawcallId)
+                        continue
+                    if size is not None:
+                        budget.add(*size)
+
+                    triangle_count = triangleCount(topology, indices)
+
+                    # Vertex Shader Constants
+                    constants = self.getVertexShaderConstants(draw, state=state)
+                    constants["DrawCall"] = {
+                        "topology": topology,
+                        "type": capture_type
+                    }
+
+                    arrays = {
+                        "indices": indices,
+                        "positions": positions,
+                        "uv": uvs,
+                    }
+                    draw_record = pack.addDraw(drawcallId, arrays, constants)
+
+                    with span('extractTexture'):
+                        texture_filename = self.extractTexture(drawcallId, state)
+
+                    entry = makeDrawcallEntry(
+                        drawcallId,
+                        pack_filename,
+                        topology,
+                        arrays,
+                        texture_filename,
+                        self.texture_bytes.get(texture_filename, 0),
+                        triangle_count
+                    )
+                    self.drawcall_entries.append(entry)
+
+                    if self.events is not None:
+                        pack.flush()
+                        self.announceDrawcall(entry, draw_record, texture_filename)
+
+        # Raise errors that occurred in the texture pool, if any. Leaving the
+        # pool waited for its threads, so all draw calls have been announced.
+        for future in self.texture_futures.values():
+            future.result()
+
+    def announceDrawcall(self, entry, draw_record, texture_filename):
+        """Tell the importer that a draw call can be imported, which is only
+        once its texture is written when it is done in the texture pool"""
+        def emit(*_):
+            self.events.emit("drawcall", entry=entry, draw=draw_record)
+        future = self.texture_futures.get(texture_filename)
+        if future is not None:
+            future.add_done_callback(emit)
+        else:
+            emit()
 
-        print("Profiling counters:")
-        for key, counter in profiling_counters.items():
-            print(f" - {key}: {counter.summary()}")
+    def skipDrawcall(self, drawcallId):
+        """Tell the importer that a draw call will not be announced, so that
+        it does not wait for it"""
+        if self.events is not None:
+            self.events.emit("skipped", drawcall=drawcallId)
 
-    def extractTexture(self, drawcallId, state):
-        """Save the texture in a png file (A bit dirty)"""
+    def findTexture(self, state):
+        """@return the resource id of the texture of a draw call and the name
+        of the file it is saved to, or (None, None) if there is no texture"""
         bindpoints = state.GetBindpointMapping(rd.ShaderStage.Fragment)
         if not bindpoints.samplers:
-            print(f"Warning: No texture found for drawcall {drawcallId}")
-            return
+            return None, None
         texture_bind = bindpoints.samplers[-1].bind
         resources = state.GetReadOnlyResources(rd.ShaderStage.Fragment)
         rid = resources[texture_bind].resources[0].resourceId
-    
+
+        description = self.getTextureDescription(rid)
+        use_raw = self.options.texture_format != 'png' and isRawCompatible(description)
+        extension = RAW_TEXTURE_EXTENSION if use_raw else ".png"
+        return rid, "{}texture-{}{}".format(self.options.prefix, resourceKey(rid), extension)
+
+    def textureBytes(self, rid):
+        """@return the size of the texels of the extracted mip of a texture, 0 if unknown"""
+        description = self.getTextureDescription(rid) if rid is not None else None
+        if description is None:
+            return 0
+        mip = self.chooseMip(description)
+        return max(1, description.width >> mip) * max(1, description.height >> mip) * 4
+
+    def extractTexture(self, drawcallId, state):
+        """Save the texture in a png file (A bit dirty). Draw calls often share
+        the same texture, so each texture resource is only saved once.
+        @return the name of the file, or None if there is no texture"""
+        rid, filename = self.findTexture(state)
+        if rid is None:
+            print(f"Warning: No texture found for drawcall {drawcallId}")
+            return None
+        self.texture_bytes[filename] = self.textureBytes(rid)
+        description = self.getTextureDescription(rid)
+        use_raw = filename.endswith(RAW_TEXTURE_EXTENSION)
+        if filename in self.saved_textures or os.path.isfile(filename):
+            # Already saved, either by this process or by another worker
+            self.saved_textures.add(filename)
+            return filename
+
+        # Workers may save the same texture at the same time, so they write to
+        # a file of their own that is then atomically renamed.
+        tmp_filename = "{}.{}.tmp".format(filename, self.options.shard or 0)
+        self.saved_textures.add(filename)
+
+        mip = self.chooseMip(description)
+        if use_raw:
+            with span("GetTextureData"):
+                data = self.controller.GetTextureData(rid, rd.Subresource(mip, 0, 0))
+            # Writing, and compressing if requested, overlaps with the replay of next draw calls
+            self.texture_futures[filename] = self.texture_pool.submit(
+                self.writeRawTexture,
+                filename, tmp_filename, data, description, mip
+            )
+            return filename
+
         texsave = rd.TextureSave()
         texsave.resourceId = rid
-        texsave.mip = 0
+        texsave.mip = mip
         texsave.slice.sliceIndex = 0
         texsave.alpha = rd.AlphaMapping.Preserve
         texsave.destType = rd.FileType.PNG
-        timer = Timer()
-        controller.SaveTexture(texsave, "{}{:05d}-texture.png".format(FILEPREFIX, drawcallId))
-        profiling_counters["SaveTexture"].add_sample(timer)
-
-def main(controller):
-    scraper = CaptureScraper(controller)
+        with span("SaveTexture"):
+            self.controller.SaveTexture(texsave, tmp_filename)
+            os.replace(tmp_filename, filename)
+        return filename
+
+    def writeRawTexture(self, filename, tmp_filename, data, description, mip):
+        """Run in the texture pool"""
+        with span("writeRawTexture"):
+            writeRawTexture(
+                tmp_filename,
+                data,
+                max(1, description.width >> mip),
+                max(1, description.height >> mip),
+                bgra=description.format.BGRAOrder(),
+                compress=self.options.texture_format == 'raw-zlib'
+            )
+            os.replace(tmp_filename, filename)
+
+    def chooseMip(self, description):
+        """Mip level to extract according to the texture quality options, the
+        matching mip is fetched rather than downscaling the full texture
+        @return 0 if the texture description is unknown"""
+        if description is None:
+            return 0
+        mip = self.options.texture_mip
+        max_size = self.options.texture_max_size
+        if max_size > 0:
+            while max(description.width, description.height) >> mip > max_size:
+                mip += 1
+        return max(0, min(mip, description.mips - 1))
+
+    def getTextureDescription(self, rid):
+        if self.texture_descriptions is None:
+            self.texture_descriptions = { tex.resourceId: tex for tex in self.controller.GetTextures() }
+        return self.texture_descriptions.get(rid)
+
+
+def main(controller, options):
+    events = EventStream.redirectStdout() if options.stream else None
+    scraper = CaptureScraper(controller, options, events)
     scraper.run()
 
 if __name__ == "__main__":
+    options = parseArgs(sys.argv[1:])
     if 'pyrenderdoc' in globals():
-        pyrenderdoc.Replay().BlockInvoke(main)
+        pyrenderdoc.Replay().BlockInvoke(lambda controller: main(controller, options))
     else:
-        print("Loading capture from {}...".format(CAPTURE_FILE))
-        with CaptureWrapper(CAPTURE_FILE) as controller:
-            main(controller)
-    
+        print("Loading capture from {}...".format(options.capture_file))
+        with CaptureWrapper(options.capture_file) as controller:
+            main(controller, options)
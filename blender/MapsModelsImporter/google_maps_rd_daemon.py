@@ -0,0 +1,89 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+"""Extraction daemon, keeping the renderdoc module loaded to run extraction
+jobs one after the other, so that imports do not wait for a new extraction
+process to start (see daemon.py for the Blender side).
+A job is a line of JSON on the standard input, {"args": [...]} with the
+command line arguments of google_maps_rd.py. Events (see protocol.py) are
+written to the standard output:
+ - "ready" once the daemon can run jobs,
+ - the events of the job itself when it runs in streaming mode,
+ - "job_done" with the "returncode" the job would have exited with and its
+   "output", what it printed.
+The daemon exits at the end of its standard input.
+"""
+
+import io
+import sys
+import json
+import traceback
+from contextlib import redirect_stdout
+
+from protocol import EventStream
+
+# Exits with the return codes of google_maps_rd.py if renderdoc fails to load
+from google_maps_rd import CaptureScraper, parseArgs
+from rdutils import CaptureWrapper
+from profiling import profiler
+
+def runJob(args, events):
+    """Run google_maps_rd.py with the given command line arguments
+    @return its return code"""
+    scraper = None
+    try:
+        options = parseArgs(args)
+        print("Loading capture from {}...".format(options.capture_file))
+        with CaptureWrapper(options.capture_file) as controller:
+            scraper = CaptureScraper(controller, options, events if options.stream else None)
+            scraper.run()
+        return 0
+    except SystemExit as err:
+        return err.code if isinstance(err.code, int) else 1
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        return 1
+    finally:
+        # Segments of a failed job would otherwise live as long as the daemon
+        if scraper is not None and scraper.shared_pack is not None:
+            scraper.shared_pack.release()
+
+def serve(events):
+    events.emit("ready")
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        try:
+            job = json.loads(line)
+        except ValueError:
+            continue # e.g. the release line of a failed job
+        profiler.reset()
+        output = io.StringIO()
+        with redirect_stdout(output):
+            returncode = runJob(job["args"], events)
+        profiler.stopMemoryProfiling() # do not keep tracing allocations while idle
+        events.emit("job_done", returncode=returncode, output=output.getvalue())
+
+if __name__ == "__main__":
+    serve(EventStream(sys.stdout))
@@ -0,0 +1,90 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+# no bpy nor renderdoc here, this is used on both sides of the extraction
+
+"""The manifest lists the draw calls that were successfully extracted, in which
+pack file their arrays are and how large they are, so that the importer knows
+exactly what to load without looking at the directory."""
+
+import os
+import json
+
+MANIFEST_VERSION = 1
+
+# -----------------------------------------------------------------------------
+
+def manifestFilename(prefix, shard=None):
+    """The main extraction process writes the manifest, workers write a
+    partial one that is merged into it"""
+    if shard is None:
+        return "{}manifest.json".format(prefix)
+    else:
+        return "{}manifest-{:02d}.json".format(prefix, shard)
+
+def makeDrawcallEntry(drawcall_id, pack_filename, topology, arrays, texture_filename, texture_bytes=0, triangle_count=0):
+    """Describe an extracted draw call, file names are relative to the
+    directory of the manifest. There is no pack file when arrays are
+    transferred through shared memory.
+    @param texture_bytes: size of the texels of the texture, see budget.py
+    @param triangle_count: number of triangles once imported, see budget.py"""
+    return {
+        "id": drawcall_id,
+        "pack": os.path.basename(pack_filename) if pack_filename is not None else None,
+        "topology": topology,
+        "index_count": len(arrays["indices"]),
+        "triangle_count": triangle_count,
+        "vertex_count": len(arrays["positions"]),
+        "byte_size": sum(array.nbytes for array in arrays.values()),
+        "texture": os.path.basename(texture_filename) if texture_filename is not None else None,
+        "texture_bytes": texture_bytes,
+    }
+
+def makeManifest(capture_type, max_blocks, drawcalls, strategy=None, budget=None):
+    """@param budget: limits of the budget of the extraction, see budget.py"""
+    drawcalls = sorted(drawcalls, key=lambda entry: entry["id"])
+    return {
+        "version": MANIFEST_VERSION,
+        "capture_type": capture_type,
+        "strategy": strategy,
+        "max_blocks": max_blocks,
+        "budget": budget,
+        "drawcalls": drawcalls,
+        "totals": {
+            "drawcalls": len(drawcalls),
+            "indices": sum(entry["index_count"] for entry in drawcalls),
+            "vertices": sum(entry["vertex_count"] for entry in drawcalls),
+            "byte_size": sum(entry["byte_size"] for entry in drawcalls),
+            "textures": sum(entry["texture"] is not None for entry in drawcalls),
+        },
+    }
+
+# -----------------------------------------------------------------------------
+
+def writeManifest(filename, manifest):
+    with open(filename, 'w') as file:
+        json.dump(manifest, file, indent=1)
+
+def readManifest(filename):
+    with open(filename, 'r') as file:
+        return json.load(file)
@@ -68,7 +68,13 @@ def unpackData(fmt, data):
 
     return value
 
-def unpackDataNumpy(fmt, data, stride=None, count=-1):
+def unpackDataNumpy(fmt, data, stride=None, count=-1, offset=0):
+    """Decode count attribute values from raw buffer data, starting at offset
+    and separated by stride bytes. Components are read through a strided view
+    of the buffer, so no copy is made unless the values need normalization or
+    reordering, in which case they are written to a single output array.
+    Raises ValueError if the data does not reach the last value.
+    @return an array of shape (count, fmt.compCount)"""
     compType = {
         rd.CompType.UInt:    'u',
         rd.CompType.SInt:    'i',
@@ -79,43 +85,53 @@ def unpackDataNumpy(fmt, data, stride=None, count=-1):
         rd.CompType.SScaled: 'i',
         #rd.CompType.Double:  'f',
     }[fmt.compType]
-    data_field = ('data', f"{fmt.compCount}{compType}{fmt.compByteWidth}")
-
-    dtype = np.dtype([data_field])
-    if stride is not None:
-        missing = stride - dtype.itemsize
-        if missing > 0:
-            dtype = np.dtype([data_field, ('align', f"{missing}u1")])
-            #data = np.array(data).reshape((-1, stride))
-            #data = data[:,:dtype.itemsize].reshape(-1)
-            data = data + b'\x00' * missing
-
-    try:
-        decoded = np.frombuffer(data, dtype, count=count)['data']
-    except ValueError as err:
-        print(err)
-        print(data)
-        print(f"len(data) = {len(data)}")
-        print(f"dtype = {dtype}")
-        print(f"dtype.itemsize = {dtype.itemsize}")
-        print(f"stride = {stride}")
-        print(f"count = {count}")
-    #decoded = decoded.reshape((-1, fmt.compCount))
+    comp_dtype = np.dtype(f"<{compType}{fmt.compByteWidth}")
+    item_size = fmt.compCount * fmt.compByteWidth
+    if not stride:
+        stride = item_size
+    if count < 0:
+        count = max(0, (len(data) - offset - item_size) // stride + 1)
+
+    required_size = offset + (count - 1) * stride + item_size if count > 0 else 0
+    if len(data) < required_size:
+        if count > 0 and len(data) <= offset + (count - 1) * stride:
+            raise ValueError(f"Vertex buffer too short: {len(data)} bytes for {count} vertices of stride {stride} at offset {offset}")
+        # Only the last value is truncated, pad it (this copies the buffer)
+        data = bytes(data) + b'\x00' * (required_size - len(data))
+
+    view = np.ndarray(
+        shape=(count, fmt.compCount),
+        dtype=comp_dtype,
+        buffer=data,
+        offset=offset if count > 0 else 0,
+        strides=(stride, fmt.compByteWidth)
+    )
+
+    # Reorder BGRA components with slices of the view rather than fancy indexing
+    if fmt.BGRAOrder():
+        parts = [(view[:,2::-1], slice(0, 3)), (view[:,3:], slice(3, None))]
+    else:
+        parts = [(view, slice(None))]
 
     # Post process
     if fmt.compType == rd.CompType.UNorm:
-        divisor = float((1 << (fmt.compByteWidth * 8)) - 1)
-        decoded = decoded.astype('f') / divisor
+        divisor = np.float32((1 << (fmt.compByteWidth * 8)) - 1)
+        decoded = np.empty(view.shape, dtype=np.float32)
+        for source, columns in parts:
+            np.divide(source, divisor, out=decoded[:,columns], dtype=np.float32)
     elif fmt.compType == rd.CompType.SNorm:
         maxNeg = -(1 << (fmt.compByteWidth * 8 - 1))
-        divisor = float(-(maxNeg-1))
-
-        mask = decoded != maxNeg
-        decoded = decoded.astype('f')
-        decoded[mask] /= divisor
-    if fmt.BGRAOrder():
-        # If the format is BGRA, swap the two components
-        decoded = decoded[:,[2, 1, 0, 3]]
+        divisor = np.float32(-(maxNeg-1))
+        decoded = np.empty(view.shape, dtype=np.float32)
+        for source, columns in parts:
+            decoded[:,columns] = source
+            np.divide(decoded[:,columns], divisor, out=decoded[:,columns], where=source != maxNeg)
+    elif fmt.BGRAOrder():
+        decoded = np.empty(view.shape, dtype=comp_dtype)
+        for source, columns in parts:
+            decoded[:,columns] = source
+    else:
+        decoded = view
 
     return decoded
 
@@ -143,6 +159,8 @@ class MeshData(rd.MeshFormat):
 
         # The total offset is the attribute offset from the base of the vertex
         mesh.vertexByteOffset = attr.byteOffset + vbs[attr.vertexBuffer].byteOffset
+        mesh.vertexBufferByteOffset = vbs[attr.vertexBuffer].byteOffset
+        mesh.attributeByteOffset = attr.byteOffset
         mesh.format = attr.format
         mesh.vertexResourceId = vbs[attr.vertexBuffer].resourceId
         mesh.vertexByteStride = vbs[attr.vertexBuffer].byteStride
@@ -151,25 +169,28 @@ class MeshData(rd.MeshFormat):
     def fetchIndices(mesh, controller):
         # If indexed draw call
         if mesh.indexResourceId != rd.ResourceId.Null():
-            # struct-style format string
-            ibdata = controller.GetBufferData(mesh.indexResourceId, mesh.indexByteOffset, 0)
-            offset = mesh.indexOffset * mesh.indexByteStride
+            # Only fetch the part of the index buffer used by the draw call
+            offset = mesh.indexByteOffset + mesh.indexOffset * mesh.indexByteStride
+            ibdata = controller.GetBufferData(mesh.indexResourceId, offset, mesh.numIndices * mesh.indexByteStride)
 
             dtype = np.dtype(f"u{mesh.indexByteStride}")
-            indices = np.frombuffer(ibdata, dtype=dtype, count=mesh.numIndices, offset=offset) + mesh.baseVertex
+            indices = np.frombuffer(ibdata, dtype=dtype, count=mesh.numIndices).astype(np.int64) + mesh.baseVertex
         else:
-            indices = np.range(mesh.baseVertex, mesh.baseVertex + mesh.numIndices)
+            indices = np.arange(mesh.baseVertex, mesh.baseVertex + mesh.numIndices)
 
         return indices
 
-    def fetchData(mesh, controller):
-        indices = mesh.fetchIndices(controller)
+    def fetchData(mesh, controller, indices=None):
+        """Decode the attribute for vertices 0 to max(indices), see DrawBuffers
+        for only fetching the range of vertices actually used"""
+        if indices is None:
+            indices = mesh.fetchIndices(controller)
 
         if len(indices) == 0:
             return []
-        data = controller.GetBufferData(mesh.vertexResourceId, mesh.vertexByteOffset, 0)
+        maxi = int(indices.max()) + 1
+        data = controller.GetBufferData(mesh.vertexResourceId, mesh.vertexByteOffset, maxi * mesh.vertexByteStride)
 
-        maxi = max(indices) + 1
         unpacked = unpackDataNumpy(mesh.format, data, stride=mesh.vertexByteStride, count=maxi)
 
         return unpacked
@@ -182,6 +203,58 @@ class MeshData(rd.MeshFormat):
 
 # -----------------------------------------------------------------------------
 
+class DrawBuffers():
+    """Buffer fetching layer for a single draw call: the index buffer is read
+    once, then only the range of vertices it references is read, once per
+    vertex buffer, so that interleaved attributes share the same read."""
+    def __init__(self, controller, mesh, indices=None):
+        """@param mesh: any MeshData of the draw call, they all share the same indices
+        @param indices: result of mesh.fetchIndices() if it was already called,
+        these bytes are then not counted in fetched_bytes"""
+        self.controller = controller
+        self.vertex_data = {} # (resource, offset, stride) -> (requested size, bytes)
+        self.fetched_bytes = 0
+
+        if indices is None:
+            indices = mesh.fetchIndices(controller)
+            self.fetched_bytes += len(indices) * mesh.indexByteStride
+        if len(indices) > 0:
+            self.first_vertex = int(indices.min())
+            self.vertex_count = int(indices.max()) - self.first_vertex + 1
+        else:
+            self.first_vertex = 0
+            self.vertex_count = 0
+        # Indices are made relative to the first referenced vertex
+        self.indices = (indices - self.first_vertex).astype(np.uint32)
+
+    def fetchData(self, mesh):
+        """Decode an attribute for the vertices referenced by self.indices"""
+        item_size = mesh.format.compCount * mesh.format.compByteWidth
+        stride = mesh.vertexByteStride
+        if stride == 0:
+            # Tightly packed attribute
+            stride = item_size
+        key = (mesh.vertexResourceId, mesh.vertexBufferByteOffset, stride)
+        # Interleaved attributes fit in the stride and share the same read,
+        # others (e.g. planar layouts) need to read beyond the last stride
+        size = max(
+            self.vertex_count * stride,
+            mesh.attributeByteOffset + (self.vertex_count - 1) * stride + item_size
+        ) if self.vertex_count > 0 else 0
+        if key not in self.vertex_data or self.vertex_data[key][0] < size:
+            data = self.controller.GetBufferData(
+                mesh.vertexResourceId,
+                mesh.vertexBufferByteOffset + self.first_vertex * stride,
+                size
+            ) if size > 0 else b''
+            self.fetched_bytes += len(data)
+            self.vertex_data[key] = (size, data)
+        _, data = self.vertex_data[key]
+
+        return unpackDataNumpy(mesh.format, data, stride=stride, count=self.vertex_count, offset=mesh.attributeByteOffset)
+
+# -----------------------------------------------------------------------------
+
 def makeMeshData(attr, ib, vbs, draw):
     """For some reason, it crashes when MeshData.build() is
     MeshData.__init__() so this wrapper works this around"""
@@ -23,11 +23,16 @@
 
 import bpy
 from bpy_extras.io_utils import ImportHelper
-from bpy.props import StringProperty, IntProperty, BoolProperty
+from bpy.props import StringProperty, IntProperty, BoolProperty, EnumProperty, FloatProperty
 from bpy.types import Operator
 
-from .google_maps import importCapture, MapsModelsImportError
+from .google_maps import importCapture, startCaptureImport, MapsModelsImportError
 from .preferences import getPreferences
+from .cache import getCache
+from .budget import ImportBudget
+
+MODAL_TIMER_STEP = 0.02 # seconds between two steps of a non-blocking import
+MODAL_TIME_BUDGET = 0.05 # maximum duration of a step, for the UI to remain responsive
 
 class IMP_OP_GoogleMapsCapture(Operator, ImportHelper):
     """Import a capture of a Google Maps frame recorded with RenderDoc"""
@@ -48,16 +53,137 @@ class IMP_OP_GoogleMapsCapture(Operator, ImportHelper):
         default=-1,
     )
 
+    max_triangles: IntProperty(
+        name="Max Triangles",
+        description="Triangle budget of the import, the most detailed draw calls that fit are imported (0 for no limit). Draw calls are extracted by decreasing index count until the budget is exhausted",
+        default=0,
+        min=0,
+    )
+
+    max_vertices: IntProperty(
+        name="Max Vertices",
+        description="Vertex budget of the import, the most detailed draw calls that fit are imported (0 for no limit). Draw calls are extracted by decreasing index count until the budget is exhausted",
+        default=0,
+        min=0,
+    )
+
+    max_texture_memory: IntProperty(
+        name="Max Texture Memory (MB)",
+        description="Budget of texture memory of the import, once decoded (0 for no limit). Draw calls are extracted by decreasing index count until the budget is exhausted",
+        default=0,
+        min=0,
+    )
+
     use_experimental: BoolProperty(
         name="Experimental",
         description="Use the new experimental way of extracting draw calls.",
         default=False,
     )
 
-    def execute(self, context):
+    texture_format: EnumProperty(
+        name="Textures",
+        description="How textures are transferred from the capture to Blender",
+        items=[
+            ('PNG', "PNG", "Encode textures as PNG files, slower to extract"),
+            ('RAW', "Raw", "Dump raw texels, faster to extract, images are then packed in the blend file"),
+            ('RAW_ZLIB', "Raw (compressed)", "Dump raw texels with fast compression, for less disk usage"),
+        ],
+        default='PNG',
+    )
+
+    texture_quality: EnumProperty(
+        name="Texture Quality",
+        description="Resolution of the extracted textures, lower ones are faster to import and use less memory",
+        items=[
+            ('FULL', "Full", "Full resolution textures"),
+            ('MIP', "Mip Level", "Extract the given mip level of each texture"),
+            ('MAX_SIZE', "Max Size", "Extract the largest mip level that fits in the given size"),
+        ],
+        default='FULL',
+    )
+
+    texture_mip: IntProperty(
+        name="Mip Level",
+        description="Mip level of the textures, each level halves the resolution",
+        default=1,
+        min=0,
+        soft_max=8,
+    )
+
+    texture_max_size: IntProperty(
+        name="Max Size",
+        description="Maximum width and height of the textures, in pixels",
+        default=256,
+        min=1,
+        subtype='PIXEL',
+    )
+
+    merge_mode: EnumProperty(
+        name="Merge",
+        description="Merge draw calls into fewer objects, which are much faster to handle in large scenes",
+        items=[
+            ('NONE', "None", "One object per draw call"),
+            ('TEXTURE', "By Texture", "One object per texture"),
+            ('GRID', "By Grid Cell", "One object per cell of a regular grid, using one material slot per texture"),
+        ],
+        default='NONE',
+    )
+
+    grid_size: FloatProperty(
+        name="Grid Size",
+        description="Size of the grid cells when merging by grid cell",
+        default=100.0,
+        min=0.001,
+        subtype='DISTANCE',
+    )
+
+    use_modal: BoolProperty(
+        name="Non-blocking",
+        description="Import in the background while Blender remains responsive, showing progress. Press Esc to cancel, keeping what was imported so far. The extraction is then always streamed, whatever the preferences",
+        default=False,
+    )
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "use_modal")
+        layout.prop(self, "max_blocks")
+        layout.prop(self, "max_triangles")
+        layout.prop(self, "max_vertices")
+        layout.prop(self, "max_texture_memory")
+        layout.prop(self, "use_experimental")
+        layout.prop(self, "texture_format")
+        layout.prop(self, "texture_quality")
+        if self.texture_quality == 'MIP':
+            layout.prop(self, "texture_mip")
+        elif self.texture_quality == 'MAX_SIZE':
+            layout.prop(self, "texture_max_size")
+        layout.prop(self, "merge_mode")
+        if self.merge_mode == 'GRID':
+            layout.prop(self, "grid_size")
+
+    def importArgs(self, context):
         pref = getPreferences(context)
+        texture_mip = self.texture_mip if self.texture_quality == 'MIP' else 0
+        texture_max_size = self.texture_max_size if self.texture_quality == 'MAX_SIZE' else 0
+        budget = ImportBudget(self.max_triangles, self.max_vertices, self.max_texture_memory * 1024 * 1024)
+        return (
+            context, self.filepath, self.max_blocks, self.use_experimental, pref,
+            self.texture_format, texture_mip, texture_max_size,
+            self.merge_mode, self.grid_size, budget
+        )
+
+    def invoke(self, context, event):
+        # Only imports started from the file browser may run in the background,
+        # scripts expect the import to be done once the operator returns
+        self.from_file_browser = True
+        return ImportHelper.invoke(self, context, event)
+
+    def execute(self, context):
+        from_file_browser = getattr(self, "from_file_browser", False)
+        if self.use_modal and from_file_browser and context.window is not None and not bpy.app.background:
+            return self.startModal(context)
         try:
-            importCapture(context, self.filepath, self.max_blocks, self.use_experimental, pref)
+            importCapture(*self.importArgs(context))
             error = None
         except MapsModelsImportError as err:
             error = err.args[0]
@@ -65,6 +191,70 @@ class IMP_OP_GoogleMapsCapture(Operator, ImportHelper):
             self.report({'ERROR'}, error)
         return {'FINISHED'}
 
+    def startModal(self, context):
+        try:
+            self.task = startCaptureImport(*self.importArgs(context))
+        except MapsModelsImportError as err:
+            self.report({'ERROR'}, err.args[0])
+            return {'CANCELLED'}
+        wm = context.window_manager
+        self.timer = wm.event_timer_add(MODAL_TIMER_STEP, window=context.window)
+        wm.modal_handler_add(self)
+        wm.progress_begin(0, 100)
+        self.updateProgress(context)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self.task.cancel()
+            self.endModal(context)
+            self.report({'WARNING'}, f"Import cancelled, {self.task.imported_count} draw calls were imported")
+            return {'FINISHED'} # what was imported is kept
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        try:
+            done = self.task.step(MODAL_TIME_BUDGET)
+        except MapsModelsImportError as err:
+            self.endModal(context)
+            self.report({'ERROR'}, err.args[0])
+            return {'FINISHED'}
+        except Exception:
+            self.endModal(context)
+            raise
+
+        if done:
+            self.endModal(context)
+            return {'FINISHED'}
+        self.updateProgress(context)
+        return {'RUNNING_MODAL'}
+
+    def updateProgress(self, context):
+        task = self.task
+        context.window_manager.progress_update(int(100 * task.progress()))
+        total = "?" if task.drawcall_count is None else task.drawcall_count
+        context.workspace.status_text_set(f"Importing capture: {task.imported_count}/{total} draw calls (Esc to cancel)")
+
+    def endModal(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+
+class IMP_OP_ClearExtractionCache(Operator):
+    """Remove all the captures kept in the extraction cache"""
+    bl_idname = "import_rdc.clear_cache"
+    bl_label = "Clear Cache"
+
+    def execute(self, context):
+        cache = getCache(getPreferences(context))
+        size = cache.size()
+        cache.clear()
+        self.report({'INFO'}, f"Removed {size / (1024 * 1024):.1f} MB of cached captures")
+        return {'FINISHED'}
+
 
 def menu_func_import(self, context):
     self.layout.operator(IMP_OP_GoogleMapsCapture.bl_idname, text="Google Maps Capture (.rdc)")
@@ -72,9 +262,11 @@ def menu_func_import(self, context):
 
 def register():
     bpy.utils.register_class(IMP_OP_GoogleMapsCapture)
+    bpy.utils.register_class(IMP_OP_ClearExtractionCache)
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
 
 
 def unregister():
+    bpy.utils.unregister_class(IMP_OP_ClearExtractionCache)
     bpy.utils.unregister_class(IMP_OP_GoogleMapsCapture)
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
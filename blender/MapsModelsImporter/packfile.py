@@ -0,0 +1,182 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+# no bpy nor renderdoc here, this is used on both sides of the extraction
+
+"""Pack files gather the arrays and constants of many draw calls in a single file:
+ - a fixed size header with a magic string and the location of the index,
+ - the array payloads, each one aligned to PAYLOAD_ALIGNMENT bytes,
+ - a JSON index giving for each draw call its constants and the offset, dtype
+   and shape of each of its arrays.
+
+Raw texture files hold 8 bit RGBA (or BGRA) texels as returned by RenderDoc,
+after a small header, optionally compressed with zlib.
+"""
+
+import json
+import mmap
+import zlib
+import struct
+import numpy as np
+
+MAGIC = b"MMIPACK1"
+HEADER_FORMAT = "<8sQQ" # magic, index offset, index size
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+PAYLOAD_ALIGNMENT = 64
+PACK_EXTENSION = ".pack"
+
+RAW_TEXTURE_MAGIC = b"MMIT"
+RAW_TEXTURE_HEADER_FORMAT = "<4sIIBB" # magic, width, height, is BGRA, is zlib compressed
+RAW_TEXTURE_HEADER_SIZE = struct.calcsize(RAW_TEXTURE_HEADER_FORMAT)
+RAW_TEXTURE_EXTENSION = ".rgba"
+
+# -----------------------------------------------------------------------------
+
+def packFilename(prefix, shard=0):
+    return "{}arrays-{:02d}{}".format(prefix, shard, PACK_EXTENSION)
+
+# -----------------------------------------------------------------------------
+
+class PackWriter():
+    def __init__(self, filename):
+        self.file = open(filename, 'wb')
+        self.file.write(b"\0" * HEADER_SIZE)
+        self.draws = []
+
+    def addDraw(self, drawcall_id, arrays, constants):
+        """Append the arrays of a draw call, given as a dict of numpy arrays
+        @return the record of the draw call in the index"""
+        layouts = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            offset = self.file.tell()
+            padding = -offset % PAYLOAD_ALIGNMENT
+            self.file.write(b"\0" * padding)
+            offset += padding
+            array.tofile(self.file)
+            layouts[name] = {
+                "offset": offset,
+                "dtype": array.dtype.str,
+                "shape": array.shape,
+            }
+        draw = {
+            "id": drawcall_id,
+            "arrays": layouts,
+            "constants": constants,
+        }
+        self.draws.append(draw)
+        return draw
+
+    def flush(self):
+        """Make the arrays added so far readable by a PackStreamReader"""
+        self.file.flush()
+
+    def close(self):
+        index = json.dumps({ "draws": self.draws }).encode('utf-8')
+        index_offset = self.file.tell()
+        self.file.write(index)
+        self.file.seek(0)
+        self.file.write(struct.pack(HEADER_FORMAT, MAGIC, index_offset, len(index)))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+# -----------------------------------------------------------------------------
+
+class PackReader():
+    """Read a pack file, arrays are views over a memory map of the file so they
+    are only paged in from disk when used"""
+    def __init__(self, filename):
+        with open(filename, 'rb') as file:
+            magic, index_offset, index_size = struct.unpack(HEADER_FORMAT, file.read(HEADER_SIZE))
+            if magic != MAGIC:
+                raise ValueError(f"Not a MapsModelsImporter pack file: {filename}")
+            file.seek(index_offset)
+            index = json.loads(file.read(index_size).decode('utf-8'))
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = np.frombuffer(self.mapping, dtype=np.uint8)
+        self.draws = { draw["id"]: draw for draw in index["draws"] }
+
+    def getArray(self, drawcall_id, name):
+        layout = self.draws[drawcall_id]["arrays"][name]
+        return np.ndarray(
+            shape=tuple(layout["shape"]),
+            dtype=np.dtype(layout["dtype"]),
+            buffer=self.data,
+            offset=layout["offset"]
+        )
+
+    def getConstants(self, drawcall_id):
+        return self.draws[drawcall_id]["constants"]
+
+    def close(self):
+        self.data = None
+        try:
+            self.mapping.close()
+        except BufferError:
+            pass # arrays are still used, the mapping is closed once they are released
+
+class PackStreamReader():
+    """Read arrays of a pack file that is still being written, the index is
+    not available yet so draw records are given by the writer (see protocol.py)"""
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+
+    def getArray(self, draw, name):
+        layout = draw["arrays"][name]
+        dtype = np.dtype(layout["dtype"])
+        shape = tuple(layout["shape"])
+        self.file.seek(layout["offset"])
+        data = self.file.read(int(np.prod(shape)) * dtype.itemsize)
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+    def close(self):
+        self.file.close()
+
+# -----------------------------------------------------------------------------
+
+def writeRawTexture(filename, data, width, height, bgra=False, compress=False):
+    """Write texels of the top row first, as returned by GetTextureData"""
+    if compress:
+        data = zlib.compress(data, 1)
+    with open(filename, 'wb') as file:
+        file.write(struct.pack(RAW_TEXTURE_HEADER_FORMAT, RAW_TEXTURE_MAGIC, width, height, bgra, compress))
+        file.write(data)
+
+def readRawTexture(filename):
+    """@return texels as an array of shape (height, width, 4) in RGBA order, top row first"""
+    with open(filename, 'rb') as file:
+        magic, width, height, bgra, compressed = struct.unpack(RAW_TEXTURE_HEADER_FORMAT, file.read(RAW_TEXTURE_HEADER_SIZE))
+        if magic != RAW_TEXTURE_MAGIC:
+            raise ValueError(f"Not a MapsModelsImporter raw texture file: {filename}")
+        data = file.read()
+    if compressed:
+        data = zlib.decompress(data)
+    texels = np.frombuffer(data, dtype=np.uint8, count=width * height * 4).reshape(height, width, 4)
+    if bgra:
+        texels = texels[:,:,[2, 1, 0, 3]]
+    return texels
@@ -48,13 +48,91 @@ class MapsModelsAddonPreferences(bpy.types.AddonPreferences):
         default=False,
         )
 
+    extraction_workers: bpy.props.IntProperty(
+        name="Extraction Workers",
+        description="Number of RenderDoc replay processes sharing the extraction of draw calls",
+        default=1,
+        min=1,
+        soft_max=16,
+        )
+
+    use_streaming: bpy.props.BoolProperty(
+        name="Streaming Import",
+        description="Import draw calls while the capture is still being extracted, instead of waiting for the whole extraction to finish",
+        default=False,
+        )
+
+    transport: bpy.props.EnumProperty(
+        name="Transport",
+        description="How draw call data is transferred from the extraction process to Blender",
+        items=[
+            ('FILE', "Files", "Write draw calls to files in the temporary directory"),
+            ('SHARED_MEMORY', "Shared Memory", "Transfer draw calls in memory, only textures are written to the temporary directory. Implies streaming import, and disables the extraction cache"),
+        ],
+        default='FILE',
+        )
+
+    use_daemon: bpy.props.BoolProperty(
+        name="Keep Extraction Process Running",
+        description="Start the extraction process once per session and reuse it for subsequent imports, instead of loading RenderDoc again for each import",
+        default=False,
+        )
+
+    use_cache: bpy.props.BoolProperty(
+        name="Cache Extracted Captures",
+        description="Keep extracted captures to skip the RenderDoc replay when importing the same capture again",
+        default=False,
+        )
+
+    cache_size: bpy.props.IntProperty(
+        name="Cache Size (MB)",
+        description="Maximum size of the extraction cache, least recently used captures are removed beyond it",
+        default=4096,
+        min=0,
+        )
+
+    trace_file: bpy.props.StringProperty(
+        name="Trace File",
+        description="Write a timeline of each import, extraction processes included, to this JSON file. It can be opened in chrome://tracing or ui.perfetto.dev",
+        subtype='FILE_PATH',
+        default="",
+        )
+
+    report_file: bpy.props.StringProperty(
+        name="Report File",
+        description="Write the time spent in each stage of the last import, extraction processes included, to this JSON file",
+        subtype='FILE_PATH',
+        default="",
+        )
+
+    memory_profiling: bpy.props.BoolProperty(
+        name="Profile Memory",
+        description="Measure the peak memory of each stage and draw call, extraction processes included, and the sites allocating most of it. Slows the import down",
+        default=False,
+        )
+
     def draw(self, context):
         layout = self.layout
         layout.label(text="The temporary directory is used for intermediate files and for textures.")
         layout.label(text="It can get heavy. If left empty, the capture file's directory is used.")
         layout.prop(self, "tmp_dir")
+        layout.label(text="Each extraction worker replays its own copy of the capture, using more memory.")
+        layout.prop(self, "extraction_workers")
+        layout.prop(self, "use_streaming")
+        layout.prop(self, "transport")
+        layout.prop(self, "use_daemon")
+        layout.label(text="The cache is stored in the temporary directory, or the system's one if left empty.")
+        layout.label(text="Textures imported from the cache are packed in the blend file.")
+        layout.prop(self, "use_cache")
+        row = layout.row()
+        row.enabled = self.use_cache
+        row.prop(self, "cache_size")
+        row.operator("import_rdc.clear_cache")
         layout.label(text="Turn on extra debug info:")
         layout.prop(self, "debug_info")
+        layout.prop(self, "trace_file")
+        layout.prop(self, "report_file")
+        layout.prop(self, "memory_profiling")
 
 # -----------------------------------------------------------------------------
 
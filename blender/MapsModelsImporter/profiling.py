@@ -23,10 +23,50 @@
 
 # no bpy here
 
+"""Spans measure the stages of the extraction and of the import:
+
+    with span("loadData", drawcall=entry["id"]):
+        ...
+
+or @profile() for a whole function. Spans nest, and the inner spans of a span
+that is attributed to a draw call are attributed to it as well. Each span
+adds a sample to the counter of its name in profiling_counters, and while a
+trace is recording it is also kept as an event of the Chrome trace format
+(chrome://tracing or https://ui.perfetto.dev), so that the traces of the
+extraction processes and of Blender can be merged into a single timeline.
+
+Memory profiling is opt-in, as tracemalloc slows Python down. While enabled,
+spans of the thread that enabled it also sample the peak of the memory
+allocated by Python and NumPy during the span, above its level when the span
+started, and how much the span raised the peak resident set size (RSS) of the
+process. The top allocation sites are kept for the largest sample of each span.
+"""
+
+import os
+import sys
+import json
 import time
-from math import sqrt
+import tracemalloc
+import functools
+import threading
+from math import sqrt, ceil
+from contextlib import contextmanager
 from collections import defaultdict
 
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+    if os.name == 'nt':
+        import ctypes
+        from ctypes import wintypes
+
+TOP_ALLOCATIONS = 5 # allocation sites kept for the largest sample of a span
+ALLOCATIONS_MIN_SIZE = 1024 * 1024 # do not look for allocation sites of smaller samples
+
+# Shift perf_counter() to the wall clock, to align the traces of several processes
+CLOCK_OFFSET = time.time() - time.perf_counter()
+
 # -------------------------------------------------------------------
 
 class Timer():
@@ -56,26 +96,400 @@ class ProfilingCounterProperty:
             var = self.accumulated_sq / self.sample_count - avg * avg
             return sqrt(max(0, var))
 
+    def percentile(self, p):
+        """Nearest rank percentile, p in [0, 100]"""
+        if self.sample_count == 0:
+            return 0
+        if not self.sorted:
+            self.samples.sort()
+            self.sorted = True
+        rank = max(1, ceil(p / 100 * self.sample_count))
+        return self.samples[rank - 1]
+
     def add_sample(self, value):
         if hasattr(value, 'ellapsed'):
             value = value.ellapsed()
         self.sample_count += 1
         self.accumulated += value
         self.accumulated_sq += value * value
+        self.samples.append(value)
+        self.sorted = False
 
     def reset(self):
         self.sample_count = 0
         self.accumulated = 0.0
         self.accumulated_sq = 0.0
+        self.samples = []
+        self.sorted = True
+
+    def stats(self):
+        """@return the statistics of the counter, in seconds"""
+        return {
+            "count": self.sample_count,
+            "total": self.accumulated,
+            "mean": self.average(),
+            "stddev": self.stddev(),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
 
     def summary(self):
-        """returns something like XXms (±Xms, X samples)"""
+        """returns something like XXms (±Xms, X samples, p50 Xms, p95 Xms, p99 Xms)"""
         return (
             f"{self.average()*1000.:.03}ms " +
             f"(±{self.stddev()*1000.:.03}ms, " +
-            f"{self.sample_count} samples)"
+            f"{self.sample_count} samples, " +
+            ", ".join(f"p{p} {self.percentile(p)*1000.:.03}ms" for p in (50, 95, 99)) + ")"
+        )
+
+# -------------------------------------------------------------------
+
+def peakRss():
+    """@return the peak resident set size of the process, in bytes, or 0 if unknown"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024 # kilobytes on Linux
+    if os.name == 'nt':
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    "PeakWorkingSetSize", "WorkingSetSize",
+                    "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage",
+                    "PagefileUsage", "PeakPagefileUsage",
+                )
+            ]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.c_void_p(ctypes.windll.kernel32.GetCurrentProcess())
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return 0
+
+def formatBytes(size):
+    return f"{size / (1024 * 1024):.03f}MB"
+
+class MemoryCounterProperty:
+    """Samples of memory profiling, see Profiler.span"""
+    def __init__(self):
+        self.reset()
+
+    def add_sample(self, traced, rss_growth, rss_peak, allocations=None):
+        """@param traced: peak of the memory traced during the span, above its level at the start
+        @param rss_growth: how much the peak RSS of the process increased during the span
+        @param rss_peak: peak RSS of the process at the end of the span
+        @param allocations: top allocation sites, as lines of text, if taken for this sample"""
+        self.samples.append((traced, rss_growth, rss_peak))
+        if allocations is not None:
+            self.allocations = (traced, allocations)
+
+    def traced_max(self):
+        return max((sample[0] for sample in self.samples), default=0)
+
+    def reset(self):
+        self.samples = []
+        self.allocations = None # (traced, lines) of the sample of the top allocation sites
+
+    def stats(self):
+        """@return the statistics of the counter, in bytes"""
+        count = len(self.samples)
+        return {
+            "count": count,
+            "traced_mean": sum(sample[0] for sample in self.samples) / count if count > 0 else 0,
+            "traced_max": self.traced_max(),
+            "rss_growth": sum(sample[1] for sample in self.samples),
+            "rss_peak": max((sample[2] for sample in self.samples), default=0),
+            "allocations": self.allocations[1] if self.allocations is not None else [],
+        }
+
+    def summary(self):
+        """returns something like traced XMB (max XMB), RSS +XMB (peak XMB)"""
+        stats = self.stats()
+        return (
+            f"traced {formatBytes(stats['traced_mean'])} (max {formatBytes(stats['traced_max'])}), " +
+            f"RSS +{formatBytes(stats['rss_growth'])} (peak {formatBytes(stats['rss_peak'])})"
         )
 
 # -------------------------------------------------------------------
 
 profiling_counters = defaultdict(ProfilingCounterProperty)
+memory_counters = defaultdict(MemoryCounterProperty)
+
+def profileFilename(prefix, shard=None):
+    """Counters of an extraction process, see writeCounters"""
+    if shard is None:
+        return "{}profile.json".format(prefix)
+    return "{}profile-{:02d}.json".format(prefix, shard)
+
+def writeCounters(filename, counters=profiling_counters, memory=memory_counters):
+    """Save the samples of the counters, so that they can be read by another process"""
+    with open(filename, 'w') as f:
+        json.dump({
+            "timings": { name: counter.samples for name, counter in counters.items() },
+            "memory": {
+                name: { "samples": counter.samples, "allocations": counter.allocations }
+                for name, counter in memory.items()
+            },
+        }, f)
+
+def readCounters(filename, counters=None, memory=None):
+    """Add the samples saved by writeCounters to counters, and the memory
+    samples to memory if not None
+    @return counters, a new dict of counters if None"""
+    if counters is None:
+        counters = defaultdict(ProfilingCounterProperty)
+    with open(filename) as f:
+        data = json.load(f)
+    for name, samples in data["timings"].items():
+        for sample in samples:
+            counters[name].add_sample(sample)
+    if memory is not None:
+        for name, saved in data["memory"].items():
+            counter = memory[name]
+            counter.samples.extend(tuple(sample) for sample in saved["samples"])
+            if saved["allocations"] is not None and saved["allocations"][0] >= counter.traced_max():
+                counter.allocations = tuple(saved["allocations"])
+    return counters
+
+# -------------------------------------------------------------------
+
+class Profiler():
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.children = defaultdict(set) # names of the spans found in each span, None for top level ones
+        self.drawcall_times = defaultdict(lambda: defaultdict(float)) # drawcall id -> span name -> seconds
+        self.trace_events = None # list of events while a trace is recording
+        self.memory_stack = None # [traced at start, peak traced] of the open spans while profiling memory
+        self.memory_thread = None # the thread whose spans profile memory
+        self.started_tracemalloc = False
+        self.drawcall_memory = {} # drawcall id -> peak traced memory
+
+    def stack(self):
+        """@return the (name, drawcall) of the spans open in the current thread"""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name, drawcall=None, **args):
+        """Measure the enclosed block
+        @param drawcall: id of the draw call to attribute the span to, inherited
+        from the enclosing span if None
+        @param args: extra details to show in the trace"""
+        stack = self.stack()
+        parent = stack[-1] if stack else (None, None)
+        if drawcall is None:
+            drawcall = parent[1]
+        stack.append((name, drawcall))
+        profile_memory = self.memory_stack is not None and threading.get_ident() == self.memory_thread
+        if profile_memory:
+            start_rss = self.enterMemorySpan()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            profile_memory = profile_memory and bool(self.memory_stack) # not reset meanwhile
+            memory = self.exitMemorySpan(start_rss) if profile_memory else None
+            self.record(name, parent[0], start, duration, drawcall, args, memory, parent[1] != drawcall)
+            if profile_memory and hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+    def profile(self, name=None):
+        """Decorator measuring each call of a function in a span, named after
+        the function unless a name is given"""
+        def decorator(func):
+            span_name = name or func.__name__
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, parent, start, duration, drawcall, args, memory=None, outermost=False):
+        """@param memory: (traced, rss growth, rss peak) if profiling memory
+        @param outermost: whether the span is the outermost one of its draw call"""
+        with self.lock:
+            profiling_counters[name].add_sample(duration)
+            self.children[parent].add(name)
+            if drawcall is not None:
+                self.drawcall_times[drawcall][name] += duration
+            if memory is not None:
+                counter = memory_counters[name]
+                allocations = None
+                if memory[0] >= ALLOCATIONS_MIN_SIZE and memory[0] > counter.traced_max():
+                    allocations = topAllocations()
+                counter.add_sample(*memory, allocations=allocations)
+                if drawcall is not None and outermost:
+                    self.drawcall_memory[drawcall] = max(self.drawcall_memory.get(drawcall, 0), memory[0])
+            if self.trace_events is not None:
+                if drawcall is not None:
+                    args = { **args, "drawcall": drawcall }
+                if memory is not None:
+                    self.trace_events.append({
+                        "name": "memory",
+                        "ph": "C",
+                        "ts": (start + duration + CLOCK_OFFSET) * 1e6,
+                        "pid": os.getpid(),
+                        "args": { "traced": tracemalloc.get_traced_memory()[0], "rss_peak": memory[2] },
+                    })
+                self.trace_events.append({
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start + CLOCK_OFFSET) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": args,
+                })
+
+    def reset(self):
+        """Forget all samples, and stop recording the trace and profiling memory if it was"""
+        with self.lock:
+            profiling_counters.clear()
+            memory_counters.clear()
+            self.children.clear()
+            self.drawcall_times.clear()
+            self.drawcall_memory.clear()
+            self.trace_events = None
+        self.stopMemoryProfiling()
+
+    def summaryLines(self):
+        """@return the summary of each counter, spans indented below the ones
+        they were found in"""
+        lines = []
+        visited = set()
+        def visit(parent, depth):
+            for name in sorted(self.children.get(parent, ())):
+                if name in visited:
+                    continue
+                visited.add(name)
+                line = f"{'  ' * depth} - {name}: {profiling_counters[name].summary()}"
+                if name in memory_counters:
+                    line += f", {memory_counters[name].summary()}"
+                lines.append(line)
+                visit(name, depth + 1)
+        visit(None, 0)
+        # Counters that are not fed by spans
+        for name, counter in profiling_counters.items():
+            if name not in visited:
+                lines.append(f" - {name}: {counter.summary()}")
+        return lines
+
+    def slowestDrawcalls(self, count=5):
+        """@return the (drawcall id, seconds per span name) of the draw calls
+        that took the longest, counting their outermost spans only"""
+        def total(times):
+            return sum(t for name, t in times.items() if not any(name in self.children[other] for other in times))
+        ranked = sorted(self.drawcall_times.items(), key=lambda item: total(item[1]), reverse=True)
+        return [(drawcall, dict(times)) for drawcall, times in ranked[:count]]
+
+    # Memory profiling
+
+    def startMemoryProfiling(self):
+        """Sample memory in the spans of the current thread, until reset()"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self.memory_thread = threading.get_ident()
+        self.memory_stack = []
+
+    def stopMemoryProfiling(self):
+        self.memory_stack = None
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    @property
+    def profilingMemory(self):
+        return self.memory_stack is not None
+
+    def enterMemorySpan(self):
+        """The peak since the last span boundary belongs to the enclosing span,
+        then peaks are measured from the start of this one
+        @return the peak RSS at the start of the span"""
+        current, peak = tracemalloc.get_traced_memory()
+        if self.memory_stack:
+            self.memory_stack[-1][1] = max(self.memory_stack[-1][1], peak)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.memory_stack.append([current, current])
+        return peakRss()
+
+    def exitMemorySpan(self, start_rss):
+        """@return (traced, rss growth, rss peak) of the span, see MemoryCounterProperty"""
+        current, peak = tracemalloc.get_traced_memory()
+        start, span_peak = self.memory_stack.pop()
+        span_peak = max(span_peak, peak)
+        if self.memory_stack:
+            self.memory_stack[-1][1] = max(self.memory_stack[-1][1], span_peak)
+        rss = peakRss()
+        return span_peak - start, rss - start_rss, rss
+
+    def memoryLines(self):
+        """@return the top allocation sites of the memory still in use at the
+        end of the largest sample of each span"""
+        lines = []
+        for name, counter in sorted(memory_counters.items()):
+            if counter.allocations is None:
+                continue
+            traced, allocations = counter.allocations
+            lines.append(f" - {name}, after a peak of {formatBytes(traced)}:")
+            lines.extend(f"   - {allocation}" for allocation in allocations)
+        return lines
+
+    def largestDrawcalls(self, count=5):
+        """@return the (drawcall id, peak traced memory) of the draw calls that used the most memory"""
+        return sorted(self.drawcall_memory.items(), key=lambda item: item[1], reverse=True)[:count]
+
+    # Trace recording
+
+    def startTrace(self, process_name):
+        """Record spans as trace events until stopTrace() is called"""
+        with self.lock:
+            self.trace_events = [{
+                "name": "process_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "args": { "name": process_name },
+            }]
+
+    def stopTrace(self):
+        """@return the events recorded since startTrace(), [] if it was not called"""
+        with self.lock:
+            events, self.trace_events = self.trace_events or [], None
+        return events
+
+    @property
+    def tracing(self):
+        return self.trace_events is not None
+
+def topAllocations(count=TOP_ALLOCATIONS):
+    """@return the sites that allocated most of the memory still in use, as lines of text"""
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+    return [
+        f"{stat.traceback}: {formatBytes(stat.size)} in {stat.count} blocks"
+        for stat in snapshot.statistics('lineno')[:count]
+    ]
+
+profiler = Profiler()
+span = profiler.span
+profile = profiler.profile
+
+# -------------------------------------------------------------------
+
+def writeTrace(filename, events):
+    with open(filename, 'w') as f:
+        json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, f)
+
+def readTrace(filename):
+    """@return the events of a trace file written by writeTrace"""
+    with open(filename) as f:
+        return json.load(f)["traceEvents"]
@@ -0,0 +1,83 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+# no bpy nor renderdoc here, this is used on both sides of the extraction
+
+"""In streaming mode, the extraction process announces its progress on its
+standard output, one event per line, while its log goes to the standard error.
+An event is a JSON object with a "type" field, after the EVENT_PREFIX marker:
+ - "start": the draw calls have been listed, with "drawcall_count" and
+   "drawcalls", their ids,
+ - "drawcall": a draw call is ready to be imported, with its "entry" in the
+   manifest and its "draw" record in the pack file (constants and array layouts),
+ - "skipped": the "drawcall" with this id will not be announced, because it
+   could not be extracted or did not fit in the import budget,
+ - "end": all draw calls have been announced, the extraction process may then
+   wait for the importer to release it (see sharedmem.py) before finishing.
+The extraction daemon adds events of its own, see google_maps_rd_daemon.py.
+Lines without the marker, e.g. printed by the native RenderDoc library, are
+not events.
+"""
+
+import sys
+import json
+import threading
+
+EVENT_PREFIX = "@mmi "
+
+# -----------------------------------------------------------------------------
+
+def formatEvent(event_type, **fields):
+    return EVENT_PREFIX + json.dumps({ "type": event_type, **fields })
+
+def parseEvent(line):
+    """@return the event as a dict, or None if the line is not an event"""
+    if not line.startswith(EVENT_PREFIX):
+        return None
+    return json.loads(line[len(EVENT_PREFIX):])
+
+# -----------------------------------------------------------------------------
+
+class EventStream():
+    """Write events to a file, whole lines at once whichever thread emits them"""
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def emit(self, event_type, **fields):
+        self.writeLine(formatEvent(event_type, **fields))
+
+    def writeLine(self, line):
+        """Also used to relay the events of another process"""
+        with self.lock:
+            self.file.write(line.rstrip("\n") + "\n")
+            self.file.flush()
+
+    @staticmethod
+    def redirectStdout():
+        """Keep the standard output for events only, print() goes to the
+        standard error from now on
+        @return an event stream writing to the original standard output"""
+        events = EventStream(sys.stdout)
+        sys.stdout = sys.stderr
+        return events
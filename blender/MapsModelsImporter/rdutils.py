@@ -23,6 +23,14 @@
 
 import renderdoc as rd
 
+def resourceKey(rid):
+    """Identifier of a resource as a string of digits, which is the same in all
+    replays of a capture, for use in file names"""
+    try:
+        return str(int(rid))
+    except TypeError:
+        return ''.join(c for c in str(rid) if c.isdigit())
+
 class CaptureWrapper():
     def __init__(self, filename):
         self.filename = filename
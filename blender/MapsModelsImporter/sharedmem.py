@@ -0,0 +1,144 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+# no bpy nor renderdoc here, this is used on both sides of the extraction
+
+"""Shared memory transport of the draw call arrays, instead of pack files.
+The extraction process copies arrays into shared memory segments and
+announces their location in streaming mode (see protocol.py), the importer
+reads them in place.
+
+Segments belong to the extraction process, which unlinks them when it exits.
+It must hence wait for the importer to have attached all of them, which is
+the case once the importer received the "end" event and writes RELEASE_LINE
+on the standard input of the extraction process.
+"""
+
+import os
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+SEGMENT_SIZE = 64 * 1024 * 1024 # arrays of several draw calls share a segment
+PAYLOAD_ALIGNMENT = 64
+RELEASE_LINE = "release\n"
+
+# -----------------------------------------------------------------------------
+
+def attachSegment(name):
+    """Open a segment created by another process, without unlinking it when
+    this process exits"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13, attached segments are registered to be unlinked
+        segment = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix':
+            resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+# -----------------------------------------------------------------------------
+
+class SharedPackWriter():
+    """Same interface as PackWriter, arrays are copied into shared memory
+    segments that remain available until release() is called"""
+    def __init__(self):
+        self.segments = []
+        self.offset = 0
+
+    def allocate(self, size):
+        """@return the segment and offset of a new chunk of size bytes"""
+        offset = self.offset + (-self.offset % PAYLOAD_ALIGNMENT)
+        if not self.segments or offset + size > self.segments[-1].size:
+            self.segments.append(shared_memory.SharedMemory(create=True, size=max(size, SEGMENT_SIZE)))
+            offset = 0
+        self.offset = offset + size
+        return self.segments[-1], offset
+
+    def addDraw(self, drawcall_id, arrays, constants):
+        """@return the record of the draw call, locating its arrays"""
+        layouts = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            segment, offset = self.allocate(array.nbytes)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf, offset=offset)[...] = array
+            layouts[name] = {
+                "segment": segment.name,
+                "offset": offset,
+                "dtype": array.dtype.str,
+                "shape": array.shape,
+            }
+        return {
+            "id": drawcall_id,
+            "arrays": layouts,
+            "constants": constants,
+        }
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Segments are kept until release()"""
+        pass
+
+    def release(self):
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+# -----------------------------------------------------------------------------
+
+class SharedPackReader():
+    """Read arrays written by a SharedPackWriter, same interface as PackStreamReader"""
+    def __init__(self):
+        self.segments = {}
+
+    def attach(self, draw):
+        """Open the segments of a draw call as soon as it is announced"""
+        for layout in draw["arrays"].values():
+            if layout["segment"] not in self.segments:
+                self.segments[layout["segment"]] = attachSegment(layout["segment"])
+
+    def getArray(self, draw, name):
+        layout = draw["arrays"][name]
+        self.attach(draw)
+        return np.ndarray(
+            shape=tuple(layout["shape"]),
+            dtype=np.dtype(layout["dtype"]),
+            buffer=self.segments[layout["segment"]].buf,
+            offset=layout["offset"]
+        )
+
+    def close(self):
+        for segment in self.segments.values():
+            try:
+                segment.close()
+            except BufferError:
+                pass # arrays are still used, the mapping is closed once they are released
+        self.segments = {}
@@ -0,0 +1,345 @@
+# Copyright (c) 2019 - 2024 Elie Michel
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the “Software”), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# The Software is provided “as is”, without warranty of any kind, express or
+# implied, including but not limited to the warranties of merchantability,
+# fitness for a particular purpose and noninfringement. In no event shall
+# the authors or copyright holders be liable for any claim, damages or other
+# liability, whether in an action of contract, tort or otherwise, arising from,
+# out of or in connection with the software or the use or other dealings in the
+# Software.
+#
+# This file is part of MapsModelsImporter, a set of addons to import 3D models
+# from Maps services
+
+"""Checks of google_maps.py that need neither Blender nor RenderDoc, e.g. of
+the NumPy decoding against the per-element code it replaced. Runs in a plain Python interpreter, with the stand-in bpy
+and mathutils modules of benchmark/stubs:
+    python -m pytest tests
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+import numpy as np
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "blender"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "blender", "MapsModelsImporter"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmark", "stubs"))
+import renderdoc as rd
+from meshdata import DrawBuffers, unpackDataNumpy
+from rdutils import CaptureWrapper
+from google_maps_rd import CaptureScraper, parseArgs
+from MapsModelsImporter.google_maps import decodeTriangles, decompressMapyCZ, DrawcallStream
+from MapsModelsImporter.budget import triangleCount, ImportBudget, selectEntries
+from MapsModelsImporter.cache import ExtractionCache
+from MapsModelsImporter.manifest import makeManifest, writeManifest, readManifest, manifestFilename
+from MapsModelsImporter.packfile import writeRawTexture, readRawTexture, PackWriter, PackReader
+
+# -----------------------------------------------------------------------------
+# Former implementations, as they were before vectorization
+
+def legacyTriangles(indices, topology):
+    n = len(indices)
+    if topology == 'TRIANGLE_STRIP':
+        tris = [ [ indices[i+j] for j in [[0,1,2],[0,2,1]][i%2] ] for i in range(n - 3)]
+        tris = [ t for t in tris if t[0] != t[1] and t[0] != t[2] and t[1] != t[2] ]
+    else:
+        tris = [ [ indices[3*i+j] for j in range(3) ] for i in range(n//3) ]
+    return np.array(tris, dtype=np.int32).reshape(-1, 3)
+
+def legacyDecompressMapyCZ(raw_verts, _uParamsSE):
+    verts = []
+    for v0 in raw_verts:
+        r0 = [0.0, 0.0, 0.0, 0.0]
+        r1 = np.zeros((3,), dtype=np.float32)
+        r2 = np.zeros((3,), dtype=np.float32)
+        r1[0] = v0[0] * _uParamsSE[3][0] + _uParamsSE[0][0]
+        r1[1] = v0[1] * _uParamsSE[0][1] + _uParamsSE[1][0]
+        r1[2] = (v0[2] * _uParamsSE[1][1] + _uParamsSE[2][0]) * _uParamsSE[3][3]
+        r0[1] = np.linalg.norm(r1)
+        r0[2] = r0[1] + 0.0001
+        r0[1] = r0[1] - _uParamsSE[2][3]
+        r0[2] = 1.0 / r0[2]
+        r1 *= r0[2]
+        r0[2] = min(max(r0[1], _uParamsSE[1][2]), _uParamsSE[3][2]) # clamp
+        r0[2] = (r0[2] - _uParamsSE[1][2]) * _uParamsSE[0][3] * _uParamsSE[1][3] + _uParamsSE[2][2]
+        r0[1] = r0[1] * r0[2] - r0[1]
+        r2[0] = v0[0] * _uParamsSE[3][0]
+        r2[1] = v0[1] * _uParamsSE[0][1]
+        r2[2] = v0[2] * _uParamsSE[1][1]
+        r2 += r1 * r0[1]
+        verts.append(r2.tolist())
+    return np.array(verts, dtype=np.float32).reshape(-1, 3)
+
+# -----------------------------------------------------------------------------
+
+TOPOLOGIES = ['TRIANGLE_STRIP', 'TRIANGLES']
+INDEX_TYPES = [np.uint16, np.uint32]
+
+def randomIndices(count, dtype, seed):
+    rng = np.random.default_rng(seed)
+    # Few distinct vertices, so that strips contain degenerate triangles
+    indices = rng.integers(0, 8, size=count)
+    if dtype == np.uint32:
+        indices += 70000
+    return indices.astype(dtype)
+
+@pytest.mark.parametrize("topology", TOPOLOGIES)
+@pytest.mark.parametrize("dtype", INDEX_TYPES)
+@pytest.mark.parametrize("count", [0, 1, 2, 3, 4, 5, 7, 100, 1001])
+def test_decodeTriangles(topology, dtype, count):
+    indices = randomIndices(count, dtype, seed=count)
+    tris = decodeTriangles(indices, topology)
+    assert tris.dtype == np.int32
+    np.testing.assert_array_equal(tris, legacyTriangles(indices, topology))
+
+@pytest.mark.parametrize("topology", TOPOLOGIES)
+@pytest.mark.parametrize("dtype", INDEX_TYPES)
+@pytest.mark.parametrize("count", [0, 1, 3, 4, 5, 100, 1001])
+def test_triangleCount(topology, dtype, count):
+    indices = randomIndices(count, dtype, seed=count)
+    assert triangleCount(topology, indices) == len(decodeTriangles(indices, topology))
+
+@pytest.mark.parametrize("topology", TOPOLOGIES)
+def test_decodeTriangles_list(topology):
+    indices = [0, 1, 2, 2, 3, 4, 5]
+    np.testing.assert_array_equal(decodeTriangles(indices, topology), legacyTriangles(indices, topology))
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("count", [0, 1, 257])
+def test_decompressMapyCZ(seed, count):
+    rng = np.random.default_rng(seed)
+    _uParamsSE = rng.uniform(0.5, 2.0, size=(4, 4)).astype(np.float32)
+    # Clamp range of the height, around the norm of the offset directions
+    _uParamsSE[1][2], _uParamsSE[3][2] = 0.5, 4.0
+    positions = rng.uniform(-150.0, 150.0, size=(count, 4)).astype(np.float32)
+    verts = decompressMapyCZ(positions, _uParamsSE)
+    assert verts.dtype == np.float32
+    assert verts.shape == (count, 3)
+    # The former loop computed in float32, the new code in float64
+    np.testing.assert_allclose(verts, legacyDecompressMapyCZ(positions[:,:3], _uParamsSE), rtol=1e-5, atol=1e-4)
+
+# -----------------------------------------------------------------------------
+
+class IdStream(DrawcallStream):
+    """Draw call stream that does not read arrays"""
+    def load(self, event):
+        return event["entry"]["id"]
+
+def drawcallEvent(drawcall_id):
+    return { "type": "drawcall", "entry": { "id": drawcall_id } }
+
+def test_DrawcallStream_holds_back():
+    stream = IdStream("")
+    assert list(stream.start([3, 5, 8])) == []
+    assert list(stream.receive(drawcallEvent(8))) == []
+    assert list(stream.receive(drawcallEvent(3))) == [3, 8]
+    assert list(stream.receive(drawcallEvent(5))) == [5]
+
+def test_DrawcallStream_skipped_first():
+    stream = IdStream("")
+    assert list(stream.start([3, 5, 8])) == []
+    assert list(stream.receive(drawcallEvent(8))) == []
+    assert list(stream.skip(3)) == []
+    assert list(stream.receive(drawcallEvent(5))) == [5, 8]
+
+def test_DrawcallStream_skipped_all_before():
+    stream = IdStream("")
+    assert list(stream.start([3, 5, 8])) == []
+    assert list(stream.skip(5)) == []
+    assert list(stream.receive(drawcallEvent(8))) == []
+    assert list(stream.skip(3)) == [8]
+
+def test_DrawcallStream_skipped_all():
+    stream = IdStream("")
+    assert list(stream.start([3])) == []
+    assert list(stream.skip(3)) == []
+    assert stream.started
+
+# -----------------------------------------------------------------------------
+
+def budgetEntries(triangle_counts):
+    return [
+        { "id": i, "topology": "TRIANGLES", "index_count": 3 * count, "triangle_count": count, "vertex_count": 0, "byte_size": 0, "texture": None }
+        for i, count in enumerate(triangle_counts)
+    ]
+
+def cachedExtraction(tmp_path, entries, max_blocks, budget):
+    cache = ExtractionCache(str(tmp_path), 1 << 30)
+    prefix = cache.prepare("key", "capture.rdc")
+    writeManifest(manifestFilename(prefix), makeManifest("Google", max_blocks, entries, budget=budget.limits()))
+    cache.commit("key", prefix)
+    return cache
+
+def triangleCounts(entries):
+    return [entry["triangle_count"] for entry in entries]
+
+def test_selectEntries_smaller_budget():
+    entries = budgetEntries([2500, 1500, 1000, 600])
+    assert triangleCounts(selectEntries(entries, ImportBudget(max_triangles=3000))) == [2500]
+    assert triangleCounts(selectEntries(entries, ImportBudget(max_triangles=2000))) == [1500]
+
+def test_ExtractionCache_smaller_budget(tmp_path):
+    entries = budgetEntries([2500, 1500, 1000, 600])
+    budget = ImportBudget(max_triangles=3000)
+    cache = cachedExtraction(tmp_path, selectEntries(entries, budget), -1, budget)
+    assert cache.lookup("key", -1, ImportBudget(max_triangles=3000)) is not None
+    assert cache.lookup("key", -1, ImportBudget(max_triangles=2000)) is None
+    assert cache.lookup("key", -1, ImportBudget(max_triangles=4000)) is None
+    assert cache.lookup("key", 2, ImportBudget(max_triangles=3000)) is None
+    assert cache.lookup("key", -1) is None
+
+def test_ExtractionCache_no_budget(tmp_path):
+    cache = cachedExtraction(tmp_path, budgetEntries([2500, 1500, 1000, 600]), 4, ImportBudget())
+    assert cache.lookup("key", 4) is not None
+    assert cache.lookup("key", 2, ImportBudget(max_triangles=2000)) is not None
+    assert cache.lookup("key", 5) is None
+    assert cache.lookup("key", -1) is None
+
+# -----------------------------------------------------------------------------
+
+class BufferController():
+    """Stand-in for the replay controller, serving a single vertex buffer"""
+    def __init__(self, data):
+        self.data = data
+
+    def GetBufferData(self, rid, offset, length):
+        return self.data[offset:offset + length]
+
+def vertexAttribute(offset, stride, fmt):
+    """Stand-in for MeshData, with only what DrawBuffers reads"""
+    return SimpleNamespace(
+        vertexResourceId=rd.ResourceId(1),
+        vertexBufferByteOffset=0,
+        vertexByteStride=stride,
+        attributeByteOffset=offset,
+        format=fmt,
+    )
+
+@pytest.mark.parametrize("first_vertex", [0, 3])
+def test_DrawBuffers_planar(first_vertex):
+    """Attributes stored one after the other, at offsets beyond the stride"""
+    vertex_count = 10
+    fmt = rd.ResourceFormat(rd.CompType.Float, 2, 4)
+    positions = np.arange(2 * vertex_count, dtype=np.float32).reshape(-1, 2)
+    uvs = -positions
+    controller = BufferController(positions.tobytes() + uvs.tobytes())
+    indices = np.array([first_vertex, vertex_count - 1, first_vertex + 1])
+    buffers = DrawBuffers(controller, None, indices)
+    used = slice(first_vertex, vertex_count)
+    np.testing.assert_array_equal(buffers.fetchData(vertexAttribute(0, 8, fmt)), positions[used])
+    np.testing.assert_array_equal(buffers.fetchData(vertexAttribute(8 * vertex_count, 8, fmt)), uvs[used])
+
+def test_DrawBuffers_interleaved():
+    """Interleaved attributes share a single read"""
+    fmt = rd.ResourceFormat(rd.CompType.Float, 2, 4)
+    vertices = np.arange(4 * 10, dtype=np.float32).reshape(-1, 4)
+    controller = BufferController(vertices.tobytes())
+    buffers = DrawBuffers(controller, None, np.array([2, 5]))
+    np.testing.assert_array_equal(buffers.fetchData(vertexAttribute(0, 16, fmt)), vertices[2:6,:2])
+    np.testing.assert_array_equal(buffers.fetchData(vertexAttribute(8, 16, fmt)), vertices[2:6,2:])
+    assert buffers.fetched_bytes == 4 * 16
+
+def test_unpackDataNumpy_truncated_last():
+    """Only the last value is cut, as when the buffer does not include the padding of the last stride"""
+    fmt = rd.ResourceFormat(rd.CompType.Float, 2, 4)
+    values = np.arange(8, dtype=np.float32).reshape(-1, 2)
+    decoded = unpackDataNumpy(fmt, values.tobytes()[:-4], stride=8, count=4)
+    np.testing.assert_array_equal(decoded[:3], values[:3])
+    assert decoded[3][0] == values[3][0]
+
+def test_unpackDataNumpy_truncated():
+    fmt = rd.ResourceFormat(rd.CompType.Float, 2, 4)
+    data = np.arange(8, dtype=np.float32).tobytes()
+    with pytest.raises(ValueError):
+        unpackDataNumpy(fmt, data[:24], stride=8, count=4)
+    with pytest.raises(ValueError):
+        unpackDataNumpy(fmt, data, stride=8, count=2, offset=32)
+
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("bgra", [False, True])
+@pytest.mark.parametrize("compress", [False, True])
+def test_rawTexture(tmp_path, bgra, compress):
+    rgba = np.random.default_rng(0).integers(0, 256, size=(5, 7, 4), dtype=np.uint8)
+    data = rgba[:,:,[2, 1, 0, 3]] if bgra else rgba
+    filename = str(tmp_path / "texture.rgba")
+    writeRawTexture(filename, data.tobytes(), 7, 5, bgra=bgra, compress=compress)
+    np.testing.assert_array_equal(readRawTexture(filename), rgba)
+
+def test_rawTexture_magic(tmp_path):
+    filename = tmp_path / "texture.rgba"
+    filename.write_bytes(b"\x89PNG" + bytes(64))
+    with pytest.raises(ValueError):
+        readRawTexture(str(filename))
+
+def test_PackReader_close(tmp_path):
+    filename = str(tmp_path / "arrays.pack")
+    positions = np.arange(12, dtype=np.float32).reshape(-1, 3)
+    with PackWriter(filename) as pack:
+        pack.addDraw(0, { "positions": positions }, { "DrawCall": {} })
+    pack = PackReader(filename)
+    array = pack.getArray(0, "positions")
+    np.testing.assert_array_equal(array, positions)
+    pack.close()
+    assert not pack.mapping.closed # still used by the array
+    del array
+    pack.close()
+    assert pack.mapping.closed
+
+# -----------------------------------------------------------------------------
+
+@pytest.mark.parametrize("kind", ["maps", "earth", "mapy"])
+def test_CaptureScraper_seeks_each_event_once(tmp_path, kind):
+    """Classification tests draw calls for several strategies, but only replays each event once"""
+    capture_file = str(tmp_path / "capture.rdc")
+    rd.writeCapture(capture_file, kind, draws=50, vertices=10)
+    with CaptureWrapper(capture_file) as controller:
+        seeks = []
+        set_frame_event = controller.SetFrameEvent
+        def countingSetFrameEvent(eventId, force):
+            seeks.append(eventId)
+            set_frame_event(eventId, force)
+        controller.SetFrameEvent = countingSetFrameEvent
+        scraper = CaptureScraper(controller, parseArgs([capture_file, str(tmp_path / "capture-"), "-1"]))
+        relevant_drawcalls, _ = scraper.extractRelevantCalls(scraper.consolidateEvents(controller.GetRootActions()))
+    assert len(relevant_drawcalls) == 50
+    assert len(seeks) == len(set(seeks))
+
+def countSeeks(controller):
+    seeks = []
+    set_frame_event = controller.SetFrameEvent
+    def countingSetFrameEvent(eventId, force):
+        seeks.append(eventId)
+        set_frame_event(eventId, force)
+    controller.SetFrameEvent = countingSetFrameEvent
+    return seeks
+
+def scrapeCapture(capture_file, prefix, *args):
+    with CaptureWrapper(capture_file) as controller:
+        seeks = countSeeks(controller)
+        CaptureScraper(controller, parseArgs([capture_file, prefix, "-1", *args])).run()
+    return readManifest(manifestFilename(prefix))["drawcalls"], seeks
+
+def test_CaptureScraper_budget(tmp_path):
+    """Extraction stops once the budget is exhausted and keeps the same draw
+    calls as the selection of a full extraction"""
+    capture_file = str(tmp_path / "capture.rdc")
+    rd.writeCapture(capture_file, "maps", draws=50, vertices=10)
+    full_entries, full_seeks = scrapeCapture(capture_file, str(tmp_path / "full-"))
+    budget = ImportBudget(max_triangles=sum(entry["triangle_count"] for entry in full_entries) // 5)
+    entries, seeks = scrapeCapture(capture_file, str(tmp_path / "budget-"), "--max-triangles", str(budget.max_triangles))
+    assert [entry["id"] for entry in entries] == [entry["id"] for entry in selectEntries(full_entries, budget)]
+    assert len(seeks) < len(full_seeks)